@@ -1,7 +1,16 @@
 import pandas as pd
 import sonoff
+import sqlalchemy
 import requests
 import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, Tuple
 
 from config import dbConfig, switchCloudControl
 from db import db
@@ -11,6 +20,30 @@ logger = create_logger('action')
 
 devices_file = switchCloudControl['config_file']
 
+# Devices are switched concurrently, up to max_workers at a time. Each HTTP
+# call times out after request_timeout seconds. Actions of a device still
+# running after dispatch_timeout seconds are not started, and are left for
+# the next execute_todo.
+max_workers = switchCloudControl.get('max_workers', 8)
+request_timeout = switchCloudControl.get('request_timeout', 5)
+dispatch_timeout = switchCloudControl.get('dispatch_timeout', 60)
+
+# Several workers (e.g. dataCollector replicas) can share the action queue.
+# Each claims a batch of due actions with a lease, which other workers skip
+# until it expires.
+worker_id = f'{socket.gethostname()}:{os.getpid()}'
+claim_batch_size = switchCloudControl.get('claim_batch_size', 100)
+lease_seconds = switchCloudControl.get('lease_seconds', dispatch_timeout + 60)
+
+# Seconds to wait for a device client to be created, which for Sonoff
+# includes logging in to the cloud account
+login_timeout = switchCloudControl.get('login_timeout', 30)
+
+# A device's last confirmed state is trusted for this many seconds
+shadow_ttl = switchCloudControl.get('shadow_ttl', 60)
+# With pushed state updates, how long to wait for a switch to be reported
+push_timeout = switchCloudControl.get('push_timeout', 5)
+
 with db(**dbConfig) as DB:
     DB.create_schema('action')
 
@@ -54,6 +87,50 @@ with db(**dbConfig) as DB:
                 ON DELETE SET NULL
                 ON UPDATE CASCADE
             );
+
+        ALTER TABLE action.action
+            ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100)
+            , ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE;
+
+        CREATE TABLE IF NOT EXISTS action.device_state (
+            device_type VARCHAR(100) NOT NULL
+            , device_id VARCHAR(100) NOT NULL
+            , is_on BOOLEAN NOT NULL
+            , seen_at TIMESTAMP WITH TIME ZONE NOT NULL
+            , PRIMARY KEY (device_type, device_id)
+            );
+
+        -- Only pending actions are ever looked up by time, so keep the index
+        -- to those. It stays small however long the history gets.
+        CREATE INDEX IF NOT EXISTS action_pending_idx
+        ON action.action (action_time, device_id)
+        WHERE status IS NULL AND actioned_at IS NULL;
+
+        -- Wake up listeners (see actionTimer.py) when actions are added
+        CREATE OR REPLACE FUNCTION action.notify_action_inserted()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify('action_inserted', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Only if missing, as creating a trigger locks the table against
+        -- writes and this runs on every import
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                    SELECT 1
+                    FROM pg_trigger
+                    WHERE tgrelid = 'action.action'::regclass
+                        AND tgname = 'action_inserted') THEN
+                CREATE TRIGGER action_inserted
+                AFTER INSERT ON action.action
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE action.notify_action_inserted();
+            END IF;
+        END
+        $$;
         """)
     DB.session.commit()
 
@@ -120,6 +197,249 @@ with db(**dbConfig) as DB:
 #             """)
 #         self.DB.session.commit()
 
+class Device_Registry:
+    """Long-lived store of device clients
+
+    The devices file is loaded once and only re-read when its modification
+    time changes. One logged-in Sonoff account is kept per set of
+    credentials and one HTTP session per Shelly endpoint, and device objects
+    are reused between actions.
+
+    Device clients and accounts are created outside the registry's lock, one
+    at a time per key, so a slow login only holds up callers wanting the
+    same client.
+    """
+
+    def __init__(self, devices_file: str):
+        self.devices_file = devices_file
+        self._mtime = None
+        self._devices = {}
+        self._instances = {}
+        self._sonoff_accounts = {}
+        self._sessions = {}
+        self._lock = threading.RLock()
+
+    @property
+    def devices(self) -> dict:
+        with self._lock:
+            mtime = os.path.getmtime(self.devices_file)
+            if mtime != self._mtime:
+                with open(self.devices_file, 'r') as f:
+                    self._devices = json.load(f)
+                self._mtime = mtime
+                # Credentials may have changed
+                self._instances.clear()
+            return self._devices
+
+    def _cached(self, cache: dict, key: tuple, create: Callable, name: str):
+        """cache[key], created by create() on first use
+
+        The first caller for a key starts create() in a thread of its own and
+        later callers wait for the same result, for up to login_timeout
+        seconds. If create() fails or times out the key is dropped, so the
+        next call tries again.
+
+        Args:
+            name (str): What is being created, for the timeout error
+
+        Raises:
+            TimeoutError: create() took longer than login_timeout
+        """
+        with self._lock:
+            future = cache.get(key)
+            if future is None:
+                future = cache[key] = Future()
+                threading.Thread(target=self._create,
+                                 args=(cache, key, future, create),
+                                 daemon=True).start()
+        try:
+            return future.result(timeout=login_timeout)
+        except FutureTimeoutError:
+            self._discard(cache, key, future)
+            raise TimeoutError(f'Creating {name} took longer than '
+                               f'{login_timeout}s')
+
+    def _create(self, cache: dict, key: tuple, future: Future,
+                create: Callable):
+        try:
+            future.set_result(create())
+        except Exception as e:
+            self._discard(cache, key, future)
+            future.set_exception(e)
+
+    def _discard(self, cache: dict, key: tuple, future: Future):
+        with self._lock:
+            if cache.get(key) is future:
+                del cache[key]
+
+    def get_device(self, device_class: type, device_id: str) -> 'Device_Base':
+        self.devices  # reload if changed
+        return self._cached(self._instances,
+                            (device_class.device_type, device_id),
+                            lambda: device_class(device_id), device_id)
+
+    def sonoff_account(self, username: str, password: str, api_region: str
+                       ) -> Tuple[sonoff.Sonoff, threading.Lock]:
+        """Logged in account and a lock to serialise calls made through it"""
+        return self._cached(
+            self._sonoff_accounts, (username, password, api_region),
+            lambda: (sonoff.Sonoff(username, password, api_region),
+                     threading.Lock()), f'Sonoff account {username}')
+
+    def session(self, endpoint: str, username: str, password: str
+                ) -> requests.Session:
+        """Keep-alive HTTP session for a device endpoint"""
+        key = (endpoint, username, password)
+        with self._lock:
+            if key not in self._sessions:
+                session = requests.Session()
+                session.auth = (username, password)
+                self._sessions[key] = session
+            return self._sessions[key]
+
+
+registry = Device_Registry(devices_file)
+
+
+class Device_Shadow:
+    """Last confirmed on/off state of each device and when it was seen
+
+    Held in memory and persisted to action.device_state. Devices use it to
+    skip commands which would not change anything, and to avoid reading
+    their state back after switching.
+
+    When pushed updates are enabled (see shellyListener.py) devices can also
+    wait for a state change to be reported rather than polling for it.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # Devices file keys (e.g. mqtt_id) identifying the devices whose
+        # state changes a running listener pushes into the shadow
+        self.push_keys = set()
+        # (device_type, device_id): (is_on, seen_at as unix time)
+        self._states = {}
+        # (device_type, device_id): unix time last written to the table
+        self._persisted_at = {}
+        self._changed = threading.Condition()
+
+        with db(**dbConfig) as DB:
+            for row in DB.connection.execute("""
+                    SELECT device_type
+                        , device_id
+                        , is_on
+                        , EXTRACT(EPOCH FROM seen_at) AS seen_at
+                    FROM action.device_state
+                    """):
+                self._states[(row['device_type'], row['device_id'])] = (
+                    row['is_on'], float(row['seen_at']))
+
+    def get(self, device_type: str, device_id: str, shared: bool = False
+            ) -> Optional[bool]:
+        """State if seen within ttl seconds, otherwise None
+
+        Args:
+            shared: also read the state saved in action.device_state, which
+                is newer if another process has switched the device since
+                this one last saw it
+        """
+        if shared:
+            try:
+                self._reload(device_type, device_id)
+            except Exception as e:
+                logger.warning(f'Unable to read state of {device_id}: {e}')
+                return None
+
+        with self._changed:
+            is_on, seen_at = self._states.get((device_type, device_id),
+                                              (None, 0))
+        if time.time() - seen_at > self.ttl:
+            return None
+        return is_on
+
+    def update(self, device_type: str, device_id: str, is_on: bool):
+        key = (device_type, device_id)
+        seen_at = time.time()
+        with self._changed:
+            changed = self._states.get(key, (None, 0))[0] != is_on
+            self._states[key] = (is_on, seen_at)
+            self._changed.notify_all()
+
+            # Pushed updates repeat the same state often, only write those
+            # which change the state or refresh a stale row
+            if not changed \
+                    and seen_at - self._persisted_at.get(key, 0) < self.ttl:
+                return
+            self._persisted_at[key] = seen_at
+
+        try:
+            self._persist(device_type, device_id, is_on, seen_at)
+        except Exception as e:
+            # The device has still been switched
+            logger.warning(f'Unable to save state of {device_id}: {e}')
+
+    def wait_for(self, device_type: str, device_id: str, is_on: bool,
+                 since: float, timeout: float) -> bool:
+        """Wait for the device to be reported in state is_on after since
+
+        Returns:
+            bool: False if this did not happen within timeout seconds
+        """
+        def reported():
+            state, seen_at = self._states.get((device_type, device_id),
+                                              (None, 0))
+            return state == is_on and seen_at >= since
+
+        with self._changed:
+            return self._changed.wait_for(reported, timeout=timeout)
+
+    def _persist(self, device_type: str, device_id: str, is_on: bool,
+                 seen_at: float):
+        with db(**dbConfig) as DB:
+            with DB.connection.begin():
+                DB.connection.execute(sqlalchemy.text("""
+                    INSERT INTO action.device_state (
+                        device_type
+                        , device_id
+                        , is_on
+                        , seen_at)
+                    VALUES (
+                        :device_type
+                        , :device_id
+                        , :is_on
+                        , to_timestamp(:seen_at))
+                    ON CONFLICT (device_type, device_id) DO UPDATE
+                    SET is_on = EXCLUDED.is_on
+                        , seen_at = EXCLUDED.seen_at
+                    """), {'device_type': device_type, 'device_id': device_id,
+                           'is_on': is_on, 'seen_at': seen_at})
+
+    def _reload(self, device_type: str, device_id: str):
+        with db(**dbConfig) as DB:
+            row = DB.connection.execute(sqlalchemy.text("""
+                SELECT is_on
+                    , EXTRACT(EPOCH FROM seen_at) AS seen_at
+                FROM action.device_state
+                WHERE device_type = :device_type
+                    AND device_id = :device_id
+                """), {'device_type': device_type,
+                       'device_id': device_id}).fetchone()
+        if row is None:
+            return
+
+        key = (device_type, device_id)
+        with self._changed:
+            if float(row['seen_at']) > self._states.get(key, (None, 0))[1]:
+                self._states[key] = (row['is_on'], float(row['seen_at']))
+
+    def invalidate(self, device_type: str, device_id: str):
+        with self._changed:
+            self._states.pop((device_type, device_id), None)
+
+
+shadow = Device_Shadow(shadow_ttl)
+
+
 class Device_Base:
     device_type: str = None
 
@@ -129,16 +449,34 @@ class Device_Base:
         self.get_credentials()
 
     def get_credentials(self):
-        with open(devices_file, 'r') as f:
-            devices = json.load(f)
-        device = devices[self.device_type][self.device_id]
+        device = registry.devices[self.device_type][self.device_id]
         self.__dict__.update(device)
 
+    @property
+    def pushes_state(self) -> bool:
+        """Whether a running listener receives this device's state changes"""
+        return False
+
+    @property
+    def shadow_state(self) -> Optional[bool]:
+        """Recently confirmed on/off state, or None if not known
+
+        Other replicas may have switched the device since this process last
+        saw it, so unless its changes are pushed here the shared state is
+        read as well.
+        """
+        return shadow.get(self.device_type, self.device_id,
+                          shared=not self.pushes_state)
+
    # These methods need defining for each manufacturer
     def log_action(self, status):
         logger.info(
             f"Turning {self.device_type} device {self.device_id} {status}")
 
+    def log_no_op(self, status):
+        logger.info(
+            f"{self.device_type} device {self.device_id} is already {status}")
+
     def on(self):
         pass
 
@@ -154,22 +492,28 @@ class Sonoff(Device_Base):
 
     def __init__(self, device_id: str = None):
         super().__init__(device_id)
-        self.get_credentials()
 
-        self.sonoff_account = sonoff.Sonoff(self.username,
-                                            self.password,
-                                            self.api_region)
+        self.sonoff_account, self.account_lock = registry.sonoff_account(
+            self.username, self.password, self.api_region)
 
     @property
     def status(self):
-        device = self.sonoff_account.get_device(item.device_id)
-        return device['params']['switch']
+        with self.account_lock:
+            device = self.sonoff_account.get_device(self.device_id)
+        status = device['params']['switch']
+        shadow.update(self.device_type, self.device_id, status == 'on')
+        return status
 
     def turn(self, status: str):
         assert status in ['on', 'off']
 
+        if self.shadow_state == (status == 'on'):
+            self.log_no_op(status)
+            return
+
         self.log_action(status)
-        self.sonoff_account.switch(status, self.device_id)
+        with self.account_lock:
+            self.sonoff_account.switch(status, self.device_id)
         assert self.status == status
 
     def on(self):
@@ -179,7 +523,11 @@ class Sonoff(Device_Base):
         self.turn('off')
 
     def toggle(self):
-        if self.status == 'on':
+        is_on = self.shadow_state
+        if is_on is None:
+            is_on = self.status == 'on'
+
+        if is_on:
             self.off()
         else:
             self.on()
@@ -188,27 +536,56 @@ class Sonoff(Device_Base):
 class Shelly(Device_Base):
     device_type = 'Shelly'
 
+    def __init__(self, device_id: str = None):
+        super().__init__(device_id)
+
+        self.session = registry.session(self.endpoint, self.username,
+                                        self.password)
+
+    @property
+    def pushes_state(self) -> bool:
+        return any(key in self.__dict__ for key in shadow.push_keys)
+
     @property
     def status(self):
-        r = requests.get(self.endpoint + 'relay/0',
-                         auth=(self.username, self.password))
-        return r.json()['ison']
+        if self.pushes_state and self.shadow_state is not None:
+            return self.shadow_state
+
+        r = self.session.get(self.endpoint + 'relay/0',
+                             timeout=request_timeout)
+        is_on = r.json()['ison']
+        shadow.update(self.device_type, self.device_id, is_on)
+        return is_on
 
     def turn(self, status: str):
         assert status in ['on', 'off', 'toggle']
 
-        statusStart = self.status
+        statusStart = self.shadow_state
+        if status != 'toggle' and statusStart == (status == 'on'):
+            self.log_no_op(status)
+            return {'ison': statusStart}
 
         self.log_action(status)
-        r = requests.post(self.endpoint + 'relay/0', data={'turn': status},
-                          auth=(self.username, self.password))
+        sent_at = time.time()
+        r = self.session.post(self.endpoint + 'relay/0',
+                              data={'turn': status}, timeout=request_timeout)
+
+        # The response holds the relay state after switching, so there is no
+        # need to read it back. If the device pushes its state, wait for it
+        # to confirm the change, falling back to the response. Devices
+        # without an id for a running listener never push, so don't wait.
+        relay = r.json()
+        if not (self.pushes_state and shadow.wait_for(
+                self.device_type, self.device_id, relay['ison'], sent_at,
+                push_timeout)):
+            shadow.update(self.device_type, self.device_id, relay['ison'])
 
         if status == 'toggle':
-            assert statusStart != self.status
+            assert statusStart is None or statusStart != relay['ison']
         else:
-            assert self.status == (status == 'on')
+            assert relay['ison'] == (status == 'on')
 
-        return r.json()
+        return relay
 
     def on(self):
         return self.turn('on')
@@ -223,70 +600,266 @@ class Shelly(Device_Base):
 class action:
     DB = db(**dbConfig)
 
+    # execute_todo is run both by the scheduler and by actionTimer, but shares
+    # one session
+    _execute_lock = threading.Lock()
+    # Held while an action is started or dispatch is cancelled, so no action
+    # starts once execute_todo has given up waiting for it
+    _start_lock = threading.Lock()
+
+    # Seconds between action_time and the action being dispatched, for the
+    # most recent actions
+    lateness = deque(maxlen=1000)
+
     Status = DB.lookup_table('status', 'action', index='status')
     Device_type = DB.lookup_table('device_type', 'action', index='id')
 
     def check_multi_action(self):
         """
         If multiple commands for single device at single time, cancel all but the most recent.
+
+        Only actions which are due are checked, using action_pending_idx.
         """
 
         self.DB.session.execute(f"""
             UPDATE action.action AS a
             SET status = {self.Status.Cancelled.value}
             FROM (
-                    SELECT *, ROW_NUMBER() OVER (PARTITION BY action_time, device_id ORDER BY created_at DESC) AS rn
+                    SELECT action_id, ROW_NUMBER() OVER (PARTITION BY action_time, device_id ORDER BY created_at DESC) AS rn
                     FROM action.action
                     WHERE status IS NULL
+                        AND actioned_at IS NULL
+                        AND action_time <= CURRENT_TIMESTAMP
                 ) AS a2
             WHERE a2.rn != 1
                 AND a.action_id = a2.action_id
+                -- leave actions another worker is carrying out
+                AND (a.lease_expires_at IS NULL
+                     OR a.lease_expires_at < CURRENT_TIMESTAMP)
             """)
         self.DB.session.commit()
 
-    @property
-    def actions(self) -> pd.DataFrame:
-        return pd.read_sql("""
-            SELECT action_id
-                , action_time
-                , device_type
-                , device_id
-                , action
-                , status
-            FROM action.action
-            WHERE actioned_at IS NULL
-                AND action_time <= CURRENT_TIMESTAMP
-                AND status IS NULL
-            ORDER BY action_time DESC
-        """, self.DB.connection)
-
-    def create_device(self, device_type: int):
+    def claim_actions(self) -> pd.DataFrame:
+        """Lease a batch of due actions to this worker
+
+        Devices with actions leased to another worker are skipped, so no
+        device is switched by two workers at once. Leases only show once
+        committed, so each device is first locked for the transaction with
+        an advisory lock, and devices another worker is claiming are
+        skipped. Actions whose lease expires without a status being set
+        (e.g. the worker died) become claimable again.
+        """
+        due = """
+            p.status IS NULL
+            AND p.actioned_at IS NULL
+            AND p.action_time <= CURRENT_TIMESTAMP
+            AND (p.lease_expires_at IS NULL
+                 OR p.lease_expires_at < CURRENT_TIMESTAMP)
+            """
+        devices = [row['device_id'] for row in self.DB.session.execute(
+            sqlalchemy.text(f"""
+                SELECT device_id
+                FROM (
+                        SELECT DISTINCT device_id
+                        FROM action.action AS p
+                        WHERE {due}
+                    ) AS d
+                WHERE pg_try_advisory_xact_lock(hashtext('action.action'),
+                                                hashtext(device_id))
+                """))]
+        if len(devices) == 0:
+            self.DB.session.commit()
+            return pd.DataFrame(columns=['action_id', 'action_time',
+                                         'device_type', 'device_id',
+                                         'action'])
+
+        # A new statement, so leases committed by other workers before the
+        # locks were taken are seen
+        result = self.DB.session.execute(sqlalchemy.text(f"""
+            UPDATE action.action AS a
+            SET claimed_by = :worker_id
+                , lease_expires_at = CURRENT_TIMESTAMP
+                    + make_interval(secs => :lease_seconds)
+            FROM (
+                    SELECT action_id
+                    FROM action.action AS p
+                    WHERE {due}
+                        AND p.device_id = ANY(:devices)
+                        AND NOT EXISTS (
+                            SELECT 1
+                            FROM action.action AS o
+                            WHERE o.device_id = p.device_id
+                                AND o.status IS NULL
+                                AND o.actioned_at IS NULL
+                                AND o.claimed_by != :worker_id
+                                AND o.lease_expires_at >= CURRENT_TIMESTAMP
+                        )
+                    ORDER BY p.action_time
+                    LIMIT :batch_size
+                    FOR UPDATE SKIP LOCKED
+                ) AS c
+            WHERE a.action_id = c.action_id
+            RETURNING a.action_id
+                , a.action_time
+                , a.device_type
+                , a.device_id
+                , a.action
+            """), {'worker_id': worker_id, 'lease_seconds': lease_seconds,
+                   'batch_size': claim_batch_size, 'devices': devices})
+        claimed = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+        # Releases the device locks
+        self.DB.session.commit()
+
+        return claimed.sort_values('action_time')
+
+    def create_device(self, device_type: int, device_id: str) -> Device_Base:
+        """Device client from the registry, created on first use"""
         device_type = self.Device_type(device_type)
 
         if device_type == self.Device_type.Sonoff:
-            return Sonoff
+            return registry.get_device(Sonoff, device_id)
         elif device_type == self.Device_type.Shelly:
-            return Shelly
+            return registry.get_device(Shelly, device_id)
 
-    def execute_todo(self):
-        logger.info('Running Action().excute_todo()')
+    def run_device_actions(self, actions: pd.DataFrame,
+                           cancelled: Optional[threading.Event] = None,
+                           progress: Optional[Dict[int, Optional[int]]] = None
+                           ) -> List[Tuple[int, int]]:
+        """Carry out one device's actions in order
 
-        self.check_multi_action()
+        Args:
+            actions (pd.DataFrame): The device's claimed actions
+            cancelled (threading.Event, optional): Once set, no more actions are started
+            progress (Dict[int, Optional[int]], optional): Filled in with the status by action_id as each action finishes, None while it runs
 
-        for idx, item in self.actions.iterrows():
+        Returns:
+            List[Tuple[int, int]]: action_id and status of each action carried out
+        """
+        progress = progress if progress is not None else {}
+        for item in actions.itertuples():
+            with self._start_lock:
+                if cancelled is not None and cancelled.is_set():
+                    break
+                progress[item.action_id] = None
             try:
-                device = self.create_device(item.device_type)(item.device_id)
+                device = self.create_device(item.device_type, item.device_id)
 
                 getattr(device, item.action)()
 
-                item.status = self.Status.Success.value
+                status = self.Status.Success.value
             except:
-                item.status = self.Status.Failed.value
-
-            self.DB.session.execute(f"""
-                    UPDATE action.action
-                    SET actioned_at = CURRENT_TIMESTAMP
-                        , status = {item.status}
-                    WHERE action_id = {item.action_id}
-                """)
-            self.DB.session.commit()
+                status = self.Status.Failed.value
+            progress[item.action_id] = status
+        return [(action_id, status) for action_id, status in progress.items()
+                if status is not None]
+
+    @classmethod
+    def lateness_summary(cls) -> Dict[str, float]:
+        """How late recent actions were dispatched, in seconds"""
+        lateness = list(cls.lateness)
+        if len(lateness) == 0:
+            return {'count': 0}
+        return {'count': len(lateness),
+                'mean': sum(lateness) / len(lateness),
+                'max': max(lateness)}
+
+    def execute_todo(self):
+        with self._execute_lock:
+            self._execute_todo()
+
+    def _execute_todo(self):
+        logger.info('Running Action().excute_todo()')
+
+        self.check_multi_action()
+
+        actions = self.claim_actions()
+        if len(actions) == 0:
+            return
+
+        now = pd.Timestamp.now(tz='UTC')
+        lateness = (now - pd.to_datetime(actions['action_time'], utc=True)
+                    ).dt.total_seconds()
+        self.lateness.extend(lateness)
+        logger.info(f'Dispatching {len(actions)} actions, '
+                    f'up to {lateness.max():.1f}s after action_time')
+
+        # One task per device so that each device's actions stay in order,
+        # while different devices are switched at the same time
+        devices = [device_actions for _, device_actions in actions.groupby(
+            ['device_type', 'device_id'], sort=False, dropna=False)]
+
+        results, unstarted = [], []
+        cancelled = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=min(max_workers, len(devices)))
+        try:
+            tasks = {}
+            for device_actions in devices:
+                progress = {}
+                task = pool.submit(self.run_device_actions, device_actions,
+                                   cancelled, progress)
+                tasks[task] = (device_actions, progress)
+            done, not_done = wait(tasks, timeout=dispatch_timeout)
+            # Devices still running don't start any more actions
+            with self._start_lock:
+                cancelled.set()
+
+            for task in done:
+                results += task.result()
+            for task in not_done:
+                device_actions, progress = tasks[task]
+                progress = dict(progress)
+                results += [(action_id, status)
+                            for action_id, status in progress.items()
+                            if status is not None]
+                unstarted += [action_id for action_id
+                              in device_actions['action_id']
+                              if action_id not in progress]
+                # An action still running may yet switch the device, so it
+                # keeps its lease and is retried once the lease expires
+                running = [action_id for action_id, status
+                           in progress.items() if status is None]
+                if running:
+                    logger.warning(f'Action(s) {running} still running after '
+                                   f'{dispatch_timeout}s, retried after '
+                                   'their lease expires')
+        finally:
+            # Don't wait on devices which have hung
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        self.set_status(results)
+        self.release(unstarted)
+
+    def release(self, action_ids: List[int]):
+        """Return actions claimed by this worker to the queue, unactioned"""
+        if len(action_ids) == 0:
+            return
+
+        self.DB.session.execute(sqlalchemy.text("""
+                UPDATE action.action
+                SET claimed_by = NULL
+                    , lease_expires_at = NULL
+                WHERE action_id = ANY(:action_ids)
+                    AND claimed_by = :worker_id
+            """), {'action_ids': [int(action_id) for action_id in action_ids],
+                   'worker_id': worker_id})
+        self.DB.session.commit()
+
+    def set_status(self, results: List[Tuple[int, int]]):
+        """Record the outcome of actions in a single UPDATE and commit
+
+        Only actions still claimed by this worker are updated.
+        """
+        if len(results) == 0:
+            return
+
+        values = ', '.join(f'({int(action_id)}, {int(status)})'
+                           for action_id, status in results)
+        self.DB.session.execute(sqlalchemy.text(f"""
+                UPDATE action.action AS a
+                SET actioned_at = CURRENT_TIMESTAMP
+                    , status = v.status
+                FROM (VALUES {values}) AS v(action_id, status)
+                WHERE a.action_id = v.action_id
+                    AND a.claimed_by = :worker_id
+            """), {'worker_id': worker_id})
+        self.DB.session.commit()
@@ -0,0 +1,142 @@
+"""Fire actions at their action_time
+
+Upcoming rows of action.action are held in a heap ordered by action_time. A
+timer thread sleeps until the earliest is due and then runs
+action().execute_todo(), so actions fire on time rather than on the next
+5 minute poll.
+
+A second thread LISTENs for the action_inserted notification sent by the
+trigger on action.action, so newly written actions are added to the heap
+straight away. The periodic execute_todo job is kept as a safety net.
+
+How late actions fire compared with their action_time is recorded by
+action.execute_todo, see action.lateness_summary().
+"""
+
+import heapq
+import select
+import threading
+import time
+
+from action import action
+from config import dbConfig
+from db import db
+from logger import create_logger
+
+logger = create_logger('actionTimer')
+
+channel = 'action_inserted'
+
+
+class ActionTimer:
+    def __init__(self, executor: action, horizon_hours: float = 24,
+                 max_sleep: float = 60, min_interval: float = 1):
+        """
+        Args:
+            executor (action): Used to carry out actions when they are due
+            horizon_hours (float, optional): Only actions due within this many hours are loaded. Defaults to 24.
+            max_sleep (float, optional): Longest time in seconds the timer sleeps, and between reloads of upcoming actions in case a notification is missed. Defaults to 60.
+            min_interval (float, optional): Shortest time in seconds between runs, so a clock difference between this host and the database cannot cause a busy loop. Defaults to 1.
+        """
+        self.executor = executor
+        self.horizon_hours = horizon_hours
+        self.max_sleep = max_sleep
+        self.min_interval = min_interval
+
+        # (action_time as a unix timestamp, action_id)
+        self._heap = []
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def reload(self):
+        """Load pending actions due within the horizon into the heap"""
+        with db(**dbConfig) as DB:
+            upcoming = DB.connection.execute(f"""
+                SELECT action_id, EXTRACT(EPOCH FROM action_time) AS due
+                FROM action.action
+                WHERE status IS NULL
+                    AND actioned_at IS NULL
+                    AND action_time <= CURRENT_TIMESTAMP
+                        + INTERVAL '{self.horizon_hours} hours'
+                """).fetchall()
+
+        heap = [(float(row['due']), row['action_id']) for row in upcoming]
+        heapq.heapify(heap)
+
+        with self._changed:
+            self._heap = heap
+            self._changed.notify()
+
+    def _seconds_until_next(self) -> float:
+        if len(self._heap) == 0:
+            return self.max_sleep
+        return min(self._heap[0][0] - time.time(), self.max_sleep)
+
+    def _run_timer(self):
+        while not self._stop.is_set():
+            try:
+                with self._changed:
+                    wait = self._seconds_until_next()
+                    if wait > 0:
+                        # Woken early by reload() if the heap changes
+                        self._changed.wait(timeout=wait)
+                        continue
+
+                self.executor.execute_todo()
+                self.reload()
+            except Exception as e:
+                logger.error(f'Action timer failed: {e}')
+            self._stop.wait(self.min_interval)
+
+    def _run_listener(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning(f'Lost {channel} listener connection: {e}')
+                self._stop.wait(self.max_sleep)
+
+    def _listen(self):
+        with db(**dbConfig) as DB:
+            # A dedicated connection, outside the pool, in autocommit mode so
+            # notifications are delivered as they arrive
+            raw_connection = DB.engine.raw_connection()
+        raw_connection.detach()
+        connection = raw_connection.connection
+        try:
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f'LISTEN {channel}')
+
+            # Catch anything inserted before LISTEN took effect
+            self.reload()
+
+            while not self._stop.is_set():
+                if select.select([connection], [], [], self.max_sleep) \
+                        == ([], [], []):
+                    # Reload anyway in case a notification was missed
+                    self.reload()
+                    continue
+                connection.poll()
+                if connection.notifies:
+                    connection.notifies.clear()
+                    self.reload()
+        finally:
+            raw_connection.close()
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=target, daemon=True, name=name)
+            for target, name in [(self._run_timer, 'ActionTimer'),
+                                 (self._run_listener, 'ActionListener')]]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._changed:
+            self._changed.notify()
+        for thread in self._threads:
+            thread.join(timeout=self.max_sleep + 5)
@@ -0,0 +1,242 @@
+"""Backfill historical data for a date range
+
+    python backfill.py consumption exported tariff --from 2021-01-01 --to 2021-06-01
+
+The range is split into windows which are fetched concurrently by a bounded
+pool of workers. Requests to each API host are rate limited (see the
+backfill section of config.json). Each window is upserted as it arrives and
+checkpointed in backfill.checkpoint, so rerunning an interrupted backfill
+only fetches the windows that had not finished.
+"""
+
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Tuple
+
+import pandas as pd
+import sqlalchemy
+
+from config import dbConfig, electricalSupplier
+from db import db
+from logger import create_logger
+from microGeneration import Microgen, write_readings
+from openWeather import OpenWeather
+from supply import supplier
+from throttle import HostRateLimiter
+import octopus_tariff_app as octopus
+import rollups
+
+try:
+    from config import backfill as backfillConfig
+except ImportError:
+    backfillConfig = {}
+
+logger = create_logger('backfill')
+
+with db(**dbConfig) as DB:
+    DB.create_schema('backfill')
+
+    DB.session.execute("""
+        CREATE TABLE IF NOT EXISTS backfill.checkpoint (
+            job VARCHAR(50)
+            , window_start TIMESTAMP WITH TIME ZONE
+            , window_end TIMESTAMP WITH TIME ZONE
+            , rows INT
+            , completed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            , PRIMARY KEY (job, window_start, window_end)
+        )
+        """)
+    DB.session.commit()
+
+# Requests per second, by host
+limiter = HostRateLimiter(backfillConfig.get('rate_per_host', {}),
+                          backfillConfig.get('default_rate', 1))
+
+Window = Tuple[pd.Timestamp, pd.Timestamp]
+
+
+def windows(start: pd.Timestamp, end: pd.Timestamp, days: float
+            ) -> List[Window]:
+    """Split start to end into consecutive windows of up to days long"""
+    bounds = list(pd.date_range(start, end, freq=pd.Timedelta(days=days)))
+    if bounds[-1] < end:
+        bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def completed(job: str) -> set:
+    """Windows of job already checkpointed"""
+    with db(**dbConfig) as DB:
+        done = DB.connection.execute(sqlalchemy.text("""
+            SELECT window_start, window_end
+            FROM backfill.checkpoint
+            WHERE job = :job
+            """), {'job': job}).fetchall()
+    return {(pd.Timestamp(row['window_start']), pd.Timestamp(row['window_end']))
+            for row in done}
+
+
+def checkpoint(job: str, window: Window, rows: int):
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(sqlalchemy.text("""
+                INSERT INTO backfill.checkpoint (
+                    job, window_start, window_end, rows)
+                VALUES (:job, :window_start, :window_end, :rows)
+                ON CONFLICT (job, window_start, window_end) DO UPDATE
+                SET rows = EXCLUDED.rows
+                    , completed_at = CURRENT_TIMESTAMP
+                """), {'job': job, 'window_start': window[0],
+                       'window_end': window[1], 'rows': rows})
+
+
+def _write(df: pd.DataFrame, tableName: str, schema: str,
+           upsert_keys: List[str]) -> int:
+    if df is None or len(df) == 0:
+        return 0
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(df, tableName, schema=schema,
+                              upsert_keys=upsert_keys, upsert_update=True)
+    return len(df)
+
+
+def _usage(tableName: str, fetch: Callable) -> Callable[[Window], int]:
+    def run(window: Window) -> int:
+        return sum(_write(page, tableName, 'supply', ['interval_start'])
+                   for page in fetch(period_from=window[0],
+                                     period_to=window[1],
+                                     rate_limiter=limiter))
+    return run
+
+
+def _tariff(window: Window) -> int:
+    tariff = octopus.get_tariff(electricalSupplier['productRef'],
+                                period_from=window[0], period_to=window[1],
+                                rate_limiter=limiter)
+    if tariff is None:
+        # get_tariff returns None when the API could not be reached. Raise,
+        # so the window is not checkpointed and is retried on the next run.
+        raise ConnectionError('Unable to fetch tariff')
+    return _write(tariff, 'tariff', 'supply', ['valid_from'])
+
+
+# OpenWeather only serves the last 5 days of history
+weather_history_days = 5
+
+
+def _weather(window: Window) -> int:
+    oldest = pd.Timestamp.now(tz='UTC') - pd.Timedelta(
+        days=weather_history_days)
+    days = pd.date_range(window[0], window[1], freq='D')[:-1]
+    if len(days) > 0 and days[0] < oldest:
+        # Skipped rather than failed, so the window is checkpointed instead
+        # of failing on every run
+        logger.warning(f'Weather history is only available for the last '
+                       f'{weather_history_days} days, skipping '
+                       f'{days[0]} to {min(days[-1], oldest)}')
+    rows = 0
+    for day in days[days >= oldest]:
+        limiter.acquire('https://api.openweathermap.org')
+        rows += _write(OpenWeather.getHistory(day.to_pydatetime()),
+                       'history', 'weather', ['dt'])
+    return rows
+
+
+def _solar(microgen: Microgen) -> Callable[[Window], int]:
+    def run(window: Window) -> int:
+        rows = 0
+        for idx, tech in microgen.technologies.iterrows():
+            limiter.acquire(tech.object.config['API_URL'])
+            history = tech.object.getHistory(window[0], window[1])
+            if len(history) > 0:
+                write_readings(history, tech.object.techId)
+                rows += len(history)
+        return rows
+    return run
+
+
+# Rollup source written by each job, see rollups.py
+rollup_sources = {'consumption': 'consumption',
+                  'exported': 'exported',
+                  'solar': 'generation'}
+
+
+def fetcher(job: str) -> Callable[[Window], int]:
+    """Fetch and write function for job, taking a window
+
+    Clients are created here, once per run rather than once per window.
+    """
+    if job == 'consumption':
+        return _usage('consumption', supplier().iter_usage)
+    if job == 'exported':
+        return _usage('exported', supplier().iter_export)
+    if job == 'solar':
+        return _solar(Microgen())
+    return {'tariff': _tariff, 'weather': _weather}[job]
+
+
+def run(job: str, start: pd.Timestamp, end: pd.Timestamp,
+        window_days: float = backfillConfig.get('window_days', 7),
+        workers: int = backfillConfig.get('workers', 4)) -> int:
+    """Backfill job from start to end, skipping completed windows
+
+    Returns:
+        int: Number of rows written
+    """
+    fetch = fetcher(job)
+    done = completed(job)
+    todo = [window for window in windows(start, end, window_days)
+            if window not in done]
+    logger.info(f'Backfilling {job}: {len(todo)} windows to fetch, '
+                f'{len(done)} already done')
+
+    rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, window): window for window in todo}
+        for future in as_completed(futures):
+            window = futures[future]
+            try:
+                window_rows = future.result()
+            except Exception as e:
+                # Not checkpointed, so retried on the next run
+                logger.error(f'Backfill of {job} failed for '
+                             f'{window[0]} to {window[1]}: {e}')
+                continue
+            checkpoint(job, window, window_rows)
+            rows += window_rows
+            if job in rollup_sources and window_rows > 0:
+                # Backfilled data is usually behind the rollups' high-water
+                # mark
+                rollups.mark_stale(rollup_sources[job], *window)
+
+    if job in rollup_sources:
+        rollups.after_write(rollup_sources[job])
+    return rows
+
+
+def _timestamp(value: str) -> pd.Timestamp:
+    time = pd.Timestamp(value)
+    if time.tzinfo is None:
+        time = time.tz_localize('Europe/London')
+    return time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('jobs', nargs='+', choices=[
+        'consumption', 'exported', 'tariff', 'weather', 'solar'])
+    parser.add_argument('--from', dest='start', type=_timestamp,
+                        required=True)
+    parser.add_argument('--to', dest='end', type=_timestamp,
+                        default=pd.Timestamp(datetime.datetime.now()
+                                             ).tz_localize('Europe/London'))
+    parser.add_argument('--window-days', type=float,
+                        default=backfillConfig.get('window_days', 7))
+    parser.add_argument('--workers', type=int,
+                        default=backfillConfig.get('workers', 4))
+    args = parser.parse_args()
+
+    for job in args.jobs:
+        rows = run(job, args.start, args.end, args.window_days, args.workers)
+        logger.info(f'Backfilled {rows} rows for {job}')
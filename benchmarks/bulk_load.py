@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Compare db.dataframe_to_table load speed with and without COPY
+
+Writes synthetic half-hourly consumption frames to a scratch schema on the
+database in config.json, once through the PostgreSQL COPY path and once
+through DataFrame.to_sql, and prints rows per second for each.
+
+Usage:
+    python benchmarks/bulk_load.py [n_rows ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from config import dbConfig  # noqa: E402
+from db import db  # noqa: E402
+
+schema = 'benchmark'
+default_sizes = [1000, 100000, 1000000]
+
+
+def make_frame(n: int) -> pd.DataFrame:
+    interval_start = pd.date_range('2020-01-01', periods=n, freq='30min',
+                                   tz='Europe/London')
+    return pd.DataFrame({
+        'consumption': np.random.rand(n),
+        'interval_start': interval_start,
+        'interval_end': interval_start + pd.Timedelta('30min'),
+    })
+
+
+def rows_per_second(df: pd.DataFrame, use_copy: bool) -> float:
+    tableName = f"bulk_load_{'copy' if use_copy else 'to_sql'}"
+
+    with db(**dbConfig) as DB:
+        DB.create_schema(schema)
+        DB.session.execute(f'DROP TABLE IF EXISTS {schema}.{tableName}')
+        DB.session.commit()
+
+        start = time.perf_counter()
+        DB.dataframe_to_table(df, tableName, schema=schema,
+                              use_copy=use_copy)
+        elapsed = time.perf_counter() - start
+
+        DB.session.execute(f'DROP TABLE {schema}.{tableName}')
+        DB.session.commit()
+
+    return len(df) / elapsed
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or default_sizes
+
+    print(f"{'rows':>10} {'to_sql rows/s':>15} {'COPY rows/s':>15} {'speed up':>9}")
+    for n in sizes:
+        df = make_frame(n)
+        to_sql = rows_per_second(df, use_copy=False)
+        copy = rows_per_second(df, use_copy=True)
+        print(f'{n:>10} {to_sql:>15,.0f} {copy:>15,.0f} {copy / to_sql:>8.1f}x')
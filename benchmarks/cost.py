@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Time cost.calculate over years of half hourly data
+
+Costs synthetic consumption, export and solar generation against an Agile
+style tariff (a new rate every half hour) and prints the time taken.
+Nothing is read from or written to the database.
+
+Usage:
+    python benchmarks/cost.py [days ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cost import calculate  # noqa: E402
+
+default_sizes = [1, 30, 365, 3 * 365]
+repeats = 5
+
+
+def make_data(days: int):
+    rng = np.random.default_rng(0)
+    starts = pd.date_range('2021-01-01', periods=days * 48, freq='30min',
+                           tz='UTC')
+    usage = {name: pd.DataFrame({
+        'interval_start': starts,
+        'interval_end': starts + pd.Timedelta('30min'),
+        'consumption': rng.uniform(0, 1.5, len(starts))})
+        for name in ['consumption', 'exported']}
+    tariff = pd.DataFrame({'valid_from': starts,
+                           'valid_to': starts + pd.Timedelta('30min'),
+                           'value_inc_vat': rng.uniform(-5, 35, len(starts))})
+    # A cumulative generation counter sampled every 5 minutes
+    ts = pd.date_range(starts[0], periods=days * 288, freq='5min', tz='UTC')
+    readings = pd.DataFrame({'tech_id': 1, 'ts': ts,
+                             'value': np.cumsum(rng.uniform(0, 0.2, len(ts)))})
+    return usage['consumption'], usage['exported'], tariff, readings
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or default_sizes
+
+    print(f"{'days':>8} {'intervals':>10} {'ms':>8}")
+    for days in sizes:
+        consumption, exported, tariff, readings = make_data(days)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            costs = calculate(consumption, exported, tariff, readings,
+                              export_rate=15)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f'{days:>8} {len(costs):>10} {elapsed * 1000:>8.2f}')
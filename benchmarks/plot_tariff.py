@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Time octopus_tariff_app.plot_tariff in each render mode
+
+Renders a synthetic day of half-hourly prices in full and lite mode, each
+from an empty render cache and again once cached, and prints the time
+taken. Plots are written to a temporary directory.
+
+Usage:
+    python benchmarks/plot_tariff.py [repeats]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import octopus_tariff_app as octopus  # noqa: E402
+
+default_repeats = 5
+
+
+def make_tariff(n_slots: int = 48) -> pd.DataFrame:
+    valid_from = pd.date_range('2021-01-01 23:00', periods=n_slots,
+                               freq='30min', tz='Europe/London')
+    price = np.random.uniform(-5, 15, n_slots)
+    # A peak, so there are big steps to label
+    price[32:38] = 35
+    return pd.DataFrame({'valid_from': valid_from,
+                         'valid_to': valid_from + pd.Timedelta('30min'),
+                         'value_inc_vat': price})
+
+
+def seconds_to_plot(tariff: pd.DataFrame, mode: str, directory: str) -> float:
+    start = time.perf_counter()
+    octopus.plot_tariff(tariff, 'valid_from', 'valid_to', 'value_inc_vat',
+                        saveTo=os.path.join(directory, f'{mode}.png'),
+                        mode=mode)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else default_repeats
+
+    print(f"{'mode':>6} {'render s':>10} {'cached s':>10}")
+    for mode in ['full', 'lite']:
+        render, cached = [], []
+        for _ in range(repeats):
+            tariff = make_tariff()
+            with tempfile.TemporaryDirectory() as directory:
+                octopus.plot_cache_directory = os.path.join(directory,
+                                                            'cache')
+                render.append(seconds_to_plot(tariff, mode, directory))
+                cached.append(seconds_to_plot(tariff, mode, directory))
+        print(f'{mode:>6} {np.median(render):>10.3f} '
+              f'{np.median(cached):>10.4f}')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Time tariff_scheduler.schedule for a day of slots and many devices
+
+Schedules synthetic devices, with a mix of contiguous, minimum run length
+and deadline constraints under a household power cap, into a random
+48 slot tariff and prints the time taken. Nothing is written to the
+database.
+
+Usage:
+    python benchmarks/tariff_scheduler.py [n_devices ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tariff_scheduler import Schedulable, schedule  # noqa: E402
+
+default_sizes = [1, 10, 50]
+repeats = 20
+
+
+def make_tariff(n_slots: int = 48) -> pd.DataFrame:
+    valid_from = pd.date_range('2021-01-01', periods=n_slots, freq='30min',
+                               tz='Europe/London')
+    return pd.DataFrame({'valid_from': valid_from,
+                         'valid_to': valid_from + pd.Timedelta('30min'),
+                         'value_inc_vat': np.random.uniform(-5, 35, n_slots)})
+
+
+def make_devices(n: int, tariff: pd.DataFrame) -> list:
+    rng = np.random.default_rng(0)
+    return [Schedulable(f'device_{i}',
+                        energy_kwh=rng.uniform(0.5, 6),
+                        power_kw=rng.uniform(0.5, 3),
+                        deadline=tariff['valid_to'].iloc[rng.integers(24, 48)],
+                        min_run=int(rng.integers(1, 4)),
+                        contiguous=bool(i % 3 == 0))
+            for i in range(n)]
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or default_sizes
+    tariff = make_tariff()
+
+    print(f"{'devices':>8} {'ms':>8} {'actions':>8}")
+    for n in sizes:
+        devices = make_devices(n, tariff)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            actions = schedule(tariff, devices, power_cap_kw=n * 1.5)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f'{n:>8} {elapsed * 1000:>8.2f} {len(actions):>8}')
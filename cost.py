@@ -0,0 +1,286 @@
+"""What each half hour of electricity cost
+
+Joins supply.consumption and supply.exported to the unit rates in
+supply.tariff, and to solar generation from microgen.readings, to give per
+interval:
+* import_cost: consumption at the unit rate in force at interval_start
+* export_revenue: export at export_rate (electricalSupplier['export_rate']
+  in config.json, p/kWh, as export rates are not fetched from the supplier)
+* self_consumed_value: generation that was not exported, at the unit rate,
+  i.e. what it would have cost to import it
+* net_cost: import_cost - export_revenue
+
+Rates are matched to intervals with np.searchsorted over the tariff's
+valid_from, so a year of half hours is costed in one vectorised pass.
+update() stores the result in supply.cost, only costing intervals from the
+earliest one not yet costed, and push_summary() sends a day's totals from
+the rollups (see rollups.py).
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from config import dbConfig, electricalSupplier
+from db import db
+from logger import create_logger
+import notifications
+import rollups
+
+logger = create_logger('cost')
+
+export_rate = electricalSupplier.get('export_rate', 0)
+# Cumulative generation in kWh, see Solar.getRealTimeData
+generation_metric = electricalSupplier.get('generation_metric', 'yieldtotal')
+
+
+def _ns(times: pd.Series) -> np.ndarray:
+    """Times as int64 nanoseconds since the epoch (UTC)"""
+    return times.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def unit_rates(interval_start: pd.Series, tariff: pd.DataFrame,
+               price: str = 'value_inc_vat') -> np.ndarray:
+    """Unit rate in force at each interval_start, nan where there is none"""
+    if len(tariff) == 0:
+        return np.full(len(interval_start), np.nan)
+    tariff = tariff.sort_values('valid_from')
+    valid_from = _ns(tariff['valid_from'])
+    # Open ended rates have no valid_to
+    valid_to = np.where(tariff['valid_to'].isna(), np.iinfo(np.int64).max,
+                        _ns(tariff['valid_to'].fillna(tariff['valid_from'])))
+    starts = _ns(interval_start)
+
+    i = np.searchsorted(valid_from, starts, side='right') - 1
+    found = (i >= 0) & (starts < valid_to[np.clip(i, 0, None)])
+    return np.where(found, tariff[price].to_numpy(dtype=float)[
+        np.clip(i, 0, None)], np.nan)
+
+
+def half_hourly_generation(readings: pd.DataFrame,
+                           interval_start: pd.Series) -> np.ndarray:
+    """kWh generated in each half hour from interval_start
+
+    Args:
+        readings (pd.DataFrame): tech_id, ts and value of a cumulative kWh metric
+        interval_start (pd.Series): Start of each half hour, ascending
+
+    Returns:
+        np.ndarray: Total generation across all technologies
+    """
+    starts = _ns(interval_start)
+    bounds = np.append(starts, starts[-1] + pd.Timedelta('30min').value) \
+        if len(starts) else starts
+    generation = np.zeros(len(starts))
+
+    for tech_id, tech in readings.sort_values('ts').groupby('tech_id'):
+        # The counter's value at each half hour boundary. Counter resets
+        # (e.g. daily totals) give negative differences, counted as zero.
+        counter = np.interp(bounds, _ns(tech['ts']).astype(float),
+                            tech['value'].to_numpy(dtype=float))
+        generation += np.clip(np.diff(counter), 0, None)
+    return generation
+
+
+def calculate(consumption: pd.DataFrame, exported: pd.DataFrame,
+              tariff: pd.DataFrame,
+              readings: Optional[pd.DataFrame] = None,
+              export_rate: float = export_rate) -> pd.DataFrame:
+    """Cost of each interval
+
+    Args:
+        consumption (pd.DataFrame): interval_start, interval_end and consumption (kWh)
+        exported (pd.DataFrame): As consumption, for export
+        tariff (pd.DataFrame): valid_from, valid_to and value_inc_vat (p/kWh)
+        readings (pd.DataFrame, optional): tech_id, ts and value of cumulative generation (kWh). Self consumption is not valued without it.
+        export_rate (float, optional): Export rate in p/kWh
+
+    Returns:
+        pd.DataFrame: One row per interval, see the module docstring for fields
+    """
+    costs = pd.merge(
+        consumption[['interval_start', 'interval_end', 'consumption']],
+        exported[['interval_start', 'interval_end', 'consumption']].rename(
+            columns={'consumption': 'exported'}),
+        on=['interval_start', 'interval_end'], how='outer'
+    ).sort_values('interval_start', ignore_index=True)
+    costs[['consumption', 'exported']] = \
+        costs[['consumption', 'exported']].fillna(0)
+
+    costs['unit_rate'] = unit_rates(costs['interval_start'], tariff)
+    costs['import_cost'] = costs['consumption'] * costs['unit_rate']
+    costs['export_rate'] = export_rate
+    costs['export_revenue'] = costs['exported'] * export_rate
+
+    if readings is not None and len(readings) > 0:
+        costs['generation'] = half_hourly_generation(
+            readings, costs['interval_start'])
+        costs['self_consumed'] = np.clip(
+            costs['generation'] - costs['exported'], 0, None)
+    else:
+        costs['generation'] = np.nan
+        costs['self_consumed'] = np.nan
+    costs['self_consumed_value'] = costs['self_consumed'] * costs['unit_rate']
+
+    costs['net_cost'] = costs['import_cost'] - costs['export_revenue']
+    return costs
+
+
+def _read(DB: db, tableName: str, sql: str, params: dict) -> pd.DataFrame:
+    schema, table = tableName.split('.')
+    if not DB.table_exists(table, schema):
+        return pd.DataFrame(columns=['interval_start', 'interval_end',
+                                     'consumption'])
+    return pd.read_sql(sqlalchemy.text(sql), DB.connection, params=params)
+
+
+def load(start: pd.Timestamp, end: Optional[pd.Timestamp] = None
+         ) -> pd.DataFrame:
+    """Cost of every interval from start to end (None for no end)"""
+    params = {'start': start,
+              'end': end if end is not None else rollups.end_of_time}
+
+    with db(**dbConfig) as DB:
+        usage = {tableName: _read(DB, tableName, f"""
+            SELECT interval_start, interval_end, consumption
+            FROM {tableName}
+            WHERE interval_start >= :start
+                AND interval_start < :end
+            """, params) for tableName in ['supply.consumption',
+                                           'supply.exported']}
+        tariff = _read(DB, 'supply.tariff', """
+            SELECT valid_from, valid_to, value_inc_vat
+            FROM supply.tariff
+            WHERE (valid_to IS NULL OR valid_to > :start)
+                AND valid_from < :end
+            """, params)
+        # From an hour before, so there is a counter value at start
+        readings = _read(DB, 'microgen.readings', """
+            SELECT r.tech_id, r.ts, r.value
+            FROM microgen.readings r
+            JOIN microgen.metrics m
+                ON m.id = r.metric_id
+            WHERE m.name = :metric
+                AND r.ts >= CAST(:start AS TIMESTAMP WITH TIME ZONE)
+                    - INTERVAL '1 hour'
+                AND r.ts < CAST(:end AS TIMESTAMP WITH TIME ZONE)
+                    + INTERVAL '1 hour'
+            """, {**params, 'metric': generation_metric})
+
+    return calculate(usage['supply.consumption'], usage['supply.exported'],
+                     tariff, readings)
+
+
+def resume_from(DB: db) -> Optional[pd.Timestamp]:
+    """Start of the earliest interval update() needs to cost
+
+    That is the earliest of:
+    * intervals of consumption or export with no row in supply.cost
+    * intervals costed without a unit rate, for which there now is one
+      (e.g. the tariff has since been backfilled)
+    * the latest interval costed, in case its consumption has been revised
+
+    Returns:
+        pd.Timestamp: None if supply.cost does not exist yet, so everything needs costing
+    """
+    if not DB.table_exists('cost', 'supply'):
+        return None
+
+    usage = [f'SELECT interval_start FROM supply.{table}'
+             for table in ['consumption', 'exported']
+             if DB.table_exists(table, 'supply')]
+    todo = ['SELECT MAX(interval_start) AS interval_start FROM supply.cost']
+    if usage:
+        todo.append(f"""
+            SELECT u.interval_start
+            FROM ({' UNION '.join(usage)}) u
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM supply.cost c
+                WHERE c.interval_start = u.interval_start)
+            """)
+    if DB.table_exists('tariff', 'supply'):
+        todo.append("""
+            SELECT c.interval_start
+            FROM supply.cost c
+            WHERE c.unit_rate IS NULL
+                AND EXISTS (
+                    SELECT 1
+                    FROM supply.tariff t
+                    WHERE t.valid_from <= c.interval_start
+                        AND (t.valid_to IS NULL
+                             OR t.valid_to > c.interval_start))
+            """)
+
+    return DB.connection.execute(f"""
+        SELECT MIN(interval_start)
+        FROM ({' UNION ALL '.join(todo)}) todo
+        """).scalar()
+
+
+def update():
+    """Cost intervals not yet in supply.cost and store them
+
+    Intervals without a unit rate yet are stored with their export revenue
+    and no import cost, and costed again once there is a rate for them.
+    """
+    logger.info('Running cost.update()')
+
+    with db(**dbConfig) as DB:
+        start = resume_from(DB)
+
+    costs = load(start if start is not None else rollups.epoch)
+    if len(costs) == 0:
+        return
+
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(costs, 'cost', schema='supply',
+                              upsert_keys=['interval_start'],
+                              upsert_update=True)
+    # Costs may be revised from before the high-water mark, see resume_from
+    rollups.mark_stale('cost', costs['interval_start'].min(),
+                       costs['interval_end'].max())
+    rollups.after_write('cost')
+
+
+def summary(day: Optional[pd.Timestamp] = None) -> Optional[str]:
+    """A day's electricity use and cost, from the daily rollups
+
+    Args:
+        day (pd.Timestamp, optional): Midnight (Europe/London) at the start of the day. Defaults to yesterday.
+
+    Returns:
+        str: None if there is no data for the day
+    """
+    if day is None:
+        day = pd.Timestamp.now(tz=rollups.timezone).normalize() \
+            - pd.DateOffset(days=1)
+    end = day + pd.DateOffset(days=1)
+
+    totals = {}
+    for source in ['consumption', 'exported', 'cost']:
+        daily = rollups.query(source, 'daily', day, end)
+        totals.update({series or source: total for series, total
+                       in daily.groupby('series')['sum'].sum().items()})
+    if len(totals) == 0:
+        return None
+
+    lines = [f"Imported {totals.get('consumption', 0):.1f} kWh",
+             f"Exported {totals.get('exported', 0):.1f} kWh"]
+    if 'net_cost' in totals:
+        pounds = {series: totals.get(series, 0) / 100 for series in
+                  ['net_cost', 'import_cost', 'export_revenue']}
+        lines.append(f"Cost £{pounds['net_cost']:.2f} "
+                     f"(£{pounds['import_cost']:.2f} imported, "
+                     f"£{pounds['export_revenue']:.2f} exported)")
+    return '\n'.join(lines)
+
+
+def push_summary():
+    """Send yesterday's summary, if there is one"""
+    message = summary()
+    if message is not None:
+        notifications.enqueue(message, title='Electricity yesterday',
+                              category='summary')
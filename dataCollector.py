@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import atexit
+import signal
 import sys
 import time
 
@@ -7,9 +9,15 @@ import schedule
 
 import config
 from action import action
+from actionTimer import ActionTimer
+import cost
 from microGeneration import Microgen
+from microgenSampler import Sampler
+import notifications
+import partitions
 from octopus_tariff_app import immersion_on_during_cheapest_period, push_tariff
 from openWeather import OpenWeather
+from shellyListener import ShellyListener
 from supply import supplier
 from logger import logger
 
@@ -34,32 +42,55 @@ if len(sys.argv) > 1:
         action().execute_todo()
 
         logger.info('Testing Microgen module...')
-        Microgen().getRealTimeData()
+        Microgen().poll()
 
         logger.info('Tests complete')
 
 # Weather data
 schedule.every().day.at('02:30').do(OpenWeather.getFreshCut)
 
-# Micro generation
+# Micro generation, sampled every few seconds in the background and
+# written in batches
 microgen = Microgen()
-schedule.every(5).minutes.do(microgen.getRealTimeData)
+sampler = Sampler(microgen)
 
 # Smart Meter/Electricity supplier
 schedule.every().day.at('03:00').do(supplier().getFreshCut)
 
+# Yesterday's use and cost, once the supplier's data is in
+schedule.every().day.at('04:30').do(cost.push_summary)
+
 # Octopus tariff
 schedule.every().day.at('18:00').do(push_tariff)
 schedule.every().day.at('00:50').do(immersion_on_during_cheapest_period)
 
+# Partitions for the coming months and retention of old ones
+schedule.every().day.at('04:00').do(partitions.maintain)
+
 # Config History
 schedule.every(5).minutes.do(config.checkForUpdatedConfig)
 
-# Actions to be done
+# Actions to be done. ActionTimer fires actions at their action_time, the
+# 5 minute poll is a safety net in case it misses any.
 schedule.every(5).minutes.do(action().execute_todo)
+action_timer = ActionTimer(action())
+
+# Shelly state pushed over MQTT/CoIoT, if enabled in config
+shelly_listener = ShellyListener()
 
 
 if __name__ == '__main__':
+    # Push notifications are sent in the background
+    notifications.sender.start()
+    action_timer.start()
+    shelly_listener.start()
+    sampler.start()
+
+    # Write samples still in memory on the way out, including when stopped
+    # with SIGTERM (e.g. docker stop)
+    atexit.register(sampler.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     while True:  # infinite loop
         schedule.run_pending()
         time.sleep(15)
@@ -8,6 +8,9 @@ and not accidentally left open.
 """
 
 import enum
+import io
+import threading
+from collections import Counter
 from typing import List, Optional, Union, Dict, Tuple
 
 import pandas as pd
@@ -17,9 +20,114 @@ from sqlalchemy import orm
 
 Session = sqlalchemy.orm.sessionmaker()
 
+# Rows per COPY round trip. Bounds the memory used by the CSV buffer when
+# loading large frames.
+COPY_CHUNKSIZE = 100000
+
+# Engines (and hence their connection pools) are shared by every db instance
+# in the process. They are created lazily on first use and keyed by the
+# connection parameters, so db(**dbConfig) only checks a connection out of an
+# existing pool rather than opening a new one.
+_engines: Dict[Tuple, sqlalchemy.engine.Engine] = {}
+_engines_lock = threading.Lock()
+
+# (engine url, schema, table, key columns) of unique indexes known to exist
+_unique_indexes = set()
+
+# In-process cache of the database catalog, so that writes do not query
+# information_schema on every call. Schemas known to exist are held as
+# (engine url, schema) and tables as {(engine url, schema): {table: columns}}.
+_known_schemas = set()
+_catalog: Dict[Tuple[str, str], Dict[str, set]] = {}
+_catalog_lock = threading.Lock()
+_catalog_stats = Counter()
+
+# SQLSTATEs for undefined column, undefined table and invalid schema name.
+# A write failing with one of these means the cached catalog is stale.
+_STALE_CATALOG_ERRORS = {'42703', '42P01', '3F000'}
+
+
+class _WritePlan:
+    """Resolved column types and SQL for writing one frame shape to a table"""
+
+    def __init__(self, dtype: Dict[str, sqlalchemy.types.TypeEngine],
+                 ddl: Dict[str, str]):
+        self.dtype = dtype
+        self.ddl = ddl
+        self.columns = ', '.join(f'"{column}"' for column in dtype)
+        self.statements = {}
+
+    def statement(self, key: Tuple, build) -> str:
+        """SQL statement for key, built once with build() and then reused"""
+        if key not in self.statements:
+            self.statements[key] = build()
+        return self.statements[key]
+
+
+# Write plans keyed by (engine url, schema, table, columns, dtypes, explicit
+# dtype). See db._write_plan.
+_write_plans: Dict[Tuple, _WritePlan] = {}
+
+_pool_stats = Counter()
+_pool_stats_lock = threading.Lock()
+
+
+def _count_pool_event(event: str):
+    with _pool_stats_lock:
+        _pool_stats[event] += 1
+
+
+def _get_engine(engine_stmt: str, pool_size: int, max_overflow: int,
+                pool_pre_ping: bool, pool_recycle: int
+                ) -> sqlalchemy.engine.Engine:
+    key = (engine_stmt, pool_size, max_overflow, pool_pre_ping, pool_recycle)
+
+    with _engines_lock:
+        if key not in _engines:
+            engine = sqlalchemy.create_engine(
+                engine_stmt, pool_size=pool_size, max_overflow=max_overflow,
+                pool_pre_ping=pool_pre_ping, pool_recycle=pool_recycle)
+
+            # 'connect' fires only when a new DBAPI connection is opened,
+            # 'checkout' fires every time one is handed out by the pool
+            sqlalchemy.event.listen(
+                engine, 'connect', lambda *args: _count_pool_event('opened'))
+            sqlalchemy.event.listen(
+                engine, 'checkout',
+                lambda *args: _count_pool_event('checkouts'))
+
+            _engines[key] = engine
+        return _engines[key]
+
+
+def pool_stats() -> Dict[str, int]:
+    """Number of connections opened and reused across all pooled engines"""
+    with _pool_stats_lock:
+        opened = _pool_stats['opened']
+        checkouts = _pool_stats['checkouts']
+    return {'opened': opened, 'reused': checkouts - opened,
+            'checkouts': checkouts}
+
+
+def catalog_stats() -> Dict[str, int]:
+    """Hits and misses of the schema/table/column cache"""
+    with _catalog_lock:
+        return {'hits': _catalog_stats['hits'],
+                'misses': _catalog_stats['misses']}
+
+
+def dispose_engines():
+    """Close all pooled connections, e.g. at shutdown"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
 
 class db:
-    def __init__(self, server: str, database: str = None, username: str = None, password: str = None, port: int = None, dbType='tsql'):
+    def __init__(self, server: str, database: str = None, username: str = None, password: str = None, port: int = None, dbType='tsql',
+                 pool_size: int = 5, max_overflow: int = 10,
+                 pool_pre_ping: bool = True, pool_recycle: int = 3600):
         self.server = server
         self.database = database
         self.port = port
@@ -49,7 +157,8 @@ class db:
         # if self.username is None:
         #     engine_stmt += "?trusted_connection=yes"
 
-        self.engine = sqlalchemy.create_engine(engine_stmt)
+        self.engine = _get_engine(engine_stmt, pool_size, max_overflow,
+                                  pool_pre_ping, pool_recycle)
         self.connection = self.engine.connect()
 
         self.session = Session(bind=self.connection)
@@ -68,12 +177,12 @@ class db:
             self.create_schema(schema)
         return schema
 
-    # A connection should be closed when it is finished with as it can start to hog memory
+    # A connection should be closed when it is finished with so that it is
+    # returned to the pool. The engine itself is shared and left open.
 
     def close(self):
+        self.session.close()
         self.connection.close()
-        if hasattr(self, 'engine'):
-            self.engine.dispose()
 
     # __enter__ and __exit__ methods allow use to use db as a context manager
     # (i.e. it can be called with a with statement so that .close() is
@@ -86,8 +195,59 @@ class db:
         return self.close()
 
     def create_schema(self, schema: str):
+        cache_key = (str(self.engine.url), schema)
+        if cache_key in _known_schemas:
+            return
+
         self.session.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
         self.session.commit()
+        _known_schemas.add(cache_key)
+
+    def _schema_catalog(self, schema: str) -> Dict[str, set]:
+        """Tables in schema and their (lower case) columns
+
+        Loaded with a single query the first time a schema is used, then
+        served from the in-process cache.
+        """
+        cache_key = (str(self.engine.url), schema)
+        with _catalog_lock:
+            if cache_key in _catalog:
+                _catalog_stats['hits'] += 1
+                return _catalog[cache_key]
+            _catalog_stats['misses'] += 1
+
+        result = self.connection.execute(f"""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = '{schema}'
+            """)
+        tables = {}
+        for row in result:
+            tables.setdefault(row['table_name'], set()).add(
+                row['column_name'].lower())
+
+        with _catalog_lock:
+            return _catalog.setdefault(cache_key, tables)
+
+    def _catalog_add(self, tableName: str, schema: str, columns: List[str]):
+        tables = self._schema_catalog(schema)
+        with _catalog_lock:
+            tables.setdefault(tableName, set()).update(
+                column.lower() for column in columns)
+
+    def invalidate_catalog(self, schema: Optional[str] = None):
+        """Forget cached tables and columns for schema (or all schemas)"""
+        url = str(self.engine.url)
+        with _catalog_lock:
+            for cache_key in list(_catalog):
+                if cache_key[0] == url and schema in (None, cache_key[1]):
+                    del _catalog[cache_key]
+            for cache_key in list(_known_schemas):
+                if cache_key[0] == url and schema in (None, cache_key[1]):
+                    _known_schemas.discard(cache_key)
+            for cache_key in list(_unique_indexes):
+                if cache_key[0] == url and schema in (None, cache_key[1]):
+                    _unique_indexes.discard(cache_key)
 
     def create_scd_history(self, table: str, schema: Optional[str] = None):
         self.create_schema('history')
@@ -115,13 +275,7 @@ class db:
         """
         schema = self.schema_check(schema)
 
-        result = self.connection.execute(f"""
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema = '{schema}'
-                AND table_name = '{tableName}'
-            """)
-        return result.rowcount > 0
+        return tableName in self._schema_catalog(schema)
 
     def create_fields(self, fields: Union[List[str], str], tableName: str,
                       schema: Optional[str] = None,
@@ -149,16 +303,10 @@ class db:
         assert len(dtypes) == len(
             fields), f"One dtype ({len(dtypes)} supplied) must be supplied for each field ({len(fields)} supplied)"
 
-        sql = f"""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = '{tableName}'
-                AND table_schema = '{schema}'
-            """
-        result = self.connection.execute(sql)
-        assert result.rowcount > 0, f"Table {schema}.{tableName} does not exist"
+        tables = self._schema_catalog(schema)
+        assert tableName in tables, f"Table {schema}.{tableName} does not exist"
 
-        columns = [f['column_name'].lower() for f in result]
+        columns = tables[tableName]
 
         for field, dtype in zip(fields, dtypes):
             if field.lower() not in columns:
@@ -168,6 +316,7 @@ class db:
                     """
                 self.session.execute(sql)
                 self.session.commit()
+                self._catalog_add(tableName, schema, [field])
 
     def set_field_names_to_lower_case(self, df: Union[pd.DataFrame, dict]
                                       ) -> Union[pd.DataFrame, dict]:
@@ -180,17 +329,25 @@ class db:
     def dataframe_to_table(self, df: pd.DataFrame, tableName: str,
                            schema: Optional[str] = None,
                            dtype: Optional[Dict] = None,
-                           dedup: bool = False):
+                           dedup: bool = False,
+                           use_copy: bool = True,
+                           upsert_keys: Optional[List[str]] = None,
+                           upsert_update: bool = False):
         """Insert dataframe into SQL table
 
         This method is a wrapper script for pandas.DataFrame.to_sql which ensures all relevent fields are present in the SQL table. If not, the fields are created and set to NULL for all prior entries.
 
         Table and schema are created if they do not already exist.
 
+        On PostgreSQL the data is bulk loaded with COPY FROM STDIN (see _copy_dataframe), other dialects use a multi-row INSERT.
+
         Args:
             df (pd.DataFrame): pandas DataFrame containing data to be written
             tableName (str): name of table to be written to
             schema (str): name of schema to be written to
+            use_copy (bool): Use COPY on PostgreSQL. Defaults to True.
+            upsert_keys (list): Natural key of the table. If given, rows whose key already exists are skipped (or updated if upsert_update) instead of appended. A unique index on the key is created if needed. Replaces dedup on PostgreSQL.
+            upsert_update (bool): Overwrite existing rows with the same key. Defaults to False.
         """
         # Create schema if necessary/set default
         schema = self.schema_check(schema)
@@ -202,20 +359,231 @@ class db:
         df = self.set_field_names_to_lower_case(df)
         dtype = self.set_field_names_to_lower_case(dtype)
 
+        try:
+            dedup = self._write(df, tableName, schema, dtype, dedup, use_copy,
+                                upsert_keys, upsert_update)
+        except Exception as e:
+            if getattr(getattr(e, 'orig', e), 'pgcode', None) \
+                    not in _STALE_CATALOG_ERRORS:
+                raise
+            # Table or column dropped behind our back: forget what was
+            # cached about them and try once more, recreating them
+            logger.info(f'Catalog for {schema} is stale, retrying write')
+            self.invalidate_catalog(schema)
+            self._forget_write_plans(tableName, schema)
+            schema = self.schema_check(schema)
+            dedup = self._write(df, tableName, schema, dtype, dedup, use_copy,
+                                upsert_keys, upsert_update)
+        if dedup:
+            self.dedup(tableName, schema)
+
+    def _write(self, df: pd.DataFrame, tableName: str, schema: str,
+               dtype: Optional[Dict], dedup: bool, use_copy: bool,
+               upsert_keys: Optional[List[str]], upsert_update: bool) -> bool:
+        """Write df as dataframe_to_table, apart from dedup
+
+        Returns:
+            bool: Whether the table needs deduplicating afterwards
+        """
+        plan = self._write_plan(df, tableName, schema, dtype)
+
         # Check all required fields exist
         if self.table_exists(tableName, schema):
-            if dtype is None:
-                dtype = dict(self._get_column_names_and_types(df))
-
-            self.create_fields(df.columns, tableName, schema, dtype)
+            self.create_fields(df.columns, tableName, schema, plan.ddl)
 
         # write data
-        df.to_sql(tableName, self.connection, schema=schema, index=False,
-                  if_exists='append', dtype=dtype, method='multi',
-                  chunksize=1000)
-        self.session.commit()
-        if dedup:
-            self.dedup(tableName, schema)
+        if upsert_keys is not None and self.dbType == 'PostgreSQL':
+            self._upsert_dataframe(df, tableName, schema, upsert_keys,
+                                   upsert_update, plan)
+        elif use_copy and self.dbType == 'PostgreSQL':
+            self._copy_dataframe(df, tableName, schema, plan)
+        else:
+            df.to_sql(tableName, self.connection, schema=schema,
+                      index=False, if_exists='append', dtype=plan.dtype,
+                      method='multi', chunksize=1000)
+            self.session.commit()
+            self._catalog_add(tableName, schema, df.columns)
+            # No ON CONFLICT outside PostgreSQL: fall back to rewriting
+            dedup = dedup or upsert_keys is not None
+        return dedup
+
+    def _write_plan(self, df: pd.DataFrame, tableName: str, schema: str,
+                    dtype: Optional[Dict] = None) -> '_WritePlan':
+        """Types and SQL for writing df to a table, cached per frame shape
+
+        Frames with the same column names and numpy dtypes as an earlier
+        write to the same table reuse its plan, skipping type inference and
+        SQL compilation. Explicit dtypes override the inferred types.
+        """
+        key = (str(self.engine.url), schema, tableName, tuple(df.columns),
+               tuple(str(column_type) for column_type in df.dtypes),
+               None if dtype is None else tuple(
+                   sorted((k, repr(v)) for k, v in dtype.items())))
+
+        plan = _write_plans.get(key)
+        if plan is None:
+            resolved = {str(column): self._sqlalchemy_type(df.iloc[:, i])
+                        for i, column in enumerate(df.columns)}
+            resolved.update({column: sql_type
+                             for column, sql_type in (dtype or {}).items()
+                             if column in resolved})
+
+            ddl = {column: self._get_SQL_datatypes(sql_type)
+                   for column, sql_type in resolved.items()}
+
+            plan = _WritePlan(resolved, ddl)
+            _write_plans[key] = plan
+        return plan
+
+    def _forget_write_plans(self, tableName: str, schema: str):
+        """Drop cached write plans for a table, e.g. once it has changed"""
+        url = str(self.engine.url)
+        for key in list(_write_plans):
+            if key[:3] == (url, schema, tableName):
+                _write_plans.pop(key, None)
+
+    def _create_table(self, df: pd.DataFrame, tableName: str, schema: str,
+                      plan: '_WritePlan'):
+        """Create an empty table matching df"""
+        # Let pandas create the table, using types inferred from the whole
+        # frame rather than the empty slice. 'append' as the cached catalog
+        # may not know about a table created elsewhere, pandas checks for
+        # itself
+        df.head(0).to_sql(tableName, self.connection, schema=schema,
+                          index=False, if_exists='append', dtype=plan.dtype)
+        self._catalog_add(tableName, schema, df.columns)
+
+    @staticmethod
+    def _copy_to(cursor, df: pd.DataFrame, target: str, plan: '_WritePlan',
+                 chunksize: int = COPY_CHUNKSIZE):
+        """Stream df into target with COPY FROM STDIN, one chunk at a time
+
+        The frame is written as CSV through a single reusable buffer, so
+        memory use is bounded by chunksize rather than the size of the frame.
+        """
+        sql = plan.statement(
+            ('copy', target),
+            lambda: f'COPY {target} ({plan.columns}) FROM STDIN WITH (FORMAT csv)')
+
+        buffer = io.StringIO()
+        for start in range(0, len(df), chunksize):
+            buffer.seek(0)
+            buffer.truncate()
+            df.iloc[start:start + chunksize].to_csv(
+                buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+
+    def _copy_dataframe(self, df: pd.DataFrame, tableName: str, schema: str,
+                        plan: '_WritePlan'):
+        """Bulk load dataframe with PostgreSQL COPY FROM STDIN"""
+        if not self.table_exists(tableName, schema):
+            self._create_table(df, tableName, schema, plan)
+
+        raw_connection = self.connection.connection
+        cursor = raw_connection.cursor()
+        try:
+            self._copy_to(cursor, df, f'{schema}.{tableName}', plan)
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def create_unique_index(self, tableName: str, keys: List[str],
+                            schema: Optional[str] = None):
+        """Create a unique index on keys if it does not already exist
+
+        Rows already in the table which share a key are removed first,
+        keeping one of them (the one stored last on disk, which is not
+        necessarily the one inserted last).
+        """
+        schema = self.schema_check(schema)
+        keys = [key.lower() for key in keys]
+
+        cache_key = (str(self.engine.url), schema, tableName, tuple(keys))
+        if cache_key in _unique_indexes:
+            return
+
+        index_name = f"{tableName}_{'_'.join(keys)}_key"[:63]
+        result = self.connection.execute(f"""
+            SELECT indexname
+            FROM pg_indexes
+            WHERE schemaname = '{schema}'
+                AND indexname = '{index_name}'
+            """)
+        if result.rowcount == 0:
+            match = ' AND '.join(f'a."{key}" = b."{key}"' for key in keys)
+            self.session.execute(f"""
+                DELETE FROM {schema}.{tableName} a
+                USING {schema}.{tableName} b
+                WHERE a.ctid < b.ctid
+                    AND {match};
+
+                CREATE UNIQUE INDEX IF NOT EXISTS {index_name}
+                ON {schema}.{tableName} ({', '.join(f'"{key}"' for key in keys)});
+                """)
+            self.session.commit()
+
+        _unique_indexes.add(cache_key)
+
+    def _upsert_dataframe(self, df: pd.DataFrame, tableName: str, schema: str,
+                          keys: List[str], update: bool,
+                          plan: '_WritePlan'):
+        """Insert df, skipping or updating rows whose key already exists
+
+        Data is copied into a temporary staging table and merged with
+        INSERT ... ON CONFLICT, so the cost depends on the size of df and not
+        on the size of the table.
+        """
+        keys = [key.lower() for key in keys]
+
+        if not self.table_exists(tableName, schema):
+            self._create_table(df, tableName, schema, plan)
+        self.create_unique_index(tableName, keys, schema)
+
+        # A key may only be affected once per statement. The last row for a
+        # key in df wins, as it would if they were written one at a time.
+        df = df.drop_duplicates(
+            subset=[column for column in df.columns if column.lower() in keys],
+            keep='last')
+
+        staging = f'{tableName}_staging'
+
+        def merge_sql():
+            conflict = ', '.join(f'"{key}"' for key in keys)
+            updates = [f'"{column}" = EXCLUDED."{column}"'
+                       for column in df.columns if column not in keys]
+            if update and updates:
+                on_conflict = f"DO UPDATE SET {', '.join(updates)}"
+            else:
+                on_conflict = 'DO NOTHING'
+
+            return f"""
+                INSERT INTO {schema}.{tableName} ({plan.columns})
+                SELECT {plan.columns}
+                FROM {staging}
+                ON CONFLICT ({conflict}) {on_conflict}
+                """
+
+        raw_connection = self.connection.connection
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute(f"""
+                CREATE TEMPORARY TABLE {staging}
+                (LIKE {schema}.{tableName} INCLUDING DEFAULTS)
+                ON COMMIT DROP
+                """)
+            self._copy_to(cursor, df, staging, plan)
+            cursor.execute(plan.statement(
+                ('merge', tuple(keys), update), merge_sql))
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            cursor.close()
 
     def has_changed(self, new: Union[Dict, pd.Series, pd.DataFrame],
                     tableName: str, schema: str, orderBy: str,
@@ -324,6 +692,10 @@ class db:
         return column_names_and_types
 
     def _get_SQL_datatypes(self, sqlalchemy_dtype: Union[sqlalchemy.types.TypeEngine, str]) -> str:
+        # _sqlalchemy_type returns some types as classes rather than instances
+        if isinstance(sqlalchemy_dtype, type) \
+                and issubclass(sqlalchemy_dtype, sqlalchemy.types.TypeEngine):
+            sqlalchemy_dtype = sqlalchemy_dtype()
         if isinstance(sqlalchemy_dtype, sqlalchemy.types.TypeEngine):
             return sqlalchemy_dtype.compile(self.engine.dialect)
         else:
@@ -0,0 +1,195 @@
+"""On-disk cache for supplier API responses
+
+Responses are stored by URL and query string. Within ttl seconds of being
+fetched a response is served from disk without any request. After that it
+is revalidated with a conditional request (If-None-Match/If-Modified-Since),
+so an unchanged response costs a 304 rather than a full download. The cache
+is kept under max_bytes by evicting the least recently used entries.
+
+Each response carries a digest of its body, so callers can cache whatever
+they parse from it and reuse that for as long as the digest is unchanged.
+Only successful responses are returned; anything else raises
+requests.HTTPError, so an error body is never parsed or cached.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+import requests
+
+
+class CachedResponse:
+    def __init__(self, text: str, status_code: int, digest: str,
+                 from_cache: bool):
+        self.text = text
+        self.status_code = status_code
+        self.digest = digest
+        self.from_cache = from_cache
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HTTPCache:
+    def __init__(self, directory: str, ttl: float = 3600,
+                 max_bytes: int = 50 * 1024 ** 2,
+                 session: Optional[requests.Session] = None):
+        """
+        Args:
+            directory (str): Where responses are stored. Created if needed.
+            ttl (float, optional): Seconds a response is used without revalidating it. Defaults to 3600.
+            max_bytes (int, optional): Size the cache is kept under. Defaults to 50 MB.
+            session (requests.Session, optional): Session used for requests. Defaults to a new session.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.session = session if session is not None else requests.Session()
+
+        # hits: served without a request, revalidated: 304 Not Modified,
+        # misses: downloaded, errors: anything else
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def hit_rate(self) -> Dict[str, float]:
+        """Counts of each outcome and the share served without a download"""
+        with self._lock:
+            stats = dict(self.stats)
+        total = sum(stats.values())
+        stats['hit_rate'] = (stats.get('hits', 0) + stats.get(
+            'revalidated', 0)) / total if total else 0
+        return stats
+
+    def _count(self, outcome: str):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f'{key}.{extension}')
+
+    @staticmethod
+    def key(url: str, params: Optional[dict] = None) -> str:
+        query = urlencode(sorted((params or {}).items()))
+        return hashlib.sha256(f'{url}?{query}'.encode()).hexdigest()
+
+    def _load(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key, 'json')) as f:
+                meta = json.load(f)
+            with open(self._path(key, 'body'), encoding='utf-8') as f:
+                meta['text'] = f.read()
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def _save(self, key: str, meta: dict, text: Optional[str] = None):
+        # Write then rename so a concurrent reader never sees half a file
+        if text is not None:
+            tmp = self._path(key, f'body.{threading.get_ident()}')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp, self._path(key, 'body'))
+
+        meta = {k: v for k, v in meta.items() if k != 'text'}
+        tmp = self._path(key, f'json.{threading.get_ident()}')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path(key, 'json'))
+
+    def _touch(self, key: str):
+        # The metadata file's mtime is the entry's last use, for LRU eviction
+        try:
+            os.utime(self._path(key, 'json'))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                key = name[:-len('.json')]
+                try:
+                    size = os.path.getsize(self._path(key, 'body')) \
+                        + os.path.getsize(self._path(key, 'json'))
+                    used = os.path.getmtime(self._path(key, 'json'))
+                except OSError:
+                    continue
+                entries.append((used, size, key))
+                total += size
+
+            for used, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for extension in ['json', 'body']:
+                    try:
+                        os.remove(self._path(key, extension))
+                    except OSError:
+                        pass
+                total -= size
+
+    def get(self, url: str, params: Optional[dict] = None,
+            headers: Optional[dict] = None, **kwargs) -> CachedResponse:
+        """GET url, from the cache where possible
+
+        Only successful (200) responses are cached. Other keyword arguments
+        are passed to requests.
+
+        Raises:
+            requests.HTTPError: The response was neither 200 nor a 304 for a cached entry
+        """
+        key = self.key(url, params)
+        cached = self._load(key)
+
+        if cached is not None and time.time() - cached['fetched_at'] < self.ttl:
+            self._count('hits')
+            self._touch(key)
+            return CachedResponse(cached['text'], 200, cached['digest'], True)
+
+        headers = dict(headers or {})
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self.session.get(url, params=params, headers=headers,
+                                    **kwargs)
+
+        if response.status_code == 304 and cached is not None:
+            self._count('revalidated')
+            cached['fetched_at'] = time.time()
+            self._save(key, cached)
+            return CachedResponse(cached['text'], 200, cached['digest'], True)
+
+        if response.status_code != 200:
+            self._count('errors')
+            response.raise_for_status()
+            # e.g. a 304 for an entry evicted since the request was made
+            raise requests.HTTPError(
+                f'Unexpected {response.status_code} response for {url}',
+                response=response)
+
+        self._count('misses')
+        digest = hashlib.sha256(response.content).hexdigest()
+        self._save(key, {
+            'url': url,
+            'fetched_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'digest': digest,
+        }, response.text)
+        self._evict()
+
+        return CachedResponse(response.text, response.status_code, digest,
+                              False)
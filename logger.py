@@ -4,13 +4,21 @@ Based on the following solution:
 https://stackoverflow.com/a/43843623/6709902
 """
 
+import datetime
+import json
 import logging
+import os
+import queue
 import sys
+import threading
+import time
 import traceback
 
-from config import dbConfig, logConfig, pushNotifications
+import sqlalchemy
+
+from config import dbConfig, logConfig
 from db import db
-import pushover
+import notifications
 
 
 log_schema = 'log'
@@ -36,44 +44,185 @@ with db(**dbConfig) as DB:
 class LogDBHandler(logging.Handler):
     '''
     Customized logging handler that puts logs to the database.
-    pymssql required
+
+    Records are queued by emit and written by a background thread in
+    multi-row inserts, every batch_size records or flush_interval_ms
+    milliseconds, so logging never waits on the database. If the database is
+    unavailable or the queue is full, records are either dropped or spilled
+    to a file which is replayed once writes succeed again. The spill file is
+    capped at max_spill_bytes, records beyond that are dropped.
+
+    Errors are also added to the notification outbox (see notifications.py)
+    in the same transaction, rather than being pushed inline.
     '''
-    client = pushover.Client(pushNotifications['client'],
-                             api_token=pushNotifications['token'])
 
-    def __init__(self, DB, db_tbl_log: str):
+    def __init__(self, dbConfig: dict, db_tbl_log: str, batch_size: int = 100,
+                 flush_interval_ms: int = 1000, queue_size: int = 10000,
+                 overflow: str = 'spill',
+                 spill_file: str = './log_spill.jsonl',
+                 max_spill_bytes: int = 50 * 1024 ** 2):
         super().__init__()
-        self.DB = DB
+        assert overflow in ['drop', 'spill'], \
+            f"overflow must be 'drop' or 'spill' not {overflow}"
+
+        self.dbConfig = dbConfig
         self.db_tbl_log = db_tbl_log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.max_spill_bytes = max_spill_bytes
+        self.dropped = 0
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._spill_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._writer = threading.Thread(target=self._run, daemon=True,
+                                        name='LogDBHandler')
+        self._writer.start()
 
     def emit(self, record):
-        # Clear the log message so it can be put to db via sql (escape quotes)
-        self.log_msg = record.msg
-        self.log_msg = self.log_msg.strip()
-        self.log_msg = self.log_msg.replace('\'', '\'\'')
-        # Make the SQL insert
-        sql = f"""INSERT INTO log.{self.db_tbl_log} (
-                logged_by
+        entry = {
+            'timestamp': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'logged_by': record.name,
+            'log_level': record.levelno,
+            'log_level_name': record.levelname,
+            'log_message': record.getMessage().strip(),
+        }
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self._handle_overflow([entry])
+
+    def _run(self):
+        batch = []
+        flush_at = time.monotonic() + self.flush_interval
+        while not (self._closing.is_set() and self.queue.empty()):
+            try:
+                batch.append(self.queue.get(
+                    timeout=max(flush_at - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= flush_at:
+                self._write(batch)
+                batch = []
+                flush_at = time.monotonic() + self.flush_interval
+        self._write(batch)
+
+    def _insert(self, batch: list):
+        # Parameters are numbered per row to make a single multi-row INSERT
+        values = []
+        params = {}
+        for i, entry in enumerate(batch):
+            values.append(f"(:timestamp_{i}, :logged_by_{i}, :log_level_{i}"
+                          f", :log_level_name_{i}, :log_message_{i})")
+            params.update({f'{k}_{i}': v for k, v in entry.items()})
+
+        sql = sqlalchemy.text(f"""
+            INSERT INTO {log_schema}.{self.db_tbl_log} (
+                "timestamp"
+                , logged_by
                 , log_level
                 , log_level_name
                 , log_message)
-            VALUES (
-                '{record.name}'
-                , {record.levelno}
-                , '{record.levelname}'
-                , '{self.log_msg}')"""
+            VALUES {', '.join(values)}""")
+
+        with db(**self.dbConfig) as DB:
+            with DB.connection.begin():
+                DB.connection.execute(sql, params)
+
+                if logConfig['push_errors']:
+                    for entry in batch:
+                        if entry['log_level'] >= logging.ERROR:
+                            notifications.enqueue(
+                                entry['log_message'],
+                                title="ERROR detected in Truely Smart Home App",
+                                DB=DB)
+
+    def _write(self, batch: list):
+        if not batch:
+            return
         try:
-            self.DB.session.execute(sql)
-            self.DB.session.commit()
+            for start in range(0, len(batch), self.batch_size):
+                self._insert(batch[start:start + self.batch_size])
         # If error - print it out on screen. Since DB is not working - there's
         # no point making a log about it to the database :)
-        except:  # pymssql.Error as e:
-            print(sql)
+        except Exception:
             print('CRITICAL DB ERROR! Logging to database not possible!')
+            self._handle_overflow(batch[start:])
+            return
+
+        self._replay_spill()
+
+    def _handle_overflow(self, batch: list):
+        if self.overflow == 'drop':
+            self.dropped += len(batch)
+            return
+
+        with self._spill_lock:
+            with open(self.spill_file, 'a') as f:
+                size = f.tell()
+                for i, entry in enumerate(batch):
+                    line = json.dumps(entry) + '\n'
+                    size += len(line.encode())
+                    if size > self.max_spill_bytes:
+                        self.dropped += len(batch) - i
+                        break
+                    f.write(line)
+
+    def _spilled(self, f):
+        """Records in a spill file, batch_size at a time"""
+        batch = []
+        for line in f:
+            try:
+                batch.append(json.loads(line))
+            except ValueError:
+                # e.g. a line cut short when the process stopped
+                if line.strip():
+                    self.dropped += 1
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _replay_spill(self):
+        """Write records spilled while the database was unavailable
+
+        The file being replayed is only removed once every record in it has
+        been written or spilled again, so nothing is lost if the process
+        stops part way through (the records already written are then written
+        again by the next replay).
+        """
+        replaying = self.spill_file + '.replay'
+        with self._spill_lock:
+            # A replay file still there was interrupted, so finish it first
+            if not os.path.exists(replaying):
+                if not os.path.exists(self.spill_file):
+                    return
+                os.replace(self.spill_file, replaying)
+
+        with open(replaying) as f:
+            for batch in self._spilled(f):
+                try:
+                    self._insert(batch)
+                except Exception:
+                    print('CRITICAL DB ERROR! Logging to database not '
+                          'possible!')
+                    # Spill the rest back to file, for the next replay
+                    self._handle_overflow(batch)
+                    for rest in self._spilled(f):
+                        self._handle_overflow(rest)
+                    break
+        os.remove(replaying)
 
-        if record.levelno >= 40 and logConfig['push_errors']:
-            self.client.send_message(self.log_msg,
-                                     title="ERROR detected in Truely Smart Home App")
+    def close(self):
+        """Flush queued records and stop the writer thread"""
+        self._closing.set()
+        self._writer.join(timeout=10 * self.flush_interval + 5)
+        super().close()
 
 
 # Set file logger
@@ -81,11 +230,17 @@ logging.basicConfig(filename=logConfig['log_file_path'])
 
 # Main settings for the database logging use
 if logConfig['log_to_db']:
-    # Make the connection to database for the logger
-    DB = db(**dbConfig)
-    logdb = LogDBHandler(DB, log_table)
+    logdb = LogDBHandler(
+        dbConfig, log_table,
+        batch_size=logConfig.get('db_batch_size', 100),
+        flush_interval_ms=logConfig.get('db_flush_interval_ms', 1000),
+        queue_size=logConfig.get('db_queue_size', 10000),
+        overflow=logConfig.get('db_overflow', 'spill'),
+        spill_file=logConfig.get('db_spill_file', './log_spill.jsonl'),
+        max_spill_bytes=logConfig.get('db_spill_max_bytes', 50 * 1024 ** 2))
 
-    # Set db handler for root logger
+    # Set db handler for root logger. logging.shutdown (run at exit) closes
+    # the handler, which flushes anything still queued.
     logging.getLogger('').addHandler(logdb)
 
 
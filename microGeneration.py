@@ -7,17 +7,58 @@
 import logging
 import requests
 import sys
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from typing import Union
+import sqlalchemy
+from typing import Dict, List, Optional, Union
 
 from config import microgen, dbConfig
 from db import db
 from logger import create_logger
+import rollups
+from throttle import CircuitBreaker, backoff
+
+try:
+    from config import microgenPoller as pollerConfig
+except ImportError:
+    pollerConfig = {}
 
 logger = create_logger('microGeneration')
 
+# Each poll of the inverters must finish within poll_deadline seconds, so a
+# slow or unreachable cloud API costs a skipped sample rather than holding
+# up the next poll
+poll_deadline = pollerConfig.get('deadline_seconds', 60)
+request_timeout = pollerConfig.get('request_timeout', 5)
+backoff_base = pollerConfig.get('backoff_base', 2)
+backoff_cap = pollerConfig.get('backoff_cap', 30)
+
+# One circuit breaker per API endpoint, shared by every device using it
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(endpoint: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(
+                pollerConfig.get('failure_threshold', 5),
+                pollerConfig.get('reset_seconds', 300))
+        return _breakers[endpoint]
+
+
+class SampleSkipped(Exception):
+    """No sample could be taken within the poll deadline"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
 with db(**dbConfig) as DB:
     DB.create_schema('microgen')
 
@@ -30,11 +71,148 @@ with db(**dbConfig) as DB:
     )
     """
     DB.session.execute(sql)
+
+    # Readings from every technology, one row per metric, in place of a wide
+    # table per device (see migrate_readings.py). The BRIN index on ts is
+    # tiny and suits rows arriving in time order.
+    DB.session.execute("""
+        ALTER TABLE microgen.technologies
+        ADD COLUMN IF NOT EXISTS id SERIAL;
+
+        CREATE TABLE IF NOT EXISTS microgen.metrics (
+            id SMALLSERIAL PRIMARY KEY
+            , name VARCHAR(50) UNIQUE NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS microgen.readings (
+            tech_id INT NOT NULL
+            , ts TIMESTAMP WITH TIME ZONE NOT NULL
+            , metric_id SMALLINT NOT NULL
+            , value DOUBLE PRECISION
+            , CONSTRAINT readings_tech_id_ts_metric_id_key
+                PRIMARY KEY (tech_id, ts, metric_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS readings_ts_brin
+        ON microgen.readings USING BRIN (ts);
+
+        -- Fields which are not numbers (e.g. inverterStatus), with metric
+        -- ids from the same microgen.metrics
+        CREATE TABLE IF NOT EXISTS microgen.readings_text (
+            tech_id INT NOT NULL
+            , ts TIMESTAMP WITH TIME ZONE NOT NULL
+            , metric_id SMALLINT NOT NULL
+            , value TEXT
+            , CONSTRAINT readings_text_tech_id_ts_metric_id_key
+                PRIMARY KEY (tech_id, ts, metric_id)
+        );
+        """)
     DB.session.commit()
 
+# Metric ids by name
+_metric_ids = {}
+_metric_ids_lock = threading.Lock()
+
+
+def metric_ids(names: List[str]) -> Dict[str, int]:
+    """Ids of metrics in microgen.metrics, adding any that are new"""
+    with _metric_ids_lock:
+        missing = [name for name in names if name not in _metric_ids]
+        if missing:
+            with db(**dbConfig) as DB:
+                with DB.connection.begin():
+                    DB.connection.execute(sqlalchemy.text("""
+                        INSERT INTO microgen.metrics (name)
+                        SELECT unnest(:names)
+                        ON CONFLICT (name) DO NOTHING
+                        """), {'names': missing})
+                ids = DB.connection.execute(sqlalchemy.text("""
+                    SELECT id, name
+                    FROM microgen.metrics
+                    WHERE name = ANY(:names)
+                    """), {'names': missing}).fetchall()
+            _metric_ids.update({row['name']: row['id'] for row in ids})
+        return {name: _metric_ids[name] for name in names}
+
+
+def to_readings(data: pd.DataFrame, tech_id: int,
+                time_field: str = 'uploadTime',
+                text: bool = False) -> pd.DataFrame:
+    """Reshape wide readings to microgen.readings rows
+
+    Every numeric field is a metric. With text, every other field (e.g.
+    inverterStatus) is reshaped instead, for microgen.readings_text.
+    """
+    numeric = set(data.select_dtypes('number').columns)
+    metrics = [column for column in data.columns
+               if column != time_field and (column not in numeric) == text]
+    readings = data.melt(id_vars=[time_field], value_vars=metrics,
+                         var_name='metric').dropna(subset=['value'])
+    ids = metric_ids([metric.lower() for metric in metrics])
+
+    return pd.DataFrame({
+        'tech_id': tech_id,
+        'ts': readings[time_field].to_numpy(),
+        'metric_id': readings['metric'].str.lower().map(ids).to_numpy(),
+        'value': readings['value'].astype(str).to_numpy() if text
+        else readings['value'].to_numpy(dtype=float)})
+
+
+def write_readings(data: pd.DataFrame, tech_id: int):
+    """Upsert wide readings for a technology into microgen.readings, and
+    fields which are not numbers into microgen.readings_text
+
+    The readings may be older than the generation rollups' high-water mark
+    (e.g. from an inverter that was slow to respond), so they are flagged
+    for the next rollups.refresh().
+    """
+    if len(data) > 0:
+        rollups.mark_stale('generation', data['uploadTime'].min(),
+                           data['uploadTime'].max() + pd.Timedelta(seconds=1))
+    for table, text in [('readings', False), ('readings_text', True)]:
+        readings = to_readings(data, tech_id, text=text)
+        if len(readings) == 0:
+            continue
+        with db(**dbConfig) as DB:
+            DB.dataframe_to_table(readings, table, 'microgen',
+                                  upsert_keys=['tech_id', 'ts', 'metric_id'],
+                                  upsert_update=True)
+
+
+def readings(start: pd.Timestamp, end: pd.Timestamp,
+             metric: Optional[str] = None,
+             tech_id: Optional[int] = None) -> pd.DataFrame:
+    """Readings between start and end, as a single range scan on ts
+
+    Args:
+        start (pd.Timestamp): From, inclusive
+        end (pd.Timestamp): To, exclusive
+        metric (str, optional): Only this metric, e.g. 'acpower'
+        tech_id (int, optional): Only this technology
+
+    Returns:
+        pd.DataFrame: tech_id, ts, metric and value fields
+    """
+    with db(**dbConfig) as DB:
+        return pd.read_sql(sqlalchemy.text("""
+            SELECT r.tech_id, r.ts, m.name AS metric, r.value
+            FROM microgen.readings r
+            JOIN microgen.metrics m
+                ON m.id = r.metric_id
+            WHERE r.ts >= :start
+                AND r.ts < :end
+                AND (CAST(:metric AS VARCHAR) IS NULL OR m.name = :metric)
+                AND (CAST(:tech_id AS INT) IS NULL OR r.tech_id = :tech_id)
+            ORDER BY r.ts
+            """), DB.connection, params={'start': start, 'end': end,
+                                         'metric': metric,
+                                         'tech_id': tech_id})
+
 
 class Microgen_base:
     techType: str
+    # id in microgen.technologies, set by Microgen
+    techId: Optional[int] = None
 
     def __init__(self, make: str, config: dict, instanceNo: int):
         self.make = make
@@ -50,23 +228,76 @@ class Microgen_base:
 class Solar(Microgen_base):
     techType = 'Solar'
 
-    def _get_data(self):
-        """Method will keep trying API every 10 sec until success"""
-
-        try:
-            return requests.get(
-                f"{self.config['API_URL']}/getRealtimeInfo.do",
-                params={'tokenId': self.config['key'],
-                        'sn': self.config['SN']},
-                timeout=2)
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.ReadTimeout):
-            # try again after 10 sec
-            time.sleep(10)
-            return self._get_data()
+    def _get_data(self, deadline: float):
+        """Request real time data, retrying with capped exponential backoff
 
-    def getRealTimeData(self):
-        response = self._get_data()
+        Args:
+            deadline (float): time.monotonic() by which to give up
+
+        Raises:
+            SampleSkipped: if the endpoint's circuit breaker is open (reason 'circuit_open') or no response arrived before deadline (reason 'deadline')
+        """
+        breaker = circuit_breaker(self.config['API_URL'])
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise SampleSkipped('circuit_open')
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SampleSkipped('deadline')
+
+                response = requests.get(
+                    f"{self.config['API_URL']}/getRealtimeInfo.do",
+                    params={'tokenId': self.config['key'],
+                            'sn': self.config['SN']},
+                    timeout=min(request_timeout, remaining))
+                response.raise_for_status()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError) as e:
+                breaker.record_failure()
+                delay = backoff(attempt, backoff_base, backoff_cap)
+                attempt += 1
+                logger.debug(f'Solax API attempt {attempt} failed ({e}), '
+                             f'retrying in {delay:.1f}s')
+                if time.monotonic() + delay >= deadline:
+                    raise SampleSkipped('deadline')
+                time.sleep(delay)
+                continue
+            else:
+                breaker.record_success()
+                return response
+            finally:
+                # e.g. an unexpected error on a half open trial
+                breaker.release()
+
+    def getHistory(self, start: pd.Timestamp, end: pd.Timestamp
+                   ) -> pd.DataFrame:
+        """Inverter readings between start and end
+
+        The endpoint can be set with history_endpoint in the inverter's cloud
+        config, as it differs between versions of the Solax cloud API.
+        """
+        response = requests.get(
+            f"{self.config['API_URL']}/{self.config.get('history_endpoint', 'getHistoryInfo.do')}",
+            params={'tokenId': self.config['key'],
+                    'sn': self.config['SN'],
+                    'startTime': start.tz_convert('UTC').strftime('%Y-%m-%d %H:%M:%S'),
+                    'endTime': end.tz_convert('UTC').strftime('%Y-%m-%d %H:%M:%S')},
+            timeout=30)
+
+        history = pd.DataFrame.from_records(response.json()['result'])
+        if len(history) > 0:
+            history['uploadTime'] = pd.to_datetime(
+                history['uploadTime']).dt.tz_localize('UTC')
+        return history
+
+    def getRealTimeData(self, deadline: Optional[float] = None
+                        ) -> pd.DataFrame:
+        if deadline is None:
+            deadline = time.monotonic() + poll_deadline
+        response = self._get_data(deadline)
 
         realTimeData = pd.DataFrame.from_records(
             response.json()['result'], index=[0])
@@ -97,7 +328,26 @@ class Microgen:
                 DB.dataframe_to_table(
                     tech.to_frame().T[['type', 'make', 'sn',
                                        'instance_no']], 'technologies', 'microgen',
-                    dedup=True)
+                    upsert_keys=['type', 'make', 'sn'])
+
+        with db(**dbConfig) as DB:
+            ids = pd.read_sql_table('technologies', DB.connection,
+                                    schema='microgen')
+        ids = ids.set_index(['type', 'make', 'sn'])['id']
+        for idx, tech in self.technologies.iterrows():
+            tech.object.techId = int(ids[(tech['type'], tech['make'],
+                                          tech['sn'])])
+
+        # Polls run on _background, one at a time. Each polls every
+        # technology at once on _pool.
+        self._background = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='MicrogenPoll')
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, len(self.technologies)),
+            thread_name_prefix='MicrogenSample')
+        self._poll = None
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
 
     def _get_instance_no(self, techType: str, make: str, SN: str
                          ) -> Union[int, np.ndarray]:
@@ -141,11 +391,65 @@ class Microgen:
         return instance_no
 
     def getRealTimeData(self):
+        """Poll every technology in the background
+
+        Returns straight away so the schedule loop is never blocked. If the
+        previous poll is still running this poll is skipped.
+        """
         logger.info('Running Microgen().getRealTimeData()')
 
-        for idx, tech in self.technologies.iterrows():
-            data = tech.object.getRealTimeData()
+        if self._poll is not None and not self._poll.done():
+            self._count('skipped_overlap', len(self.technologies))
+            logger.warning('Previous microgen poll still running, skipped')
+            return
+        self._poll = self._background.submit(self.poll)
 
-            with db(**dbConfig) as DB:
-                DB.dataframe_to_table(data, tech.object.tableName,
-                                      "microgen", dedup=True)
+    def poll(self):
+        """Take a sample from every technology concurrently and store them"""
+        for tableName, data in self.sample().items():
+            write_readings(data, self.tech_ids[tableName])
+            self._count('samples')
+        rollups.after_write('generation')
+
+    @property
+    def tech_ids(self) -> Dict[str, int]:
+        """microgen.technologies id by table name"""
+        return {tech.object.tableName: tech.object.techId
+                for idx, tech in self.technologies.iterrows()}
+
+    def sample(self, deadline: Optional[float] = None
+               ) -> Dict[str, pd.DataFrame]:
+        """Take a sample from every technology concurrently
+
+        Args:
+            deadline (float, optional): time.monotonic() by which to give up. Defaults to poll_deadline seconds from now.
+
+        Returns:
+            Dict[str, pd.DataFrame]: Sample by table name, for the technologies that could be sampled
+        """
+        if deadline is None:
+            deadline = time.monotonic() + poll_deadline
+        futures = {tech.object.tableName: self._pool.submit(
+            tech.object.getRealTimeData, deadline)
+            for idx, tech in self.technologies.iterrows()}
+
+        samples = {}
+        for tableName, future in futures.items():
+            try:
+                samples[tableName] = future.result()
+            except SampleSkipped as e:
+                self._count(f'skipped_{e.reason}')
+                logger.warning(f'Skipped {tableName} sample: {e.reason}')
+            except Exception as e:
+                self._count('failed')
+                logger.error(f'Failed to sample {tableName}: {e}')
+        return samples
+
+    def _count(self, outcome: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[outcome] += n
+
+    def poll_stats(self) -> Dict[str, int]:
+        """Samples stored and skipped (by reason) since start up"""
+        with self._stats_lock:
+            return dict(self._stats)
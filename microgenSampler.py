@@ -0,0 +1,319 @@
+"""Sample microgeneration every few seconds, keeping recent readings in memory
+
+Every sample_interval seconds each technology is sampled (see
+Microgen.sample) and its numeric readings appended to a fixed size ring
+buffer of numpy arrays, which gains a column whenever a new field appears.
+Fields which are not numbers (e.g. inverterStatus) are held until they are
+written, up to the same number of samples. Samples are written to
+microgen.readings (and microgen.readings_text) in bulk once flush_samples
+are waiting or flush_seconds have passed, rather than one row at a time.
+
+The buffers can be queried in process, e.g. by the action scheduler, to
+read live generation without touching the database:
+
+    sampler.latest('solar_solax_0', 'acpower')
+    sampler.mean('solar_solax_0', 'acpower', minutes=10)
+
+Samples are keyed by the device's uploadTime, so a sample repeating the
+latest uploadTime replaces it rather than being added. How often new
+readings arrive is therefore limited by how often the device reports.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from logger import create_logger
+from microGeneration import Microgen, pollerConfig, write_readings
+import rollups
+
+logger = create_logger('microgenSampler')
+
+sample_interval = pollerConfig.get('sample_interval_seconds', 10)
+# A day of samples at the default interval
+buffer_size = pollerConfig.get('buffer_size', 8640)
+flush_samples = pollerConfig.get('flush_samples', 30)
+flush_seconds = pollerConfig.get('flush_seconds', 300)
+
+
+class RingBuffer:
+    """Fixed size buffer of timestamped rows of floats, oldest overwritten"""
+
+    def __init__(self, capacity: int, columns: List[str]):
+        self.capacity = capacity
+        self.columns = list(columns)
+        self._column_index = {column: i for i, column in enumerate(columns)}
+        # Nanoseconds since the epoch (UTC)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((capacity, len(columns)), np.nan)
+        # Rows ever appended. Row i is stored at i % capacity.
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def add_columns(self, columns: List[str]):
+        """Add columns, nan for rows already in the buffer"""
+        for column in columns:
+            self._column_index[column] = len(self.columns)
+            self.columns.append(column)
+        self.values = np.hstack([self.values,
+                                 np.full((self.capacity, len(columns)),
+                                         np.nan)])
+
+    def append(self, time_ns: int, row: np.ndarray) -> bool:
+        """Add a row, replacing the latest if it has the same time
+
+        Returns:
+            bool: True if a row was added, False if the latest was replaced
+        """
+        if self.count > 0 and self.times[(self.count - 1) % self.capacity] \
+                == time_ns:
+            self.values[(self.count - 1) % self.capacity] = row
+            return False
+
+        self.times[self.count % self.capacity] = time_ns
+        self.values[self.count % self.capacity] = row
+        self.count += 1
+        return True
+
+    def rows(self, start: int, stop: Optional[int] = None
+             ) -> Tuple[np.ndarray, np.ndarray]:
+        """Times and values of rows start to stop (counted from the first
+        row ever appended), oldest first. Overwritten rows are left out."""
+        stop = self.count if stop is None else stop
+        start = max(start, self.count - self.capacity, 0)
+        index = np.arange(start, stop) % self.capacity
+        return self.times[index], self.values[index]
+
+    def column(self, name: str) -> int:
+        return self._column_index[name]
+
+    def since(self, time_ns: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows at or after time_ns"""
+        times, values = self.rows(0)
+        first = np.searchsorted(times, time_ns)
+        return times[first:], values[first:]
+
+
+class Sampler:
+    def __init__(self, microgen: Microgen, interval: float = sample_interval,
+                 capacity: int = buffer_size,
+                 flush_samples: int = flush_samples,
+                 flush_seconds: float = flush_seconds):
+        """
+        Args:
+            microgen (Microgen): Technologies to sample
+            interval (float, optional): Seconds between samples
+            capacity (int, optional): Samples held in memory per technology
+            flush_samples (int, optional): Write to the database once this many samples are waiting
+            flush_seconds (float, optional): ... or once this long has passed since the last write
+        """
+        self.microgen = microgen
+        self.interval = interval
+        self.capacity = capacity
+        self.flush_samples = flush_samples
+        self.flush_seconds = flush_seconds
+
+        # By table name
+        self.buffers = {}
+        # Rows of each buffer written to the database
+        self._flushed = {}
+        # Times the latest row of each buffer has been replaced, so a flush
+        # can tell if a row it is writing was replaced meanwhile
+        self._replaced = Counter()
+        # Fields which are not numbers, not yet written, as
+        # {uploadTime (ns): {field: value}} per table, oldest first
+        self._text = {}
+        self._flushed_at = time.monotonic()
+
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, tableName: str, sample: pd.DataFrame):
+        """Append a sample (as returned by getRealTimeData) to its buffer"""
+        numeric = sample.select_dtypes('number')
+        text = sample.drop(columns=list(numeric.columns) + ['uploadTime'])
+        with self._lock:
+            if tableName not in self.buffers:
+                self.buffers[tableName] = RingBuffer(self.capacity,
+                                                     numeric.columns)
+                self._flushed[tableName] = 0
+                self._text[tableName] = OrderedDict()
+            buffer = self.buffers[tableName]
+            new = [column for column in numeric.columns
+                   if column not in buffer.columns]
+            if new:
+                buffer.add_columns(new)
+
+            for upload_time, row, fields in zip(
+                    sample['uploadTime'],
+                    numeric.reindex(columns=buffer.columns).to_numpy(float),
+                    # to_dict gives no records for a frame with no columns
+                    text.to_dict('records') if len(text.columns)
+                    else [{}] * len(text)):
+                time_ns = pd.Timestamp(upload_time).value
+                if not buffer.append(time_ns, row):
+                    # The replaced row is written again on the next flush
+                    self._flushed[tableName] = min(self._flushed[tableName],
+                                                   buffer.count - 1)
+                    self._replaced[tableName] += 1
+                    self.stats['repeated'] += 1
+                self._add_text(tableName, time_ns, fields)
+
+    def _add_text(self, tableName: str, time_ns: int, fields: dict):
+        fields = {field: value for field, value in fields.items()
+                  if value is not None
+                  and not (isinstance(value, float) and np.isnan(value))}
+        if not fields:
+            return
+        pending = self._text[tableName]
+        pending[time_ns] = fields
+        pending.move_to_end(time_ns)
+        while len(pending) > self.capacity:
+            pending.popitem(last=False)
+            self.stats['text_overwritten'] += 1
+
+    def _pending(self) -> int:
+        return sum(buffer.count - self._flushed[tableName]
+                   for tableName, buffer in self.buffers.items())
+
+    def flush(self):
+        """Write samples not yet in the database, in one write per table"""
+        with self._lock:
+            batches = {}
+            for tableName, buffer in self.buffers.items():
+                flushed = self._flushed[tableName]
+                if buffer.count - flushed > buffer.capacity:
+                    # Counted once, as they can't be written on a later
+                    # flush either
+                    self.stats['overwritten'] += \
+                        buffer.count - flushed - buffer.capacity
+                    self._flushed[tableName] = flushed = \
+                        buffer.count - buffer.capacity
+                times, values = buffer.rows(flushed)
+                text = self._text[tableName]
+                self._text[tableName] = OrderedDict()
+                if len(times) == 0 and len(text) == 0:
+                    continue
+
+                batch = pd.DataFrame(values, columns=buffer.columns)
+                batch['uploadTime'] = times
+                if len(text) > 0:
+                    batch = batch.merge(pd.DataFrame.from_dict(
+                        text, orient='index').rename_axis('uploadTime')
+                        .reset_index(), on='uploadTime', how='outer')
+                batch['uploadTime'] = pd.to_datetime(batch['uploadTime'],
+                                                     utc=True)
+                batches[tableName] = (batch, buffer.count,
+                                      self._replaced[tableName], text)
+            self._flushed_at = time.monotonic()
+
+        tech_ids = self.microgen.tech_ids
+        for tableName, (batch, count, replaced, text) in batches.items():
+            try:
+                write_readings(batch, tech_ids[tableName])
+            except Exception as e:
+                # Left pending, so retried on the next flush
+                logger.error(f'Failed to write {tableName} samples: {e}')
+                with self._lock:
+                    for time_ns, fields in reversed(text.items()):
+                        # Unless a later sample has replaced them
+                        if time_ns not in self._text[tableName]:
+                            self._text[tableName][time_ns] = fields
+                            self._text[tableName].move_to_end(
+                                time_ns, last=False)
+                continue
+            with self._lock:
+                # A row replaced while this batch was being written is left
+                # pending, to write the replacement on the next flush
+                if self._replaced[tableName] == replaced:
+                    self._flushed[tableName] = max(self._flushed[tableName],
+                                                   count)
+                self.stats['written'] += len(batch)
+
+        if len(batches) > 0:
+            rollups.after_write('generation')
+
+    def latest(self, tableName: str, metric: str
+               ) -> Optional[Tuple[pd.Timestamp, float]]:
+        """Latest reading of metric and its time, None if there is none"""
+        with self._lock:
+            buffer = self.buffers.get(tableName)
+            if buffer is None or buffer.count == 0:
+                return None
+            times, values = buffer.rows(buffer.count - 1)
+            return (pd.Timestamp(times[0], tz='UTC'),
+                    values[0, buffer.column(metric)])
+
+    def window(self, tableName: str, metric: str, minutes: float
+               ) -> np.ndarray:
+        """Readings of metric in the last minutes"""
+        since = (pd.Timestamp.now(tz='UTC')
+                 - pd.Timedelta(minutes=minutes)).value
+        with self._lock:
+            buffer = self.buffers.get(tableName)
+            if buffer is None:
+                return np.array([])
+            times, values = buffer.since(since)
+            return values[:, buffer.column(metric)]
+
+    def mean(self, tableName: str, metric: str, minutes: float) -> float:
+        """Mean of metric over the last minutes, nan if no readings"""
+        readings = self.window(tableName, metric, minutes)
+        return np.nanmean(readings) if len(readings) else np.nan
+
+    def max(self, tableName: str, metric: str, minutes: float) -> float:
+        """Maximum of metric over the last minutes, nan if no readings"""
+        readings = self.window(tableName, metric, minutes)
+        return np.nanmax(readings) if len(readings) else np.nan
+
+    def sample(self):
+        """Sample every technology once, flushing if due"""
+        deadline = time.monotonic() + self.interval
+        for tableName, data in self.microgen.sample(deadline).items():
+            self.add(tableName, data)
+            self.stats['samples'] += 1
+
+        with self._lock:
+            due = self._pending() >= self.flush_samples \
+                or time.monotonic() - self._flushed_at >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def _run(self):
+        next_sample = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f'Microgen sampling failed: {e}')
+            # Keep to the interval however long sampling took, skipping
+            # samples rather than falling behind
+            next_sample += self.interval
+            now = time.monotonic()
+            if next_sample < now:
+                skipped = int((now - next_sample) // self.interval) + 1
+                self.stats['skipped_late'] += skipped
+                next_sample += skipped * self.interval
+            self._stop.wait(next_sample - now)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='MicrogenSampler')
+            self._thread.start()
+
+    def stop(self):
+        """Stop sampling and write anything not yet written"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
@@ -0,0 +1,159 @@
+"""Move readings from the per-device microgen tables into microgen.readings
+
+    python migrate_readings.py [--chunk-days 30] [--drop]
+
+Each table listed in microgen.technologies (e.g. microgen.solar_solax_0) is
+copied a chunk of time at a time, every field becoming a metric in
+microgen.metrics. Numeric fields are copied to microgen.readings and the
+rest (e.g. inverterstatus) to microgen.readings_text. Each chunk is its own
+transaction and rows already copied are skipped, so the migration can be
+stopped and rerun. With --drop a table is dropped once every reading in it
+has been copied.
+"""
+
+import argparse
+from typing import List, Tuple
+
+import pandas as pd
+import sqlalchemy
+
+from config import dbConfig
+from db import db
+from logger import create_logger
+from microGeneration import metric_ids
+import rollups
+
+logger = create_logger('migrate_readings')
+
+numeric_types = ('smallint', 'integer', 'bigint', 'real', 'double precision',
+                 'numeric')
+
+
+def device_tables(DB: db) -> pd.DataFrame:
+    """Technologies with a per-device table, and the table name"""
+    technologies = pd.read_sql_table('technologies', DB.connection,
+                                     schema='microgen')
+    technologies['table'] = (technologies['type'] + '_' + technologies['make']
+                             + '_' + technologies['instance_no'].astype(str)
+                             ).str.lower()
+    return technologies[[DB.table_exists(table, 'microgen')
+                         for table in technologies['table']]]
+
+
+def fields(DB: db, table: str) -> Tuple[List[str], List[str]]:
+    """Numeric fields of table, and the other fields except uploadtime"""
+    columns = DB.connection.execute(sqlalchemy.text("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = 'microgen'
+            AND table_name = :table
+            AND column_name != 'uploadtime'
+        ORDER BY ordinal_position
+        """), {'table': table}).fetchall()
+    return ([row['column_name'] for row in columns
+             if row['data_type'] in numeric_types],
+            [row['column_name'] for row in columns
+             if row['data_type'] not in numeric_types])
+
+
+def migrate_table(DB: db, table: str, tech_id: int, chunk: pd.Timedelta
+                  ) -> int:
+    """Copy table into microgen.readings and microgen.readings_text chunk by
+    chunk
+
+    Returns:
+        int: Rows inserted
+    """
+    numeric, text = fields(DB, table)
+    if len(numeric) + len(text) == 0:
+        return 0
+    ids = metric_ids(numeric + text)
+
+    start, end = DB.connection.execute(f"""
+        SELECT MIN(uploadtime), MAX(uploadtime)
+        FROM microgen.{table}
+        """).fetchone()
+    if start is None:
+        return 0
+
+    # One row per field from each source row
+    statements = []
+    for target, names, cast in [('readings', numeric, 'DOUBLE PRECISION'),
+                                ('readings_text', text, 'TEXT')]:
+        if len(names) == 0:
+            continue
+        values = ', '.join(f"({ids[field]}, \"{field}\"::{cast})"
+                           for field in names)
+        statements.append(sqlalchemy.text(f"""
+            INSERT INTO microgen.{target} (tech_id, ts, metric_id, value)
+            SELECT :tech_id, t.uploadtime, v.metric_id, v.value
+            FROM microgen.{table} t
+            CROSS JOIN LATERAL (VALUES {values}) AS v (metric_id, value)
+            WHERE t.uploadtime >= :chunk_start
+                AND t.uploadtime < :chunk_end
+                AND v.value IS NOT NULL
+            ON CONFLICT (tech_id, ts, metric_id) DO NOTHING
+            """))
+
+    inserted = 0
+    for chunk_start in pd.date_range(start, end, freq=chunk):
+        with DB.connection.begin():
+            for sql in statements:
+                inserted += DB.connection.execute(sql, {
+                    'tech_id': tech_id, 'chunk_start': chunk_start,
+                    'chunk_end': chunk_start + chunk}).rowcount
+        logger.info(f'{table}: copied up to {chunk_start + chunk}')
+
+    # Copied readings are older than the rollups' high-water mark
+    rollups.mark_stale('generation', start, end + pd.Timedelta(seconds=1))
+    return inserted
+
+
+def fully_migrated(DB: db, table: str, tech_id: int) -> bool:
+    """Whether every field of every source row has been copied"""
+    checks = []
+    for target, names in zip(['readings', 'readings_text'],
+                             fields(DB, table)):
+        for field in names:
+            checks.append(f"""
+                (t."{field}" IS NOT NULL AND NOT EXISTS (
+                    SELECT 1
+                    FROM microgen.{target} r
+                    WHERE r.tech_id = :tech_id
+                        AND r.ts = t.uploadtime
+                        AND r.metric_id = {metric_ids([field])[field]}))""")
+    if len(checks) == 0:
+        return True
+
+    return DB.connection.execute(sqlalchemy.text(f"""
+        SELECT NOT EXISTS (
+            SELECT 1
+            FROM microgen.{table} t
+            WHERE {' OR '.join(checks)})
+        """), {'tech_id': tech_id}).scalar()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chunk-days', type=float, default=30)
+    parser.add_argument('--drop', action='store_true',
+                        help='Drop each table once it has been copied')
+    args = parser.parse_args()
+
+    with db(**dbConfig) as DB:
+        for idx, tech in device_tables(DB).iterrows():
+            rows = migrate_table(DB, tech['table'], int(tech['id']),
+                                 pd.Timedelta(days=args.chunk_days))
+            logger.info(f"Copied {rows} readings from microgen.{tech['table']}")
+            rollups.after_write('generation')
+
+            if args.drop:
+                if fully_migrated(DB, tech['table'], int(tech['id'])):
+                    DB.session.execute(
+                        f"DROP TABLE microgen.{tech['table']}")
+                    DB.session.commit()
+                    DB.invalidate_catalog('microgen')
+                    logger.info(f"Dropped microgen.{tech['table']}")
+                else:
+                    logger.warning(f"Not dropping microgen.{tech['table']}, "
+                                   'some fields were not copied')
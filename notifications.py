@@ -0,0 +1,259 @@
+"""Outbox for push notifications
+
+Messages are written to the notification.outbox table and sent to Pushover
+by a background worker, so nothing that raises a notification waits on (or
+fails because of) the notification service.
+
+The worker:
+* drops repeats of a message within dedup_window_minutes of its first
+  occurrence, counting them instead, so a message that keeps recurring is
+  sent again once per window
+* sends all due error messages as a single digest
+* rate limits sends with a token bucket
+* retries failed sends with capped exponential backoff
+"""
+
+import contextlib
+import hashlib
+import logging
+import threading
+from typing import List, Optional
+
+import pushover
+import sqlalchemy
+
+from config import dbConfig, pushNotifications
+from db import db
+from throttle import TokenBucket, backoff
+
+# Not logger.create_logger, as logger.py imports this module. Handlers are
+# set on the root logger there.
+logger = logging.getLogger('notifications')
+
+outbox_schema = 'notification'
+outbox_table = 'outbox'
+
+# Pushover limits
+max_message_length = 1024
+max_title_length = 250
+
+dedup_window_minutes = pushNotifications.get('dedup_window_minutes', 60)
+digest_interval = pushNotifications.get('digest_interval_seconds', 60)
+max_attempts = pushNotifications.get('max_attempts', 8)
+
+with db(**dbConfig) as DB:
+    DB.create_schema(outbox_schema)
+
+    DB.session.execute("""
+        CREATE TABLE IF NOT EXISTS notification.outbox (
+            id SERIAL PRIMARY KEY
+            , created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            , last_seen_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            , category VARCHAR(20) NOT NULL
+            , title TEXT
+            , message TEXT
+            , attachment TEXT
+            , fingerprint CHAR(40) NOT NULL
+            , occurrences INT NOT NULL DEFAULT 1
+            , attempts SMALLINT NOT NULL DEFAULT 0
+            , next_attempt_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            , sent_at TIMESTAMP WITH TIME ZONE
+            , status VARCHAR(10) NOT NULL DEFAULT 'pending'
+        );
+
+        DROP INDEX IF EXISTS notification.outbox_fingerprint_idx;
+
+        CREATE INDEX IF NOT EXISTS outbox_fingerprint_created_idx
+        ON notification.outbox (fingerprint, created_at);
+
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx
+        ON notification.outbox (next_attempt_at)
+        WHERE status = 'pending';
+        """)
+    DB.session.commit()
+
+
+def fingerprint(title: str, message: str) -> str:
+    return hashlib.sha1(f'{title}\n{message}'.encode()).hexdigest()
+
+
+def enqueue(message: str, title: Optional[str] = None,
+            category: str = 'error', attachment: Optional[str] = None,
+            DB: Optional[db] = None):
+    """Add a message to the outbox
+
+    If an identical message was first queued within dedup_window_minutes,
+    its occurrence count is increased instead of queuing it again. The
+    window runs from when the message was queued, not from its latest
+    repeat, so a message that keeps recurring is queued again each window.
+
+    Args:
+        message (str): Message body
+        title (str, optional): Message title
+        category (str, optional): 'error' messages are combined into digests, anything else is sent individually. Defaults to 'error'.
+        attachment (str, optional): Path of an image to attach. It is read when the message is sent.
+        DB (db, optional): Connection to use, e.g. to write in the same transaction as the caller. Defaults to a new pooled connection.
+    """
+    if DB is None:
+        with db(**dbConfig) as DB:
+            return enqueue(message, title, category, attachment, DB)
+
+    params = {'message': message, 'title': title, 'category': category,
+              'attachment': attachment,
+              'fingerprint': fingerprint(title, message),
+              'window': dedup_window_minutes}
+
+    # Join the caller's transaction if there is one
+    with contextlib.nullcontext() if DB.connection.in_transaction() \
+            else DB.connection.begin():
+        seen = DB.connection.execute(sqlalchemy.text("""
+            UPDATE notification.outbox
+            SET occurrences = occurrences + 1
+                , last_seen_at = CURRENT_TIMESTAMP
+            WHERE fingerprint = :fingerprint
+                AND created_at > CURRENT_TIMESTAMP
+                    - make_interval(mins => :window)
+            RETURNING id
+            """), params)
+
+        if seen.rowcount == 0:
+            DB.connection.execute(sqlalchemy.text("""
+                INSERT INTO notification.outbox (
+                    category
+                    , title
+                    , message
+                    , attachment
+                    , fingerprint)
+                VALUES (
+                    :category
+                    , :title
+                    , :message
+                    , :attachment
+                    , :fingerprint)
+                """), params)
+
+
+class OutboxSender:
+    """Background worker sending due outbox messages to Pushover"""
+
+    def __init__(self, interval: float = digest_interval,
+                 rate_per_hour: float = pushNotifications.get(
+                     'rate_per_hour', 20),
+                 burst: int = pushNotifications.get('burst', 5),
+                 backoff_base: float = 30, backoff_cap: float = 3600):
+        self.interval = interval
+        self.bucket = TokenBucket(rate_per_hour / 3600, burst)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.client = pushover.Client(pushNotifications['client'],
+                                      api_token=pushNotifications['token'])
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='OutboxSender')
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.send_pending()
+            except Exception as e:
+                # A warning, so it isn't itself added to the outbox
+                logger.warning(f'Unable to send notifications: {e}')
+            self._stop.wait(self.interval)
+
+    @staticmethod
+    def _format(message: str, occurrences: int) -> str:
+        return message if occurrences == 1 else f'{message} (x{occurrences})'
+
+    def _messages(self, due: list) -> list:
+        """Group due rows into (ids, title, message, attachment) to send"""
+        errors = [row for row in due if row['category'] == 'error']
+        messages = [([row['id']], row['title'],
+                     self._format(row['message'], row['occurrences']),
+                     row['attachment'])
+                    for row in due if row['category'] != 'error']
+
+        if len(errors) == 1:
+            row = errors[0]
+            messages.append(([row['id']], row['title'],
+                             self._format(row['message'], row['occurrences']),
+                             row['attachment']))
+        elif len(errors) > 1:
+            digest = '\n'.join(
+                f"- {self._format(row['message'], row['occurrences'])}"
+                for row in errors)
+            messages.append(([row['id'] for row in errors],
+                             f'{len(errors)} errors detected in Truely Smart Home App',
+                             digest, None))
+        return messages
+
+    def _send(self, title: str, message: str, attachment: Optional[str]):
+        title = (title or '')[:max_title_length] or None
+        message = message[:max_message_length]
+
+        if attachment is None:
+            self.client.send_message(message, title=title)
+        else:
+            with open(attachment, 'rb') as f:
+                self.client.send_message(message, title=title, attachment=f)
+
+    def send_pending(self):
+        """Send everything due now, as far as the rate limit allows"""
+        with db(**dbConfig) as DB:
+            due = DB.connection.execute("""
+                SELECT id, category, title, message, attachment
+                    , occurrences, attempts
+                FROM notification.outbox
+                WHERE status = 'pending'
+                    AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY created_at
+                """).fetchall()
+
+            for ids, title, message, attachment in self._messages(due):
+                if not self.bucket.consume():
+                    # Left pending for the next run
+                    break
+
+                try:
+                    self._send(title, message, attachment)
+                except Exception:
+                    self._failed(DB, ids, due)
+                else:
+                    with DB.connection.begin():
+                        DB.connection.execute(sqlalchemy.text("""
+                            UPDATE notification.outbox
+                            SET status = 'sent'
+                                , sent_at = CURRENT_TIMESTAMP
+                                , attempts = attempts + 1
+                            WHERE id = ANY(:ids)
+                            """), {'ids': ids})
+
+    def _failed(self, DB: db, ids: List[int], due: list):
+        attempts = max(row['attempts'] for row in due if row['id'] in ids)
+        delay = backoff(attempts, self.backoff_base, self.backoff_cap)
+
+        with DB.connection.begin():
+            DB.connection.execute(sqlalchemy.text("""
+                UPDATE notification.outbox
+                SET attempts = attempts + 1
+                    , next_attempt_at = CURRENT_TIMESTAMP
+                        + make_interval(secs => :delay)
+                    , status = CASE WHEN attempts + 1 >= :max_attempts
+                        THEN 'failed' ELSE status END
+                WHERE id = ANY(:ids)
+                """), {'ids': ids, 'delay': delay,
+                       'max_attempts': max_attempts})
+
+
+sender = OutboxSender()
@@ -1,66 +1,192 @@
 import base64
+import hashlib
 import json
+import os
+import shutil
+import time
 from datetime import datetime
-from typing import Tuple
+from typing import Iterator, Tuple
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import mplcyberpunk
 import numpy as np
 import pandas as pd
-import pushover
 import pytz
 import requests
 
-from config import (dbConfig, electricalSupplier, pushNotifications)
-from db import db
+from config import electricalSupplier
+from httpCache import HTTPCache
 from logger import create_logger
+import notifications
+import tariff_scheduler
 
 logger = create_logger('octopus_tariff_app')
 
-
-def get_tariff(productCode: str) -> pd.DataFrame:
+# Shared by every call to the supplier API in this process, and across
+# restarts as it is kept on disk
+cacheConfig = electricalSupplier.get('cache', {})
+api_cache = HTTPCache(cacheConfig.get('directory', './cache/octopus'),
+                      ttl=cacheConfig.get('ttl_seconds', 3600),
+                      max_bytes=cacheConfig.get('max_bytes', 50 * 1024 ** 2))
+
+# Seconds to wait for the supplier API to respond
+request_timeout = electricalSupplier.get('request_timeout', 30)
+
+# Rendered tariff plots, see plot_tariff
+plotConfig = electricalSupplier.get('plot', {})
+plot_cache_directory = plotConfig.get('cache_directory', './cache/plots')
+plot_mode = plotConfig.get('mode', 'auto')
+plot_time_budget = plotConfig.get('time_budget_seconds', 10)
+# Number of rendered plots kept on disk, the most recent ones
+plot_cache_size = plotConfig.get('cache_size', 8)
+# Seconds the last full render took, used by 'auto' mode
+_last_full_render = None
+
+# Parsed tariffs by (url, response digest), so an unchanged response is
+# not parsed again
+_parsed_tariffs = {}
+_max_parsed_tariffs = 8
+
+
+def get_tariff(productCode: str, period_from=None, period_to=None,
+               rate_limiter=None) -> pd.DataFrame:
+    """Unit rates for a product
+
+    Without period_from only the first page of results (the latest rates)
+    is fetched. With it, every page in the period is fetched.
+
+    rate_limiter, if given, is acquired (see throttle.HostRateLimiter)
+    before each page is requested.
+    """
+    url = f"{electricalSupplier['API_URL']}/products/{productCode}/electricity-tariffs/E-1R-{productCode}-L/standard-unit-rates/"
+    params = {}
+    if period_from is not None:
+        params['period_from'] = api_time(period_from)
+        params['page_size'] = 1500
+    if period_to is not None:
+        params['period_to'] = api_time(period_to)
+
+    pages = []
+    next_url = url
     try:
-        url = f"{electricalSupplier['API_URL']}/products/{productCode}/electricity-tariffs/E-1R-{productCode}-L/standard-unit-rates/"
-        agileProduct = requests.get(url)
-    except requests.urllib3.exceptions.MaxRetryError:
-        logger.error(f'API attempt failed: {url}')
+        while next_url is not None:
+            if rate_limiter is not None:
+                rate_limiter.acquire(next_url)
+            page = api_cache.get(next_url, params=params or None,
+                                 timeout=request_timeout)
+            pages.append(page)
+
+            next_url = page.json().get('next') \
+                if period_from is not None else None
+            # next is a full URL, including the query
+            params = {}
+    except (requests.urllib3.exceptions.MaxRetryError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.HTTPError) as e:
+        logger.error(f'API attempt failed: {url} ({e})')
         return
 
-    tariff = pd.DataFrame.from_records(
-        json.loads(agileProduct.text)['results'])
+    key = (url, period_from, period_to, tuple(page.digest for page in pages))
+    if key not in _parsed_tariffs:
+        rates = [rate for page in pages for rate in page.json()['results']]
+        # No rates, e.g. for a window before the product was launched
+        tariff = pd.DataFrame.from_records(rates) if rates else pd.DataFrame(
+            columns=['valid_from', 'valid_to', 'value_exc_vat',
+                     'value_inc_vat'])
 
-    # default times are UTC
-    tariff['valid_from'] = pd.to_datetime(
-        tariff['valid_from']).dt.tz_convert('Europe/London')
-    tariff['valid_to'] = pd.to_datetime(
-        tariff['valid_to']).dt.tz_convert('Europe/London')
+        # default times are UTC
+        tariff['valid_from'] = pd.to_datetime(
+            tariff['valid_from'], utc=True).dt.tz_convert('Europe/London')
+        tariff['valid_to'] = pd.to_datetime(
+            tariff['valid_to'], utc=True).dt.tz_convert('Europe/London')
 
-    return tariff
+        if len(_parsed_tariffs) >= _max_parsed_tariffs:
+            _parsed_tariffs.pop(next(iter(_parsed_tariffs)))
+        _parsed_tariffs[key] = tariff
 
+    # Callers add columns to the frame
+    return _parsed_tariffs[key].copy()
 
-def get_usage():
-    return get_usage_base(electricalSupplier["MPAN"])
 
+def api_time(time) -> str:
+    """Format a time for API query parameters (UTC, ISO 8601)"""
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        time = time.tz_localize('Europe/London')
+    return time.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%SZ')
 
-def get_export():
-    return get_usage_base(electricalSupplier["MPAN_export"])
 
+def get_usage(**kwargs):
+    return get_usage_base(electricalSupplier["MPAN"], **kwargs)
+
+
+def get_export(**kwargs):
+    return get_usage_base(electricalSupplier["MPAN_export"], **kwargs)
 
-def get_usage_base(MPAN) -> pd.DataFrame:
-    token = base64.b64encode(electricalSupplier['key'].encode()).decode()
-    response = requests.get(
-        f'{electricalSupplier["API_URL"]}/electricity-meter-points/{MPAN}/meters/{electricalSupplier["serialNo"]}/consumption/', headers={"Authorization": f'Basic {token}'})
 
-    usage = pd.DataFrame.from_records(json.loads(response.text)['results'])
+def iter_usage(**kwargs):
+    return iter_usage_base(electricalSupplier["MPAN"], **kwargs)
 
-    # default times are UTC
-    usage['interval_start'] = pd.to_datetime(
-        usage['interval_start']).dt.tz_convert('Europe/London')
-    usage['interval_end'] = pd.to_datetime(
-        usage['interval_end']).dt.tz_convert('Europe/London')
 
-    return usage
+def iter_export(**kwargs):
+    return iter_usage_base(electricalSupplier["MPAN_export"], **kwargs)
+
+
+def iter_usage_base(MPAN, period_from=None, period_to=None,
+                    page_size: int = 25000,
+                    rate_limiter=None) -> Iterator[pd.DataFrame]:
+    """Consumption for a meter point, one DataFrame per page of results
+
+    Follows the API's pagination, oldest interval first, so that callers can
+    write each page as it arrives.
+
+    Args:
+        MPAN (str): Meter point
+        period_from (optional): Only intervals from this time. Defaults to all history.
+        period_to (optional): Only intervals before this time. Defaults to now.
+        page_size (int, optional): Intervals per request (API maximum is 25000). Defaults to 25000.
+        rate_limiter (throttle.HostRateLimiter, optional): Acquired before each page is requested. Defaults to no limit.
+
+    Raises:
+        requests.HTTPError: The API responded with an error
+    """
+    token = base64.b64encode(electricalSupplier['key'].encode()).decode()
+    url = f'{electricalSupplier["API_URL"]}/electricity-meter-points/{MPAN}/meters/{electricalSupplier["serialNo"]}/consumption/'
+    params = {'page_size': page_size, 'order_by': 'period'}
+    if period_from is not None:
+        params['period_from'] = api_time(period_from)
+    if period_to is not None:
+        params['period_to'] = api_time(period_to)
+
+    while url is not None:
+        if rate_limiter is not None:
+            rate_limiter.acquire(url)
+        response = requests.get(url, params=params,
+                                headers={"Authorization": f'Basic {token}'},
+                                timeout=request_timeout)
+        response.raise_for_status()
+        page = json.loads(response.text)
+
+        if len(page['results']) > 0:
+            usage = pd.DataFrame.from_records(page['results'])
+
+            # default times are UTC
+            usage['interval_start'] = pd.to_datetime(
+                usage['interval_start']).dt.tz_convert('Europe/London')
+            usage['interval_end'] = pd.to_datetime(
+                usage['interval_end']).dt.tz_convert('Europe/London')
+
+            yield usage
+
+        # next is a full URL, including the query
+        url = page.get('next')
+        params = None
+
+
+def get_usage_base(MPAN, **kwargs) -> pd.DataFrame:
+    pages = list(iter_usage_base(MPAN, **kwargs))
+    if len(pages) == 0:
+        return pd.DataFrame(columns=['consumption', 'interval_start',
+                                     'interval_end'])
+    return pd.concat(pages, ignore_index=True)
 
 
 def get_cheapest_period(n: int = 1):
@@ -107,23 +233,22 @@ def create_actions(df: pd.DataFrame, start: str = 'From', end: str = 'To', start
 
 
 def immersion_on_during_cheapest_period():
+    """Schedule the immersion, and any other devices in
+    electricalSupplier['scheduled_devices'], into the cheapest future slots
+    """
     # logger.info(
     #     'Running immersion_on_during_cheapest_period() from octopus_tariff_app')
 
-    set_n_periods = electricalSupplier['auto_immersion_periods']
-    cheapest_period = get_cheapest_period(set_n_periods)
-    if cheapest_period is None:
+    tariff = get_tariff(electricalSupplier['productRef'])
+    if tariff is None:
         return
+    tariff = tariff[tariff['valid_to'] >
+                    datetime.now(pytz.timezone('Europe/London'))]
 
-    action = create_actions(
-        cheapest_period, start='valid_from', end='valid_to')
-    action['device_id'] = 'Immersion'
-
-    with db(**dbConfig) as DB:
-        device_type = DB.lookup_table('device_type', 'action', index='id')
-        action['device_type'] = device_type.Shelly.value
-
-        DB.dataframe_to_table(action, 'action', schema='action')
+    actions = tariff_scheduler.schedule(
+        tariff, tariff_scheduler.configured_devices(),
+        power_cap_kw=electricalSupplier.get('power_cap_kw', np.inf))
+    tariff_scheduler.write_actions(actions)
 
 
 def is_edge_nan(arr: np.ndarray) -> np.ndarray:
@@ -176,19 +301,72 @@ def split_array(x: np.ndarray, y: np.ndarray, split: float, above: bool = True
     return x, y
 
 
-def plot_tariff(tariff: pd.DataFrame, timeFrom_series: str, timeTo_series: str, value_series: str, saveTo: str = None) -> pd.DataFrame:
-    plt.style.use("cyberpunk")
+def _pyplot():
+    """Import matplotlib on first use, with the non-interactive Agg backend
 
-    tariff['diff'] = -tariff[value_series].diff(periods=1)
+    Importing matplotlib is slow on the Pi, and only plots need it.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def tariff_digest(tariff: pd.DataFrame, columns: list, mode: str) -> str:
+    """Hash of the plotted data, so an unchanged tariff is not re-rendered"""
+    hashed = pd.util.hash_pandas_object(tariff[columns], index=False)
+    return hashlib.sha256(hashed.values.tobytes()
+                          + mode.encode()).hexdigest()
+
+
+def _render_mode(mode: str) -> str:
+    # auto renders lite once a full render has been slower than the budget
+    if mode != 'auto':
+        return mode
+    if _last_full_render is not None and _last_full_render > plot_time_budget:
+        return 'lite'
+    return 'full'
+
+
+def plot_tariff(tariff: pd.DataFrame, timeFrom_series: str, timeTo_series: str, value_series: str, saveTo: str = None, mode: str = plot_mode):
+    """Plot tariff as a step function, labelling big changes in price
+
+    Args:
+        tariff (pd.DataFrame): Tariff to plot
+        timeFrom_series (str): Start time field
+        timeTo_series (str): End time field
+        value_series (str): Price field
+        saveTo (str, optional): Save the plot to this path, reusing an earlier render of the same tariff if there is one. Returns the axes if None.
+        mode (str, optional): 'full' adds the mplcyberpunk glow, which redraws every line many times. 'lite' leaves it out. 'auto' uses full unless the last full render took longer than time_budget_seconds. Defaults to the plot mode in config.json, or 'auto'.
+    """
+    global _last_full_render
+    mode = _render_mode(mode)
+
+    if saveTo is not None:
+        key = tariff_digest(
+            tariff, [timeFrom_series, timeTo_series, value_series], mode)
+        cached = os.path.join(plot_cache_directory, f'{key}.png')
+        if os.path.exists(cached):
+            shutil.copyfile(cached, saveTo)
+            return
+
+    start = time.perf_counter()
+    plt = _pyplot()
+    if mode == 'full':
+        import mplcyberpunk  # Registers the cyberpunk style
+    plt.style.use("cyberpunk" if mode == 'full' else "dark_background")
+
+    timeFrom = tariff[timeFrom_series].values
+    timeTo = tariff[timeTo_series]
+    price = tariff[value_series].to_numpy(dtype=float)
+    diff = np.append(np.nan, -np.diff(price))
 
     fig, ax = plt.subplots()
 
     # Create step functions
-    timeFrom = tariff[timeFrom_series].repeat(2).values[:-1]
-    value = tariff[value_series].repeat(2).values[1:]
-
-    x, pos = split_array(timeFrom, value, 0, True)
-    _, neg = split_array(timeFrom, value, 0, False)
+    x, pos = split_array(timeFrom.repeat(2)[:-1], price.repeat(2)[1:], 0, True)
+    _, neg = split_array(timeFrom.repeat(2)[:-1], price.repeat(2)[1:], 0,
+                         False)
 
     ax.plot(x, pos, color='c')
     ax.plot(x, neg, color='r')
@@ -199,50 +377,51 @@ def plot_tariff(tariff: pd.DataFrame, timeFrom_series: str, timeTo_series: str,
                       tariff[timeFrom_series].max(), freq=freq)
     ax.set_ylabel('Tariff (p/kWh)')
     ax.set_xticks(t)
-    ax.set_xticklabels([time.time().strftime("%I %p").lstrip('0')
-                        for time in t], rotation=90)
-
-    def label(label_series: pd.Series, text_offset: Tuple[float, float]):
-        # Wrapper for annotate method
-        xlim = [mpl.dates.num2date(l) for l in ax.get_xlim()]
-        xaxis_range = (xlim[1] - xlim[0]).total_seconds() / 60 / 60
-
-        strftime = "%I %p" if label_series[timeTo_series].strftime(
-            "%M") == "00" else "%I:%M %p"
-        x_shift_hrs = text_offset[0] * xaxis_range
-
-        ax.annotate(label_series[timeTo_series].strftime(strftime).lstrip('0'),
-                    xy=(label_series[timeTo_series],
-                        label_series[value_series] + label_series['diff'] / 2),
-                    xytext=(label_series[timeTo_series] + pd.Timedelta(
-                        f'{x_shift_hrs} hours'), (label_series[value_series]
-                                                  + label_series['diff'] / 2) * text_offset[1]),
+    ax.set_xticklabels(t.strftime("%I %p").str.lstrip('0'), rotation=90)
+
+    # Label start and end times of large jumps in price
+    xlim = ax.get_xlim()
+    xaxis_range = pd.Timedelta(days=xlim[1] - xlim[0])
+
+    on_the_hour = (timeTo.dt.minute == 0).to_numpy()
+    labels = np.where(on_the_hour, timeTo.dt.strftime("%I %p"),
+                      timeTo.dt.strftime("%I:%M %p"))
+    rising = diff > 10
+    x_offset = np.where(rising, np.where(on_the_hour, -0.1, -0.12), 0.04)
+    y = price + diff / 2
+
+    for i in np.flatnonzero(rising | (diff < -10)):
+        ax.annotate(labels[i].lstrip('0'),
+                    xy=(timeTo.iloc[i], y[i]),
+                    xytext=(timeTo.iloc[i] + x_offset[i] * xaxis_range,
+                            y[i] * 1.1),
                     arrowprops={'arrowstyle': '->'})
 
-    # table start and end times of large jumps in price
-    for big_step in tariff[tariff['diff'] > 10].iterrows():
-        big_step = big_step[1]
-        label(big_step, (-0.1 if big_step[timeTo_series].strftime(
-            "%M") == "00" else -0.12, 1.1))
+    if mode == 'full':
+        mplcyberpunk.make_lines_glow()
+        mplcyberpunk.add_underglow()
 
-    for big_step in tariff[tariff['diff'] < -10].iterrows():
-        big_step = big_step[1]
-        label(big_step, (0.04, 1.1))
+    if saveTo is None:
+        return ax
 
-    mplcyberpunk.make_lines_glow()
-    mplcyberpunk.add_underglow()
+    plt.savefig(saveTo, bbox_inches='tight')
+    plt.close(fig)
 
-    if saveTo is not None:
-        plt.savefig(saveTo, bbox_inches='tight')
-    else:
-        return ax
+    if mode == 'full':
+        _last_full_render = time.perf_counter() - start
 
+    os.makedirs(plot_cache_directory, exist_ok=True)
+    shutil.copyfile(saveTo, cached)
 
-def push_tariff():
+    # Only the latest few renders are ever reused
+    renders = sorted((os.path.join(plot_cache_directory, name)
+                      for name in os.listdir(plot_cache_directory)),
+                     key=os.path.getmtime)
+    for render in renders[:max(len(renders) - plot_cache_size, 0)]:
+        os.remove(render)
 
-    client = pushover.Client(pushNotifications['client'],
-                             api_token=pushNotifications['token'])
 
+def push_tariff():
     tariff = get_tariff(electricalSupplier['productRef'])
     if tariff is None:
         return
@@ -256,17 +435,13 @@ def push_tariff():
         "%I %p %a %d %b" if tariff.valid_from.max().strftime(
             "%M") == "00" else "%I:%M %p %a %d %b").lstrip("0")
 
-    with open('octopus_tariff.png', 'rb') as attachment:
-        try:
-            # logger.info('Pushing tariff plot to pushover')
-            client.send_message(f"{start_time} to {end_time}",
-                                title="Octopus Tariff", attachment=attachment)
-        except requests.exceptions.ConnectionError:
-            # Error connecting to pushover api
-            # logger.error(f'Error connecting to PushOver API from {__file__}.')
-            pass
+    # Sent by the outbox worker, see notifications.py
+    notifications.enqueue(f"{start_time} to {end_time}",
+                          title="Octopus Tariff", category='tariff',
+                          attachment='octopus_tariff.png')
 
 
 if __name__ == '__main__':
     push_tariff()
+    notifications.sender.send_pending()
     # immersion_on_during_cheapest_period()
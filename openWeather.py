@@ -17,14 +17,9 @@ with db(**dbConfig) as DB:
 class OpenWeather:
     DB = db(**dbConfig)
 
-    @classmethod
-    def getFreshCut(cls):
-        logger.info('Running OpenWeather().getFreshCut()')
-
-        data = requests.get(
-            f"https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&appid={openWeather['key']}&units=metric")
-
-        forcast = pd.DataFrame.from_dict(json.loads(data.text)['hourly'])
+    @staticmethod
+    def _hourly(hourly: list) -> pd.DataFrame:
+        forcast = pd.DataFrame.from_dict(hourly)
         forcast = forcast.join(pd.DataFrame.from_dict(
             list(forcast.weather.apply(lambda x: x[0]))))
         forcast.drop('weather', axis=1, inplace=True)
@@ -35,6 +30,27 @@ class OpenWeather:
             if precipitation in forcast.columns:
                 forcast[precipitation] = forcast[precipitation].apply(
                     lambda x: x['1h'] if type(x) is dict else x)
+        return forcast
+
+    @classmethod
+    def getFreshCut(cls):
+        logger.info('Running OpenWeather().getFreshCut()')
+
+        data = requests.get(
+            f"https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&appid={openWeather['key']}&units=metric")
+
+        forcast = cls._hourly(json.loads(data.text)['hourly'])
         forcast['forcastDate'] = datetime.datetime.now()
 
         cls.DB.dataframe_to_table(forcast, 'forecast', schema='weather')
+
+    @classmethod
+    def getHistory(cls, day: datetime.datetime) -> pd.DataFrame:
+        """Observed hourly weather for the day containing day
+
+        NB: the API only holds the last 5 days.
+        """
+        data = requests.get(
+            f"https://api.openweathermap.org/data/2.5/onecall/timemachine?lat={lat}&lon={lon}&dt={int(day.timestamp())}&appid={openWeather['key']}&units=metric")
+
+        return cls._hourly(json.loads(data.text)['hourly'])
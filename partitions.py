@@ -0,0 +1,350 @@
+"""Monthly partitioning and retention for the high volume tables
+
+The tables in partitioned_tables are converted to tables partitioned by
+month on a timestamp field, so queries over a time range only scan the
+months they need (EXPLAIN lists only those partitions) and old data is
+removed by dropping a whole partition rather than by DELETE.
+
+maintain(), run daily by dataCollector, for each table:
+* converts it to a partitioned table if it is not one yet, copying the
+  existing rows across in a single transaction
+* creates partitions months_ahead months in advance
+* moves any rows that landed in the default partition (e.g. backfilled
+  history older than the existing partitions) into monthly partitions
+* applies the table's retention policy
+
+Configured in an optional partitioning section of config.json, e.g.
+    {"months_ahead": 2, "archive_directory": "./archive",
+     "retention": {"log.log": {"months": 3, "mode": "drop"},
+                   "weather.forecast": {"months": 12, "mode": "archive"}}}
+Partitions older than the retention period are dropped, or with "archive"
+written to a gzipped CSV in archive_directory first. Tables without a
+retention policy are kept forever.
+"""
+
+import gzip
+import os
+import re
+from typing import List, Optional
+
+import pandas as pd
+import sqlalchemy
+
+from config import dbConfig
+from db import db
+from logger import create_logger
+
+try:
+    from config import partitioning as partitionConfig
+except ImportError:
+    partitionConfig = {}
+
+logger = create_logger('partitions')
+
+months_ahead = partitionConfig.get('months_ahead', 2)
+archive_directory = partitionConfig.get('archive_directory', './archive')
+retention = partitionConfig.get('retention', {})
+
+# Partition key, and constraints and indexes to create on the partitioned
+# table ({table} is replaced by its name). Unique constraints must include
+# the partition key.
+partitioned_tables = {
+    'log.log': {
+        'key': 'timestamp',
+        'ddl': [],
+    },
+    'microgen.readings': {
+        'key': 'ts',
+        'ddl': [
+            """ALTER TABLE {table}
+            ADD CONSTRAINT readings_tech_id_ts_metric_id_key
+            PRIMARY KEY (tech_id, ts, metric_id)""",
+            """CREATE INDEX IF NOT EXISTS readings_ts_brin
+            ON {table} USING BRIN (ts)""",
+        ],
+    },
+    'weather.forecast': {
+        'key': 'forcastdate',
+        'ddl': [],
+    },
+    'action.action': {
+        'key': 'action_time',
+        'ddl': [
+            """ALTER TABLE {table}
+            ADD PRIMARY KEY (action_id, action_time)""",
+            """ALTER TABLE {table}
+            ADD CONSTRAINT fk_status FOREIGN KEY(status)
+                REFERENCES action.status(status)
+                ON DELETE SET NULL
+                ON UPDATE CASCADE""",
+            """ALTER TABLE {table}
+            ADD CONSTRAINT fk_device_type FOREIGN KEY(device_type)
+                REFERENCES action.device_type(id)
+                ON DELETE SET NULL
+                ON UPDATE CASCADE""",
+            """CREATE INDEX IF NOT EXISTS action_pending_idx
+            ON {table} (action_time, device_id)
+            WHERE status IS NULL AND actioned_at IS NULL""",
+            """CREATE TRIGGER action_inserted
+            AFTER INSERT ON {table}
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE action.notify_action_inserted()""",
+        ],
+    },
+}
+
+
+def month_start(time) -> pd.Timestamp:
+    """Start of the month containing time, in UTC"""
+    time = pd.Timestamp(time)
+    time = time.tz_localize('UTC') if time.tzinfo is None \
+        else time.tz_convert('UTC')
+    return time.normalize().replace(day=1)
+
+
+def partition_name(table: str, month: pd.Timestamp) -> str:
+    return f"{table}_p{month.strftime('%Y%m')}"
+
+
+def is_partitioned(DB: db, table: str) -> Optional[bool]:
+    """Whether table is partitioned, None if it does not exist"""
+    kind = DB.connection.execute(sqlalchemy.text("""
+        SELECT relkind
+        FROM pg_class
+        WHERE oid = to_regclass(:table)
+        """), {'table': table}).scalar()
+    return None if kind is None else kind == 'p'
+
+
+def partitions(DB: db, table: str) -> List[str]:
+    """Monthly partitions of table, oldest first (excluding the default)"""
+    schema, name = table.split('.')
+    rows = DB.connection.execute(sqlalchemy.text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child
+            ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(:table)
+        """), {'table': table}).fetchall()
+    pattern = re.compile(rf'^{re.escape(name)}_p\d{{6}}$')
+    return sorted(f"{schema}.{row['relname']}" for row in rows
+                  if pattern.match(row['relname']))
+
+
+def _create_partitions(DB: db, table: str, start, end):
+    """Create the monthly partitions of table covering start to end"""
+    for month in pd.date_range(month_start(start), month_start(end),
+                               freq='MS'):
+        DB.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(table, month)}
+            PARTITION OF {table}
+            FOR VALUES FROM ('{month.isoformat()}')
+                TO ('{(month + pd.DateOffset(months=1)).isoformat()}')
+            """)
+
+
+def _key_range(DB: db, table: str, key: str):
+    return DB.connection.execute(f"""
+        SELECT MIN("{key}"), MAX("{key}")
+        FROM {table}
+        """).fetchone()
+
+
+def convert(DB: db, table: str):
+    """Convert table to a table partitioned by month, keeping its rows
+
+    The table is renamed, a partitioned copy created in its place and the
+    rows copied across, all in one transaction. The table is locked before
+    anything else is done, so writers wait until the partitioned table has
+    replaced it rather than writing rows that would not be copied.
+    """
+    spec = partitioned_tables[table]
+    key = spec['key']
+    schema, name = table.split('.')
+    legacy = f'{name}_legacy'
+
+    with DB.connection.begin():
+        DB.connection.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+        # Another process may have converted it while waiting for the lock
+        if is_partitioned(DB, table):
+            return
+
+        DB.connection.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+
+        # Free the names of the legacy table's indexes and constraints, so
+        # they can be recreated on the partitioned table
+        for row in DB.connection.execute(sqlalchemy.text("""
+                SELECT conname
+                FROM pg_constraint
+                WHERE conrelid = to_regclass(:legacy)
+                    AND contype IN ('p', 'u', 'f')
+                """), {'legacy': f'{schema}.{legacy}'}).fetchall():
+            DB.connection.execute(f"""
+                ALTER TABLE {schema}.{legacy}
+                DROP CONSTRAINT "{row['conname']}" CASCADE
+                """)
+        for row in DB.connection.execute(sqlalchemy.text("""
+                SELECT indexname
+                FROM pg_indexes
+                WHERE schemaname = :schema
+                    AND tablename = :legacy
+                """), {'schema': schema, 'legacy': legacy}).fetchall():
+            DB.connection.execute(
+                f"""DROP INDEX {schema}."{row['indexname']}" """)
+        DB.connection.execute(
+            f'DROP TRIGGER IF EXISTS action_inserted ON {schema}.{legacy}')
+
+        DB.connection.execute(f"""
+            CREATE TABLE {table} (
+                LIKE {schema}.{legacy}
+                INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE ("{key}")
+            """)
+        DB.connection.execute(f"""
+            CREATE TABLE {table}_default PARTITION OF {table} DEFAULT
+            """)
+        for ddl in spec['ddl']:
+            DB.connection.execute(ddl.format(table=table))
+
+        start, end = _key_range(DB, f'{schema}.{legacy}', key)
+        now = pd.Timestamp.now(tz='UTC')
+        _create_partitions(DB, table, start if start is not None else now,
+                           now + pd.DateOffset(months=months_ahead))
+
+        DB.connection.execute(f"""
+            INSERT INTO {table}
+            OVERRIDING SYSTEM VALUE
+            SELECT *
+            FROM {schema}.{legacy}
+            """)
+
+        # Serial columns: move the sequence over, so it is not dropped with
+        # the legacy table. Identity columns: continue after the copied ids.
+        for row in DB.connection.execute(sqlalchemy.text("""
+                SELECT column_name, is_identity
+                FROM information_schema.columns
+                WHERE table_schema = :schema
+                    AND table_name = :legacy
+                    AND (column_default LIKE 'nextval%'
+                         OR is_identity = 'YES')
+                """), {'schema': schema, 'legacy': legacy}).fetchall():
+            column = row['column_name']
+            if row['is_identity'] == 'YES':
+                sequence = DB.connection.execute(sqlalchemy.text(
+                    'SELECT pg_get_serial_sequence(:table, :column)'),
+                    {'table': table, 'column': column}).scalar()
+            else:
+                sequence = DB.connection.execute(sqlalchemy.text(
+                    'SELECT pg_get_serial_sequence(:table, :column)'),
+                    {'table': f'{schema}.{legacy}', 'column': column}
+                ).scalar()
+                DB.connection.execute(
+                    f'ALTER SEQUENCE {sequence} OWNED BY {table}."{column}"')
+            DB.connection.execute(sqlalchemy.text(f"""
+                SELECT setval(:sequence,
+                              COALESCE(MAX("{column}"), 0) + 1, false)
+                FROM {table}
+                """), {'sequence': sequence})
+
+        DB.connection.execute(f'DROP TABLE {schema}.{legacy}')
+
+    DB.invalidate_catalog(schema)
+    logger.info(f'Converted {table} to a partitioned table')
+
+
+def drain_default(DB: db, table: str):
+    """Move rows from the default partition into monthly partitions"""
+    key = partitioned_tables[table]['key']
+    default = f'{table}_default'
+
+    start, end = _key_range(DB, default, key)
+    if start is None:
+        return
+
+    with DB.connection.begin():
+        # A partition cannot be created while the default holds rows that
+        # belong in it
+        DB.connection.execute(
+            f'ALTER TABLE {table} DETACH PARTITION {default}')
+        _create_partitions(DB, table, start, end)
+        DB.connection.execute(f"""
+            INSERT INTO {table}
+            OVERRIDING SYSTEM VALUE
+            SELECT *
+            FROM {default}
+            WHERE "{key}" IS NOT NULL
+            """)
+        DB.connection.execute(
+            f'DELETE FROM {default} WHERE "{key}" IS NOT NULL')
+        DB.connection.execute(
+            f'ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT')
+    logger.info(f'Moved rows from {start} to {end} out of {default}')
+
+
+def _archive(DB: db, partition: str):
+    os.makedirs(archive_directory, exist_ok=True)
+    path = os.path.join(archive_directory, f'{partition}.csv.gz')
+
+    raw_connection = DB.connection.connection
+    cursor = raw_connection.cursor()
+    try:
+        with gzip.open(path, 'wt') as f:
+            cursor.copy_expert(
+                f'COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)', f)
+    finally:
+        cursor.close()
+    logger.info(f'Archived {partition} to {path}')
+
+
+def apply_retention(DB: db, table: str, months: int, mode: str = 'drop'):
+    """Drop (after archiving if mode is 'archive') partitions entirely
+    older than months"""
+    assert mode in ['drop', 'archive'], \
+        f"Retention mode for {table} must be 'drop' or 'archive', not {mode}"
+
+    cutoff = month_start(pd.Timestamp.now(tz='UTC')) \
+        - pd.DateOffset(months=months)
+    for partition in partitions(DB, table):
+        month = pd.Timestamp(partition[-6:] + '01', tz='UTC')
+        if month >= cutoff:
+            break
+        if mode == 'archive':
+            _archive(DB, partition)
+        with DB.connection.begin():
+            DB.connection.execute(f'DROP TABLE {partition}')
+        logger.info(f'Dropped {partition}')
+
+
+def maintain():
+    """Partition, create partitions ahead and apply retention for every
+    table in partitioned_tables"""
+    logger.info('Running partitions.maintain()')
+
+    now = pd.Timestamp.now(tz='UTC')
+    for table in partitioned_tables:
+        try:
+            with db(**dbConfig) as DB:
+                partitioned = is_partitioned(DB, table)
+                if partitioned is None:
+                    # Not created yet, e.g. weather.forecast before the
+                    # first forecast is stored
+                    continue
+                if not partitioned:
+                    convert(DB, table)
+
+                # First, as partitions can't be created for months the
+                # default holds rows for
+                drain_default(DB, table)
+                with DB.connection.begin():
+                    _create_partitions(
+                        DB, table, now,
+                        now + pd.DateOffset(months=months_ahead))
+
+                if table in retention:
+                    apply_retention(DB, table, **retention[table])
+        except Exception as e:
+            logger.error(f'Partition maintenance failed for {table}: {e}')
+
+
+if __name__ == '__main__':
+    maintain()
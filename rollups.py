@@ -0,0 +1,301 @@
+"""Hourly and daily rollups of generation, consumption, export and cost
+
+rollup.hourly and rollup.daily hold the sum, mean, min, max and count of
+each source's values per bucket, and per series within a source (e.g. each
+inverter metric for generation). Read them with query() instead of
+aggregating the raw rows, as cost.summary does for the daily push.
+
+Rollups are kept up to date incrementally. Each source has a high-water
+mark, the latest raw time already rolled up, and refresh() only rebuilds
+buckets from the one containing the high-water mark onwards. Collectors
+call after_write() once they have written.
+
+Data arriving for times before the high-water mark (e.g. from backfill.py,
+or a second inverter reporting late) must be flagged with mark_stale(), so
+that refresh() also rebuilds the buckets it falls in. Writers that cannot
+tell whether their data is late flag everything they write.
+
+Hourly buckets are hours in UTC, so the hour repeated when the clocks go
+back is two buckets, and daily buckets are days in Europe/London. query()
+gives buckets in Europe/London.
+"""
+
+from typing import Optional
+
+import pandas as pd
+import sqlalchemy
+
+from config import dbConfig
+from db import db
+from logger import create_logger
+
+logger = create_logger('rollups')
+
+timezone = 'Europe/London'
+
+# Query giving ts, value and series fields for each source. Filters on
+# time are applied inside the query, so they reach the raw table's indexes
+# and partitions.
+sources = {
+    'generation': {
+        'table': 'microgen.readings',
+        'query': """
+            SELECT r.ts AS ts, r.value, r.tech_id || '.' || m.name AS series
+            FROM microgen.readings r
+            JOIN microgen.metrics m
+                ON m.id = r.metric_id
+            WHERE r.ts >= :start
+                AND r.ts < :end
+            """,
+    },
+    'consumption': {
+        'table': 'supply.consumption',
+        'query': """
+            SELECT interval_start AS ts, consumption AS value, '' AS series
+            FROM supply.consumption
+            WHERE interval_start >= :start
+                AND interval_start < :end
+            """,
+    },
+    'exported': {
+        'table': 'supply.exported',
+        'query': """
+            SELECT interval_start AS ts, consumption AS value, '' AS series
+            FROM supply.exported
+            WHERE interval_start >= :start
+                AND interval_start < :end
+            """,
+    },
+    # Written by cost.update(), one series per field
+    'cost': {
+        'table': 'supply.cost',
+        'query': """
+            SELECT c.interval_start AS ts, v.value, v.series
+            FROM supply.cost c
+            CROSS JOIN LATERAL (VALUES
+                ('import_cost', c.import_cost)
+                , ('export_revenue', c.export_revenue)
+                , ('self_consumed_value', c.self_consumed_value)
+                , ('net_cost', c.net_cost)) AS v (series, value)
+            WHERE c.interval_start >= :start
+                AND c.interval_start < :end
+            """,
+    },
+}
+
+with db(**dbConfig) as DB:
+    DB.create_schema('rollup')
+
+    DB.session.execute("""
+        CREATE TABLE IF NOT EXISTS rollup.hourly (
+            source VARCHAR(50)
+            , series VARCHAR(100)
+            , bucket TIMESTAMP WITH TIME ZONE
+            , sum DOUBLE PRECISION
+            , mean DOUBLE PRECISION
+            , min DOUBLE PRECISION
+            , max DOUBLE PRECISION
+            , count INT
+            , PRIMARY KEY (source, series, bucket)
+        );
+
+        CREATE TABLE IF NOT EXISTS rollup.daily (
+            LIKE rollup.hourly INCLUDING ALL
+        );
+
+        CREATE TABLE IF NOT EXISTS rollup.watermark (
+            source VARCHAR(50) PRIMARY KEY
+            , high_water TIMESTAMP WITH TIME ZONE
+            , refreshed_at TIMESTAMP WITH TIME ZONE
+        );
+
+        CREATE TABLE IF NOT EXISTS rollup.stale (
+            id SERIAL PRIMARY KEY
+            , source VARCHAR(50) NOT NULL
+            , range_start TIMESTAMP WITH TIME ZONE NOT NULL
+            , range_end TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+        """)
+    DB.session.commit()
+
+
+# Before any data, used when a source has no high-water mark yet
+epoch = pd.Timestamp(0, tz='UTC')
+# After any data, for ranges with no end
+end_of_time = pd.Timestamp('2200-01-01', tz='UTC')
+
+
+def _floor(time, freq: str) -> pd.Timestamp:
+    """Start of the hour ('H') or day ('D') containing time"""
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        time = time.tz_localize(timezone)
+    if freq == 'D':
+        return time.tz_convert(timezone).normalize()
+    return time.tz_convert('UTC').floor(pd.Timedelta(hours=1))
+
+
+def _ceil(time, freq: str) -> pd.Timestamp:
+    """Start of the hour or day after time, or time if it is a start"""
+    floor = _floor(time, freq)
+    if floor == pd.Timestamp(time):
+        return floor
+    return _floor(floor + pd.Timedelta(hours=25 if freq == 'D' else 1), freq)
+
+
+def mark_stale(source: str, start, end):
+    """Flag that data for source between start and end changed behind the
+    high-water mark, so its buckets are rebuilt on the next refresh"""
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(sqlalchemy.text("""
+                INSERT INTO rollup.stale (source, range_start, range_end)
+                VALUES (:source, :start, :end)
+                """), {'source': source, 'start': pd.Timestamp(start),
+                       'end': pd.Timestamp(end)})
+
+
+def _rebuild(DB: db, source: str, start: pd.Timestamp,
+             end: Optional[pd.Timestamp]):
+    """Recompute buckets from start (inclusive) to end (exclusive, None for
+    no limit)"""
+    params = {'source': source, 'tz': timezone}
+    upsert = """
+        ON CONFLICT (source, series, bucket) DO UPDATE
+        SET sum = EXCLUDED.sum
+            , mean = EXCLUDED.mean
+            , min = EXCLUDED.min
+            , max = EXCLUDED.max
+            , count = EXCLUDED.count
+        """
+
+    # Hourly buckets from the raw rows
+    DB.connection.execute(sqlalchemy.text(f"""
+        INSERT INTO rollup.hourly (
+            source, series, bucket, sum, mean, min, max, count)
+        SELECT :source
+            , series
+            , date_trunc('hour', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+                AS bucket
+            , SUM(value)
+            , AVG(value)
+            , MIN(value)
+            , MAX(value)
+            , COUNT(value)
+        FROM ({sources[source]['query']}) raw
+        GROUP BY series, bucket
+        {upsert}
+        """), {**params, 'start': _floor(start, 'H'),
+               'end': _ceil(end, 'H') if end is not None else end_of_time})
+
+    # Daily buckets from the hourly ones
+    DB.connection.execute(sqlalchemy.text(f"""
+        INSERT INTO rollup.daily (
+            source, series, bucket, sum, mean, min, max, count)
+        SELECT source
+            , series
+            , date_trunc('day', bucket AT TIME ZONE :tz) AT TIME ZONE :tz
+                AS day
+            , SUM(sum)
+            , SUM(sum) / NULLIF(SUM(count), 0)
+            , MIN(min)
+            , MAX(max)
+            , SUM(count)
+        FROM rollup.hourly
+        WHERE source = :source
+            AND bucket >= :start
+            AND bucket < :end
+        GROUP BY source, series, day
+        {upsert}
+        """), {**params, 'start': _floor(start, 'D'),
+               'end': _ceil(end, 'D') if end is not None else end_of_time})
+
+
+def refresh(source: str):
+    """Bring source's rollups up to date"""
+    spec = sources[source]
+    with db(**dbConfig) as DB:
+        schema, table = spec['table'].split('.')
+        if not DB.table_exists(table, schema):
+            return
+
+        with DB.connection.begin():
+            # One refresh of a source at a time
+            DB.connection.execute(sqlalchemy.text(
+                'SELECT pg_advisory_xact_lock(hashtext(:source))'),
+                {'source': source})
+
+            high_water = DB.connection.execute(sqlalchemy.text("""
+                SELECT high_water
+                FROM rollup.watermark
+                WHERE source = :source
+                """), {'source': source}).scalar()
+
+            stale = DB.connection.execute(sqlalchemy.text("""
+                DELETE FROM rollup.stale
+                WHERE source = :source
+                RETURNING range_start, range_end
+                """), {'source': source}).fetchall()
+
+            for row in stale:
+                _rebuild(DB, source, row['range_start'], row['range_end'])
+
+            # New data, from the bucket holding the high-water mark on
+            start = high_water if high_water is not None else epoch
+            _rebuild(DB, source, start, None)
+
+            DB.connection.execute(sqlalchemy.text(f"""
+                INSERT INTO rollup.watermark (
+                    source, high_water, refreshed_at)
+                SELECT :source, MAX(ts), CURRENT_TIMESTAMP
+                FROM ({spec['query']}) raw
+                ON CONFLICT (source) DO UPDATE
+                SET high_water = COALESCE(EXCLUDED.high_water,
+                                          rollup.watermark.high_water)
+                    , refreshed_at = EXCLUDED.refreshed_at
+                """), {'source': source, 'start': _floor(start, 'D'),
+                       'end': end_of_time})
+
+
+def after_write(*sources: str):
+    """Refresh sources after a collector has written to them. Failures are
+    logged rather than raised, so they never fail the collector."""
+    for source in sources:
+        try:
+            refresh(source)
+        except Exception as e:
+            logger.error(f'Failed to refresh {source} rollups: {e}')
+
+
+def query(source: str, granularity: str, start, end,
+          series: Optional[str] = None) -> pd.DataFrame:
+    """Rollups of source between start and end
+
+    Args:
+        source (str): e.g. 'consumption'
+        granularity (str): 'hourly' or 'daily'
+        start: From, inclusive
+        end: To, exclusive
+        series (str, optional): Only this series, e.g. '1.acpower' for generation. Defaults to all.
+
+    Returns:
+        pd.DataFrame: series, bucket (in Europe/London), sum, mean, min, max and count fields
+    """
+    assert granularity in ['hourly', 'daily'], \
+        f"granularity must be 'hourly' or 'daily', not {granularity}"
+
+    with db(**dbConfig) as DB:
+        rollup = pd.read_sql(sqlalchemy.text(f"""
+            SELECT series, bucket, sum, mean, min, max, count
+            FROM rollup.{granularity}
+            WHERE source = :source
+                AND bucket >= :start
+                AND bucket < :end
+                AND (CAST(:series AS VARCHAR) IS NULL OR series = :series)
+            ORDER BY series, bucket
+            """), DB.connection, params={
+                'source': source, 'start': pd.Timestamp(start),
+                'end': pd.Timestamp(end), 'series': series})
+    rollup['bucket'] = pd.to_datetime(rollup['bucket'], utc=True
+                                      ).dt.tz_convert(timezone)
+    return rollup
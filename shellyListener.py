@@ -0,0 +1,231 @@
+"""Listen for relay state pushed by Shelly devices on the local network
+
+Shelly (Gen1) devices report their relay state as it changes, either to an
+MQTT broker (topic shellies/<mqtt_id>/relay/0, payload "on"/"off") or by
+CoIoT, CoAP status messages multicast over UDP. The listeners here feed
+those reports into the device shadow (see action.Device_Shadow), which
+keeps the state current and persists changes to action.device_state.
+While a listener is running, Shelly.turn waits for the pushed state change
+of devices it hears from instead of relying on the HTTP response, and
+Shelly.status reads their shadow instead of polling the device.
+
+Devices are matched through optional keys on each Shelly in the devices
+file: mqtt_id (e.g. "shelly1-ABCDEF") and coiot_id (e.g. "ABCDEF").
+
+MQTT support needs paho-mqtt 2 or later. Both listeners are configured
+under switchCloudControl['listener'] in config.json, e.g.
+    {"mqtt": {"host": "localhost", "port": 1883}, "coiot": true}
+"""
+
+import json
+import socket
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from action import registry, shadow, Shelly
+from config import switchCloudControl
+from logger import create_logger
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+logger = create_logger('shellyListener')
+
+listenerConfig = switchCloudControl.get('listener', {})
+
+coiot_group = '224.0.1.187'
+coiot_port = 5683
+# CoAP option holding "<device type>#<device id>#<CoIoT version>"
+coiot_device_option = 3332
+# CoIoT sensor ids for the state of relay 0 (CoIoT v1 and v2)
+coiot_relay_sensors = {112, 1101}
+
+
+def devices_by(key: str) -> Dict[str, str]:
+    """Map the given devices file key (e.g. mqtt_id) to Shelly device_id"""
+    return {device[key]: device_id
+            for device_id, device in registry.devices.get(
+                Shelly.device_type, {}).items()
+            if key in device}
+
+
+def parse_coap(packet: bytes) -> Tuple[Dict[int, List[bytes]], bytes]:
+    """Split a CoAP message into its options and payload
+
+    Returns:
+        Tuple[Dict[int, List[bytes]], bytes]: option values by option number, and the payload
+    """
+    if len(packet) < 4 or packet[0] >> 6 != 1:
+        raise ValueError('Not a CoAP message')
+
+    token_length = packet[0] & 0x0F
+    i = 4 + token_length
+    options = {}
+    number = 0
+    while i < len(packet) and packet[i] != 0xFF:
+        delta, length = packet[i] >> 4, packet[i] & 0x0F
+        i += 1
+        # Values 13 and 14 mean the real value follows in 1 or 2 bytes
+        if delta == 13:
+            delta = packet[i] + 13
+            i += 1
+        elif delta == 14:
+            delta = struct.unpack('!H', packet[i:i + 2])[0] + 269
+            i += 2
+        if length == 13:
+            length = packet[i] + 13
+            i += 1
+        elif length == 14:
+            length = struct.unpack('!H', packet[i:i + 2])[0] + 269
+            i += 2
+
+        number += delta
+        options.setdefault(number, []).append(packet[i:i + length])
+        i += length
+
+    payload = packet[i + 1:] if i < len(packet) else b''
+    return options, payload
+
+
+def parse_coiot(packet: bytes) -> Optional[Tuple[str, bool]]:
+    """CoIoT id and relay state from a CoIoT status message, if present"""
+    options, payload = parse_coap(packet)
+    if coiot_device_option not in options or not payload:
+        return None
+
+    coiot_id = options[coiot_device_option][0].decode().split('#')[1]
+    for channel, sensor, value in json.loads(payload).get('G', []):
+        if sensor in coiot_relay_sensors:
+            return coiot_id, bool(value)
+    return None
+
+
+class CoIoTListener:
+    """Receive CoIoT status multicasts from Shelly devices"""
+
+    # Devices file key of the devices this listener hears from
+    key = 'coiot_id'
+
+    def __init__(self, group: str = coiot_group, port: int = coiot_port):
+        self.group = group
+        self.port = port
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        membership = struct.pack('4sl', socket.inet_aton(self.group),
+                                 socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        membership)
+        sock.settimeout(1)
+        return sock
+
+    def handle(self, packet: bytes):
+        try:
+            report = parse_coiot(packet)
+        except (ValueError, IndexError, KeyError, UnicodeDecodeError,
+                json.JSONDecodeError, struct.error):
+            return
+        if report is None:
+            return
+
+        coiot_id, is_on = report
+        device_id = devices_by('coiot_id').get(coiot_id)
+        if device_id is not None:
+            shadow.update(Shelly.device_type, device_id, is_on)
+
+    def _run(self):
+        with self._socket() as sock:
+            while not self._stop.is_set():
+                try:
+                    packet, _ = sock.recvfrom(4096)
+                except socket.timeout:
+                    continue
+                self.handle(packet)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='CoIoTListener')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+class MQTTListener:
+    """Subscribe to relay state published by Shelly devices to MQTT"""
+
+    topic = 'shellies/+/relay/0'
+    key = 'mqtt_id'
+
+    def __init__(self, host: str, port: int = 1883,
+                 username: Optional[str] = None,
+                 password: Optional[str] = None):
+        assert mqtt is not None, \
+            "paho-mqtt must be installed to listen to Shelly devices over MQTT"
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.host = host
+        self.port = port
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        # (Re)subscribe whenever the connection is made
+        if reason_code.is_failure:
+            logger.warning(f'Unable to connect to MQTT broker {self.host}: '
+                           f'{reason_code}')
+            return
+        client.subscribe(self.topic)
+
+    def on_message(self, client, userdata, message):
+        mqtt_id = message.topic.split('/')[1]
+        payload = message.payload.decode().strip()
+        if payload not in ['on', 'off']:
+            # e.g. "overpower"
+            return
+
+        device_id = devices_by('mqtt_id').get(mqtt_id)
+        if device_id is not None:
+            shadow.update(Shelly.device_type, device_id, payload == 'on')
+
+    def start(self):
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class ShellyListener:
+    """Run the listeners enabled in config and flag which devices push state"""
+
+    def __init__(self, config: dict = listenerConfig):
+        self.listeners = []
+        if config.get('coiot', False):
+            self.listeners.append(CoIoTListener())
+        if 'mqtt' in config:
+            self.listeners.append(MQTTListener(**config['mqtt']))
+
+    def start(self):
+        for listener in self.listeners:
+            listener.start()
+        shadow.push_keys = {listener.key for listener in self.listeners}
+
+    def stop(self):
+        shadow.push_keys = set()
+        for listener in self.listeners:
+            listener.stop()
@@ -7,7 +7,9 @@ import requests
 from config import electricalSupplier, dbConfig
 from db import db
 from logger import create_logger
+import cost
 import octopus_tariff_app as octopus
+import rollups
 
 logger = create_logger('supply')
 
@@ -41,17 +43,47 @@ class supplier:
         if self.supplier == 'Octopus Energy':
             return octopus.get_export
 
+    @property
+    def iter_usage(self):
+        if self.supplier == 'Octopus Energy':
+            return octopus.iter_usage
+
+    @property
+    def iter_export(self):
+        if self.supplier == 'Octopus Energy':
+            return octopus.iter_export
+
+    def watermark(self, tableName: str):
+        """Start of the latest interval already stored, None if no data"""
+        if not self.DB.table_exists(tableName, 'supply'):
+            return None
+        return self.DB.connection.execute(f"""
+            SELECT MAX(interval_start)
+            FROM supply.{tableName}
+            """).scalar()
+
     def getFreshCut(self):
         logger.info('Running supplier().getFreshCut()')
 
         tariff = self.get_tariff(electricalSupplier['productRef'])
         self.DB.dataframe_to_table(tariff, 'tariff', schema='supply',
-                                   dedup=True)
+                                   upsert_keys=['valid_from'],
+                                   upsert_update=True)
 
-        usage = self.get_usage()
-        self.DB.dataframe_to_table(usage, 'consumption', schema='supply',
-                                   dedup=True)
+        # Only fetch intervals from the latest one stored (which is fetched
+        # again in case it has been revised) and write each page as it
+        # arrives
+        for tableName, fetch in [('consumption', self.iter_usage),
+                                 ('exported', self.iter_export)]:
+            try:
+                for usage in fetch(period_from=self.watermark(tableName)):
+                    self.DB.dataframe_to_table(
+                        usage, tableName, schema='supply',
+                        upsert_keys=['interval_start'], upsert_update=True)
+            except requests.exceptions.RequestException as e:
+                # The pages written so far are kept, the rest are fetched
+                # next time
+                logger.error(f'Unable to fetch {tableName}: {e}')
 
-        export = self.get_export()
-        self.DB.dataframe_to_table(export, 'exported', schema='supply',
-                                   dedup=True)
+        rollups.after_write('consumption', 'exported')
+        cost.update()
@@ -0,0 +1,223 @@
+"""Schedule devices into the cheapest tariff slots
+
+Each device needs a number of slots of running before a deadline, either in
+one contiguous block or in runs of at least min_run slots. Devices are
+placed one at a time, tightest deadline first, on numpy arrays of slot
+prices: block costs for every start slot come from a cumulative sum, so
+placing a device is a handful of array operations however many slots there
+are. Slots where a device would take the household over power_cap_kw are
+unavailable to it.
+
+Consecutive slots chosen for a device are merged into a single on/off pair
+of actions, and the actions for every device are written in one bulk call.
+"""
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import dbConfig, electricalSupplier
+from db import db
+from logger import create_logger
+
+logger = create_logger('tariff_scheduler')
+
+
+class Schedulable:
+    def __init__(self, device_id: str, device_type: str = 'Shelly',
+                 slots: Optional[int] = None,
+                 energy_kwh: Optional[float] = None, power_kw: float = 3,
+                 deadline: Optional[pd.Timestamp] = None,
+                 min_run: int = 1, contiguous: bool = False):
+        """
+        Args:
+            device_id (str): Device to switch, as in the devices file
+            device_type (str, optional): Name in action.device_type. Defaults to 'Shelly'.
+            slots (int, optional): Slots of running needed. Calculated from energy_kwh if not given.
+            energy_kwh (float, optional): Energy needed, used if slots is not given
+            power_kw (float, optional): Power drawn while on. Defaults to 3.
+            deadline (pd.Timestamp, optional): Time by which the device must have finished. Defaults to the end of the tariff.
+            min_run (int, optional): Shortest run in slots, to avoid short cycling. Defaults to 1.
+            contiguous (bool, optional): Run in a single block. Defaults to False.
+        """
+        assert slots is not None or energy_kwh is not None, \
+            f'{device_id} needs either slots or energy_kwh to be scheduled'
+
+        self.device_id = device_id
+        self.device_type = device_type
+        self.slots = slots
+        self.energy_kwh = energy_kwh
+        self.power_kw = power_kw
+        self.deadline = deadline
+        self.min_run = max(1, min_run)
+        self.contiguous = contiguous
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'Schedulable':
+        """Deadlines in config are a time of day, e.g. "07:00", and mean
+        its next occurrence"""
+        config = dict(config)
+        if config.get('deadline') is not None:
+            now = pd.Timestamp.now(tz='Europe/London')
+            deadline = pd.Timestamp.combine(
+                now.date(), pd.Timestamp(config['deadline']).time()
+            ).tz_localize('Europe/London')
+            if deadline <= now:
+                deadline += pd.Timedelta(days=1)
+            config['deadline'] = deadline
+        return cls(**config)
+
+    def slots_needed(self, slot_hours: float) -> int:
+        if self.slots is not None:
+            return int(self.slots)
+        return int(np.ceil(self.energy_kwh / (self.power_kw * slot_hours)))
+
+
+def _block_costs(prices: np.ndarray, length: int) -> np.ndarray:
+    """Cost of the block of length slots starting at each slot
+
+    Blocks containing an unavailable (inf) slot cost inf.
+    """
+    unavailable = np.isinf(prices)
+    costs = np.concatenate([[0], np.cumsum(np.where(unavailable, 0, prices))])
+    blocked = np.concatenate([[0], np.cumsum(unavailable)])
+    sums = costs[length:] - costs[:-length]
+    return np.where(blocked[length:] - blocked[:-length] > 0, np.inf, sums)
+
+
+def _choose(prices: np.ndarray, needed: int, min_run: int,
+            contiguous: bool) -> np.ndarray:
+    """Slots to run in, as a boolean mask. Unavailable slots are inf."""
+    chosen = np.zeros(len(prices), dtype=bool)
+    available = int(np.isfinite(prices).sum())
+    if needed <= 0 or available == 0:
+        return chosen
+
+    if contiguous:
+        length = min(needed, len(prices))
+        costs = _block_costs(prices, length)
+        start = int(np.argmin(costs))
+        if np.isfinite(costs[start]):
+            chosen[start:start + length] = True
+        return chosen
+
+    if min_run == 1:
+        cheapest = np.argsort(prices, kind='stable')[:min(needed, available)]
+        chosen[cheapest] = True
+        return chosen
+
+    # Add the cheapest free block of min_run slots until enough are chosen.
+    # The last block may take the total over needed by up to min_run - 1.
+    prices = prices.copy()
+    while chosen.sum() < needed and min_run <= len(prices):
+        costs = _block_costs(prices, min_run)
+        start = int(np.argmin(costs))
+        if not np.isfinite(costs[start]):
+            break
+        chosen[start:start + min_run] = True
+        prices[start:start + min_run] = np.inf
+    return chosen
+
+
+def _runs(chosen: np.ndarray) -> np.ndarray:
+    """(first slot, slot after last) of each run of chosen slots"""
+    edges = np.diff(np.concatenate([[0], chosen.astype(np.int8), [0]]))
+    return np.column_stack([np.flatnonzero(edges == 1),
+                            np.flatnonzero(edges == -1)])
+
+
+def _no_actions() -> pd.DataFrame:
+    return pd.DataFrame(columns=['action_time', 'action', 'device_id',
+                                 'device_type'])
+
+
+def schedule(tariff: pd.DataFrame, devices: List[Schedulable],
+             power_cap_kw: float = np.inf, price: str = 'value_inc_vat'
+             ) -> pd.DataFrame:
+    """Choose when each device runs
+
+    Args:
+        tariff (pd.DataFrame): Future slots with valid_from, valid_to and price fields
+        devices (List[Schedulable]): Devices to schedule
+        power_cap_kw (float, optional): Most power all scheduled devices may draw at once. Defaults to no limit.
+        price (str, optional): Price field. Defaults to 'value_inc_vat'.
+
+    Returns:
+        pd.DataFrame: Actions with action_time, action, device_id and device_type (name) fields
+    """
+    if len(tariff) == 0:
+        # No slots to size energy_kwh against or to run in
+        logger.warning('No future tariff slots, nothing scheduled')
+        return _no_actions()
+
+    tariff = tariff.sort_values('valid_from')
+    prices = tariff[price].to_numpy(dtype=float)
+    starts = tariff['valid_from']
+    ends = tariff['valid_to']
+    # Compare times as integers rather than Timestamps
+    ends_ns = ends.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    slot_hours = (ends - starts).median() / pd.Timedelta(hours=1)
+
+    def deadline_ns(device: Schedulable) -> int:
+        if device.deadline is None:
+            return ends_ns.max() if len(ends_ns) else 0
+        return pd.Timestamp(device.deadline).value
+
+    load = np.zeros(len(prices))
+    on, off, device_ids, device_types = [], [], [], []
+    for device in sorted(devices, key=deadline_ns):
+        device_prices = np.where(
+            (ends_ns > deadline_ns(device))
+            | (load + device.power_kw > power_cap_kw), np.inf, prices)
+
+        needed = device.slots_needed(slot_hours)
+        chosen = _choose(device_prices, needed, device.min_run,
+                         device.contiguous)
+        if chosen.sum() < needed:
+            logger.warning(f'Only {chosen.sum()} of {needed} slots could be '
+                           f'scheduled for {device.device_id}')
+        load[chosen] += device.power_kw
+
+        runs = _runs(chosen)
+        on.append(runs[:, 0])
+        off.append(runs[:, 1] - 1)
+        device_ids += [device.device_id] * len(runs)
+        device_types += [device.device_type] * len(runs)
+
+    if len(device_ids) == 0:
+        return _no_actions()
+
+    on, off = np.concatenate(on), np.concatenate(off)
+    return pd.DataFrame({
+        'action_time': pd.concat([starts.iloc[on], ends.iloc[off]],
+                                 ignore_index=True),
+        'action': ['on'] * len(on) + ['off'] * len(off),
+        'device_id': device_ids * 2,
+        'device_type': device_types * 2,
+    }).sort_values(['device_id', 'action_time'], ignore_index=True)
+
+
+def configured_devices() -> List[Schedulable]:
+    """Devices from electricalSupplier['scheduled_devices'] in config.json
+
+    Falls back to the immersion running for auto_immersion_periods slots.
+    """
+    if 'scheduled_devices' in electricalSupplier:
+        return [Schedulable.from_config(device)
+                for device in electricalSupplier['scheduled_devices']]
+    return [Schedulable('Immersion', 'Shelly',
+                        slots=electricalSupplier['auto_immersion_periods'])]
+
+
+def write_actions(actions: pd.DataFrame):
+    """Write scheduled actions to action.action in one bulk write"""
+    if len(actions) == 0:
+        return
+
+    with db(**dbConfig) as DB:
+        device_type = DB.lookup_table('device_type', 'action', index='id')
+        actions = actions.assign(device_type=[
+            device_type[name].value for name in actions['device_type']])
+
+        DB.dataframe_to_table(actions, 'action', schema='action')
@@ -0,0 +1,151 @@
+"""Shared setup for the tests
+
+The modules read config.json from the working directory and create their
+tables when imported, so the tests need a PostgreSQL database of their own.
+Give its dbConfig (as in config.json) in the TEST_DB_CONFIG environment
+variable, e.g.
+
+    TEST_DB_CONFIG='{"server": "localhost", "database": "smart_home_test",
+                     "username": "postgres", "password": "...",
+                     "dbType": "PostgreSQL"}' python -m pytest tests
+
+Without it the tests are skipped. The tests write to the database, so never
+point it at a live one.
+
+A config.json for that database is written to a temporary directory, which
+the tests run in. APIs are replaced by FakeAPI, a local HTTP server.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+test_db = os.environ.get('TEST_DB_CONFIG')
+
+if test_db is None:
+    collect_ignore_glob = ['test_*.py']
+else:
+    directory = tempfile.mkdtemp(prefix='smart_home_test_')
+
+    # immersion pushes its state over MQTT and CoIoT, heater doesn't
+    devices = {'Shelly': {
+        'immersion': {'endpoint': 'http://127.0.0.1:1/', 'username': 'user',
+                      'password': 'password', 'mqtt_id': 'shelly1-ABCDEF',
+                      'coiot_id': 'ABCDEF'},
+        'heater': {'endpoint': 'http://127.0.0.1:1/', 'username': 'user',
+                   'password': 'password'}}}
+    with open(os.path.join(directory, 'devices.json'), 'w') as f:
+        json.dump(devices, f)
+
+    config = {
+        'dbConfig': json.loads(test_db),
+        'logConfig': {'log_to_db': False,
+                      'log_file_path': os.path.join(directory, 'log.txt'),
+                      'log_error_level': 'INFO', 'push_errors': False,
+                      'log_exceptions': False},
+        'pushNotifications': {'client': 'client', 'token': 'token'},
+        'electricalSupplier': {'supplier': 'Octopus Energy',
+                               'API_URL': 'http://127.0.0.1:1',
+                               'key': 'key', 'productRef': 'AGILE-18-02-21',
+                               'MPAN': '1000000000000',
+                               'MPAN_export': '1000000000001',
+                               'serialNo': '00A0000000',
+                               'export_rate': 15,
+                               'cache': {'directory': os.path.join(
+                                   directory, 'cache'), 'ttl_seconds': 0}},
+        'switchCloudControl': {'config_file': os.path.join(
+            directory, 'devices.json')},
+        'openWeather': {'key': 'key'},
+        'lat': 51.5,
+        'lon': -0.1,
+        'microgen': [],
+        'backfill': {'default_rate': 1000},
+    }
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+    os.chdir(directory)
+    sys.path.insert(0, repo)
+
+
+Route = Callable[[Dict[str, str]], Tuple[int, Optional[dict]]]
+
+
+class FakeAPI:
+    """Local HTTP server standing in for a JSON API
+
+    Each route is a function taking the query (or form) parameters and
+    returning a status code and JSON body. A body of None drops the
+    connection without responding, as an unreachable API would.
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, Route] = {}
+        # (path, query parameters) of every request, in order
+        self.requests: List[Tuple[str, Dict[str, str]]] = []
+        self._lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                self.respond(url.path, url.query)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.respond(urlparse(self.path).path,
+                             self.rfile.read(length).decode())
+
+            def respond(self, path: str, query: str):
+                params = {key: values[0]
+                          for key, values in parse_qs(query).items()}
+                with api._lock:
+                    api.requests.append((path, params))
+
+                route = api.routes.get(path)
+                status, body = route(params) if route else (404, {})
+                if body is None:
+                    self.close_connection = True
+                    return
+
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def requested(self, path: str) -> List[Dict[str, str]]:
+        """Query parameters of each request made to path"""
+        with self._lock:
+            return [params for p, params in self.requests if p == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_api():
+    api = FakeAPI()
+    yield api
+    api.close()
@@ -0,0 +1,221 @@
+import threading
+import time
+
+import pytest
+import sqlalchemy
+
+import action
+from config import dbConfig
+from db import db
+from action import registry, shadow, Shelly
+
+
+@pytest.fixture
+def relay(fake_api, monkeypatch):
+    """Shelly relay endpoint on the fake API, used by every Shelly"""
+    state = {'ison': False}
+
+    def relay_0(params):
+        if params.get('turn') == 'toggle':
+            state['ison'] = not state['ison']
+        elif 'turn' in params:
+            state['ison'] = params['turn'] == 'on'
+        return 200, state
+
+    fake_api.routes['/relay/0'] = relay_0
+    for device in registry.devices[Shelly.device_type].values():
+        monkeypatch.setitem(device, 'endpoint', f'{fake_api.url}/')
+    for device_id in registry.devices[Shelly.device_type]:
+        shadow.invalidate(Shelly.device_type, device_id)
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(sqlalchemy.text("""
+                DELETE FROM action.device_state
+                WHERE device_type = :device_type
+                """), {'device_type': Shelly.device_type})
+    return state
+
+
+@pytest.fixture
+def listening(monkeypatch):
+    """As if MQTT and CoIoT listeners were running"""
+    monkeypatch.setattr(shadow, 'push_keys', {'mqtt_id', 'coiot_id'})
+    monkeypatch.setattr(action, 'push_timeout', 1)
+
+
+def test_turn_without_push_does_not_wait(relay, listening):
+    heater = Shelly('heater')
+    assert not heater.pushes_state
+
+    start = time.monotonic()
+    heater.on()
+
+    assert time.monotonic() - start < action.push_timeout
+    assert relay['ison']
+    assert shadow.get(Shelly.device_type, 'heater') is True
+
+
+def test_turn_waits_for_pushed_state(relay, listening):
+    immersion = Shelly('immersion')
+    assert immersion.pushes_state
+
+    # Nothing is pushed, so it waits for push_timeout and then falls back
+    # to the response
+    start = time.monotonic()
+    immersion.on()
+
+    assert time.monotonic() - start >= action.push_timeout
+    assert shadow.get(Shelly.device_type, 'immersion') is True
+
+
+def test_no_device_pushes_without_listeners(relay):
+    assert not Shelly('immersion').pushes_state
+
+
+def test_turn_reads_state_saved_by_other_replicas(relay, fake_api):
+    heater = Shelly('heater')
+    heater.off()
+    assert shadow.get(Shelly.device_type, 'heater') is False
+
+    # Another replica switches the heater on
+    relay['ison'] = True
+    shadow._persist(Shelly.device_type, 'heater', True, time.time())
+
+    heater.off()
+    assert [params['turn'] for params in fake_api.requested('/relay/0')
+            if 'turn' in params] == ['off', 'off']
+    assert not relay['ison']
+
+
+@pytest.fixture
+def due_actions():
+    """Two due actions for the immersion, and one for the heater"""
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DELETE FROM action.action')
+            DB.connection.execute(sqlalchemy.text("""
+                INSERT INTO action.action (
+                    action_time, device_type, device_id, action)
+                VALUES
+                    (CURRENT_TIMESTAMP - INTERVAL '2 minutes', :shelly,
+                     'immersion', 'on')
+                    , (CURRENT_TIMESTAMP - INTERVAL '1 minute', :shelly,
+                       'immersion', 'off')
+                    , (CURRENT_TIMESTAMP - INTERVAL '1 minute', :shelly,
+                       'heater', 'on')
+                """), {'shelly': action.action.Device_type.Shelly.value})
+    yield
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DELETE FROM action.action')
+
+
+def test_claim_actions(due_actions):
+    claimed = action.action().claim_actions()
+
+    assert claimed['device_id'].tolist() == ['immersion', 'immersion',
+                                             'heater']
+    # Leased, so not claimed again
+    assert len(action.action().claim_actions()) == 0
+
+
+def test_claim_skips_devices_being_claimed(due_actions):
+    # Another worker part way through claiming the immersion's first
+    # action, its lease not yet committed
+    with db(**dbConfig) as other:
+        with other.connection.begin():
+            other.connection.execute("""
+                SELECT pg_advisory_xact_lock(hashtext('action.action'),
+                                             hashtext('immersion'))""")
+            other.connection.execute("""
+                SELECT action_id
+                FROM action.action
+                WHERE device_id = 'immersion'
+                ORDER BY action_time
+                LIMIT 1
+                FOR UPDATE""")
+
+            claimed = action.action().claim_actions()
+
+    assert claimed['device_id'].tolist() == ['heater']
+
+
+def statuses() -> dict:
+    with db(**dbConfig) as DB:
+        return {(row['device_id'], row['action']): (
+                    row['status'], row['claimed_by'] is not None)
+                for row in DB.connection.execute("""
+                    SELECT device_id, action, status, claimed_by
+                    FROM action.action""")}
+
+
+def test_dispatch_timeout_leaves_actions_pending(relay, fake_api, due_actions,
+                                                 monkeypatch):
+    # The immersion hangs on its first action
+    def slow_relay_0(params):
+        time.sleep(2)
+        return 200, {'ison': params.get('turn') == 'on'}
+
+    fake_api.routes['/slow/relay/0'] = slow_relay_0
+    monkeypatch.setitem(registry.devices[Shelly.device_type]['immersion'],
+                        'endpoint', f'{fake_api.url}/slow/')
+    monkeypatch.setattr(action, 'dispatch_timeout', 0.5)
+
+    action.action().execute_todo()
+    time.sleep(2.5)
+
+    success = action.action.Status.Success.value
+    assert statuses() == {
+        ('heater', 'on'): (success, True),
+        # Still running, so left leased for the lease to expire
+        ('immersion', 'on'): (None, True),
+        # Never started, so returned to the queue
+        ('immersion', 'off'): (None, False)}
+    # The second action wasn't sent once execute_todo had given up
+    assert [params['turn'] for params
+            in fake_api.requested('/slow/relay/0')] == ['on']
+
+
+class SlowDevice:
+    """Device client whose creation (e.g. a cloud login) takes a while"""
+    device_type = 'Slow'
+    created = []
+
+    def __init__(self, device_id: str):
+        if device_id == 'broken':
+            raise ConnectionError('Login failed')
+        time.sleep(1 if device_id == 'slow' else 0.1)
+        self.created.append(device_id)
+
+
+def test_slow_device_creation_times_out(monkeypatch):
+    monkeypatch.setattr(action, 'login_timeout', 0.5)
+    SlowDevice.created.clear()
+
+    errors = []
+
+    def get_slow():
+        try:
+            registry.get_device(SlowDevice, 'slow')
+        except TimeoutError as e:
+            errors.append(e)
+
+    slow = threading.Thread(target=get_slow)
+    slow.start()
+    time.sleep(0.1)
+
+    # Not held up by the slow login
+    start = time.monotonic()
+    registry.get_device(SlowDevice, 'quick')
+    assert time.monotonic() - start < 0.5
+    slow.join()
+    assert len(errors) == 1
+
+    with pytest.raises(ConnectionError):
+        registry.get_device(SlowDevice, 'broken')
+    # The slow device finishes being created in the background, but isn't
+    # kept, as the caller gave up on it
+    time.sleep(1)
+    assert SlowDevice.created == ['quick', 'slow']
+    assert registry.get_device(SlowDevice, 'quick') is \
+        registry.get_device(SlowDevice, 'quick')
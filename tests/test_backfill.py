@@ -0,0 +1,199 @@
+import pandas as pd
+import pytest
+import requests
+import sqlalchemy
+
+import backfill
+import octopus_tariff_app as octopus
+from config import dbConfig, electricalSupplier
+from db import db
+
+start = pd.Timestamp('2021-03-01', tz='UTC')
+end = start + pd.Timedelta(days=3)
+# Smaller than a window, so every window is fetched in several pages
+page_size = 20
+
+
+@pytest.fixture
+def api(fake_api, monkeypatch):
+    """Fake Octopus API serving half hourly consumption for any period
+
+    Requests with a period_from in api.fail get a 500 once.
+    """
+    monkeypatch.setitem(electricalSupplier, 'API_URL', fake_api.url)
+    path = (f"/electricity-meter-points/{electricalSupplier['MPAN']}"
+            f"/meters/{electricalSupplier['serialNo']}/consumption/")
+    fake_api.consumption_path = path
+    fake_api.fail = set()
+
+    def consumption(params):
+        if params['period_from'] in fake_api.fail:
+            fake_api.fail.discard(params['period_from'])
+            return 500, {'detail': 'Server error'}
+
+        intervals = pd.date_range(params['period_from'],
+                                  params['period_to'], freq='30min')[:-1]
+        page = int(params.get('page', 1))
+        results = intervals[(page - 1) * page_size:page * page_size]
+        next_page = None
+        if page * page_size < len(intervals):
+            next_page = (f"{fake_api.url}{path}"
+                         f"?period_from={params['period_from']}"
+                         f"&period_to={params['period_to']}&page={page + 1}")
+        return 200, {'count': len(intervals), 'next': next_page,
+                     'results': [{'consumption': 0.5,
+                                  'interval_start': t.isoformat(),
+                                  'interval_end': (
+                                      t + pd.Timedelta('30min')).isoformat()}
+                                 for t in results]}
+
+    fake_api.routes[path] = consumption
+    return fake_api
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DELETE FROM backfill.checkpoint')
+            for table in ['consumption', 'tariff']:
+                if DB.table_exists(table, 'supply'):
+                    DB.connection.execute(f'DELETE FROM supply.{table}')
+
+
+def consumption() -> pd.DataFrame:
+    with db(**dbConfig) as DB:
+        return pd.read_sql(sqlalchemy.text("""
+            SELECT interval_start, consumption
+            FROM supply.consumption
+            WHERE interval_start >= :start
+                AND interval_start < :end
+            ORDER BY interval_start
+            """), DB.connection, params={'start': start, 'end': end})
+
+
+def checkpointed(job: str) -> list:
+    return sorted(backfill.completed(job))
+
+
+def window_starts(requests: list) -> set:
+    """period_from of the first page of each window requested"""
+    return {pd.Timestamp(params['period_from']) for params in requests
+            if 'page' not in params}
+
+
+def test_windows():
+    assert backfill.windows(start, end, 1) == [
+        (start, start + pd.Timedelta(days=1)),
+        (start + pd.Timedelta(days=1), start + pd.Timedelta(days=2)),
+        (start + pd.Timedelta(days=2), end)]
+    # The last window is cut short at end
+    assert backfill.windows(start, end, 2)[-1] == (
+        start + pd.Timedelta(days=2), end)
+
+
+def test_backfill(api):
+    rows = backfill.run('consumption', start, end, window_days=1)
+
+    assert rows == 3 * 48
+    assert len(consumption()) == 3 * 48
+    assert checkpointed('consumption') == backfill.windows(start, end, 1)
+
+
+def test_resumes_from_checkpoint(api):
+    windows = backfill.windows(start, end, 1)
+    backfill.checkpoint('consumption', windows[0], 48)
+
+    rows = backfill.run('consumption', start, end, window_days=1)
+
+    assert rows == 2 * 48
+    assert window_starts(api.requested(api.consumption_path)) == {
+        window[0] for window in windows[1:]}
+    assert checkpointed('consumption') == windows
+
+
+def test_failed_window_is_retried(api):
+    windows = backfill.windows(start, end, 1)
+    api.fail.add(windows[1][0].strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    rows = backfill.run('consumption', start, end, window_days=1)
+
+    assert rows == 2 * 48
+    assert checkpointed('consumption') == [windows[0], windows[2]]
+
+    # Only the failed window is fetched again
+    api.requests.clear()
+    rows = backfill.run('consumption', start, end, window_days=1)
+
+    assert rows == 48
+    assert window_starts(api.requested(api.consumption_path)) == {
+        windows[1][0]}
+    assert checkpointed('consumption') == windows
+    assert len(consumption()) == 3 * 48
+
+
+def test_error_response_raises(api):
+    api.fail.add(start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    with pytest.raises(requests.HTTPError):
+        list(octopus.iter_usage(period_from=start, period_to=end))
+
+
+def test_rerun_is_idempotent(api):
+    backfill.run('consumption', start, end, window_days=1)
+    first = consumption()
+
+    # Fetch everything again
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DELETE FROM backfill.checkpoint')
+    backfill.run('consumption', start, end, window_days=1)
+
+    pd.testing.assert_frame_equal(consumption(), first)
+
+
+def test_rate_limits_every_page(api, monkeypatch):
+    acquired = []
+
+    class Limiter:
+        def acquire(self, url):
+            acquired.append(url)
+
+    monkeypatch.setattr(backfill, 'limiter', Limiter())
+    backfill.run('consumption', start, end, window_days=1)
+
+    # 48 intervals a window, in pages of 20
+    assert len(api.requested(api.consumption_path)) == 3 * 3
+    assert len(acquired) == 3 * 3
+
+
+def test_unreachable_tariff_window_is_not_checkpointed(api):
+    path = (f"/products/{electricalSupplier['productRef']}"
+            f"/electricity-tariffs/E-1R-{electricalSupplier['productRef']}-L"
+            f"/standard-unit-rates/")
+    # Drop the connection, as an unreachable API would
+    api.routes[path] = lambda params: (200, None)
+
+    assert backfill.run('tariff', start, end, window_days=1) == 0
+    assert checkpointed('tariff') == []
+
+
+def test_tariff_window_without_rates_is_checkpointed(api):
+    path = (f"/products/{electricalSupplier['productRef']}"
+            f"/electricity-tariffs/E-1R-{electricalSupplier['productRef']}-L"
+            f"/standard-unit-rates/")
+    api.routes[path] = lambda params: (200, {'count': 0, 'next': None,
+                                             'results': []})
+
+    assert backfill.run('tariff', start, end, window_days=1) == 0
+    assert len(checkpointed('tariff')) == 3
+
+
+def test_weather_older_than_history_is_skipped(monkeypatch):
+    def unavailable(day):
+        raise KeyError('hourly')
+
+    monkeypatch.setattr(backfill.OpenWeather, 'getHistory', unavailable)
+
+    assert backfill.run('weather', start, end, window_days=1) == 0
+    assert len(checkpointed('weather')) == 3
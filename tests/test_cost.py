@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cost
+from config import dbConfig
+from db import db
+
+start = pd.Timestamp('2021-03-01', tz='UTC')
+intervals = pd.date_range(start, periods=2 * 48, freq='30min')
+
+
+def usage(times: pd.DatetimeIndex, kwh: float) -> pd.DataFrame:
+    return pd.DataFrame({'interval_start': times,
+                         'interval_end': times + pd.Timedelta('30min'),
+                         'consumption': kwh})
+
+
+def tariff(times: pd.DatetimeIndex, rate: float) -> pd.DataFrame:
+    return pd.DataFrame({'valid_from': times,
+                         'valid_to': times + pd.Timedelta('30min'),
+                         'value_inc_vat': rate, 'value_exc_vat': rate})
+
+
+def write(df: pd.DataFrame, table: str, key: str):
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(df, table, schema='supply', upsert_keys=[key],
+                              upsert_update=True)
+
+
+def stored() -> pd.DataFrame:
+    with db(**dbConfig) as DB:
+        return pd.read_sql("""
+            SELECT interval_start, unit_rate, import_cost, export_revenue
+            FROM supply.cost
+            ORDER BY interval_start
+            """, DB.connection)
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            for table in ['consumption', 'exported', 'tariff', 'cost']:
+                if DB.table_exists(table, 'supply'):
+                    DB.connection.execute(f'DELETE FROM supply.{table}')
+
+
+def test_unit_rates():
+    rates = tariff(intervals[:48], 10.0)
+    rates.loc[47, 'valid_to'] = pd.NaT  # open ended
+
+    found = cost.unit_rates(pd.Series(intervals), rates)
+
+    assert (found[:48] == 10).all()
+    # The open ended rate applies from then on
+    assert (found[48:] == 10).all()
+    assert np.isnan(cost.unit_rates(pd.Series([start - pd.Timedelta('30min')]),
+                                    rates)).all()
+
+
+def test_costs_intervals_once_their_tariff_arrives():
+    write(usage(intervals, 2.0), 'consumption', 'interval_start')
+    write(usage(intervals, 1.0), 'exported', 'interval_start')
+    # Only the first day's rates are known
+    write(tariff(intervals[:48], 10.0), 'tariff', 'valid_from')
+
+    cost.update()
+
+    costs = stored()
+    assert len(costs) == 2 * 48
+    assert (costs['import_cost'][:48] == 20).all()
+    assert costs['import_cost'][48:].isna().all()
+    # Export is still counted for intervals without a unit rate
+    assert (costs['export_revenue'] == 15).all()
+
+    # The second day's rates are backfilled
+    write(tariff(intervals[48:], 20.0), 'tariff', 'valid_from')
+    cost.update()
+
+    costs = stored()
+    assert (costs['import_cost'][48:] == 40).all()
+
+
+def test_costs_usage_older_than_the_latest_interval():
+    write(tariff(intervals, 10.0), 'tariff', 'valid_from')
+    write(usage(intervals[48:], 2.0), 'consumption', 'interval_start')
+    cost.update()
+
+    # e.g. backfilled
+    write(usage(intervals[:48], 1.0), 'consumption', 'interval_start')
+    cost.update()
+
+    costs = stored()
+    assert len(costs) == 2 * 48
+    assert (costs['import_cost'][:48] == 10).all()
@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+from config import dbConfig
+from db import db
+
+schema = 'db_test'
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    yield
+    with db(**dbConfig) as DB:
+        DB.session.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        DB.session.commit()
+        DB.invalidate_catalog(schema)
+
+
+def frame(values: list) -> pd.DataFrame:
+    return pd.DataFrame({'id': range(len(values)), 'value': values})
+
+
+def rows(table: str) -> list:
+    with db(**dbConfig) as DB:
+        return [tuple(row) for row in DB.connection.execute(
+            f'SELECT id, value FROM {schema}.{table} ORDER BY id')]
+
+
+def behind_the_cache(sql: str):
+    """Change the database without the catalog cache knowing"""
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(sql)
+
+
+@pytest.mark.parametrize('upsert_keys', [None, ['id']])
+def test_write_after_table_dropped(upsert_keys):
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(frame([1.0]), 'dropped', schema,
+                              upsert_keys=upsert_keys)
+        behind_the_cache(f'DROP TABLE {schema}.dropped')
+
+        DB.dataframe_to_table(frame([2.0, 3.0]), 'dropped', schema,
+                              upsert_keys=upsert_keys)
+
+    assert rows('dropped') == [(0, 2.0), (1, 3.0)]
+
+
+def test_write_after_column_dropped():
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(frame([1.0]), 'altered', schema)
+        behind_the_cache(f'ALTER TABLE {schema}.altered DROP COLUMN value')
+
+        DB.dataframe_to_table(frame([2.0]), 'altered', schema)
+
+    assert rows('altered') == [(0, None), (0, 2.0)]
+
+
+def test_write_after_schema_dropped():
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(frame([1.0]), 'gone', schema)
+        behind_the_cache(f'DROP SCHEMA {schema} CASCADE')
+
+        DB.dataframe_to_table(frame([2.0]), 'gone', schema)
+
+    assert rows('gone') == [(0, 2.0)]
+
+
+def test_upsert_keeps_last_duplicate():
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(pd.DataFrame({'id': [0, 1, 0, 0],
+                                            'value': [1.0, 2.0, 3.0, 4.0]}),
+                              'duplicates', schema, upsert_keys=['id'])
+
+    assert rows('duplicates') == [(0, 4.0), (1, 2.0)]
@@ -0,0 +1,52 @@
+import pytest
+import requests
+
+import octopus_tariff_app
+from httpCache import HTTPCache
+
+rates = {'next': None, 'results': [
+    {'valid_from': '2023-06-01T00:00:00Z', 'valid_to': '2023-06-01T00:30:00Z',
+     'value_exc_vat': 10.0, 'value_inc_vat': 10.5}]}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HTTPCache(str(tmp_path), ttl=3600)
+
+
+def test_errors_are_raised_not_cached(fake_api, cache):
+    responses = [(500, {'detail': 'Server error'}), (200, {'ok': True})]
+    fake_api.routes['/data'] = lambda params: responses.pop(0)
+
+    with pytest.raises(requests.HTTPError):
+        cache.get(f'{fake_api.url}/data')
+    # Requested again, rather than served the error from the cache
+    assert cache.get(f'{fake_api.url}/data').json() == {'ok': True}
+    assert cache.get(f'{fake_api.url}/data').from_cache
+    assert len(fake_api.requested('/data')) == 2
+    assert cache.hit_rate()['errors'] == 1
+
+
+def test_not_modified_without_cached_entry(fake_api, cache):
+    fake_api.routes['/data'] = lambda params: (304, {})
+
+    with pytest.raises(requests.HTTPError):
+        cache.get(f'{fake_api.url}/data')
+
+
+def test_tariff_error_is_not_parsed(fake_api, monkeypatch, tmp_path):
+    monkeypatch.setitem(octopus_tariff_app.electricalSupplier, 'API_URL',
+                        fake_api.url)
+    monkeypatch.setattr(octopus_tariff_app, 'api_cache',
+                        HTTPCache(str(tmp_path), ttl=0))
+    monkeypatch.setattr(octopus_tariff_app, '_parsed_tariffs', {})
+    path = ('/products/AGILE-18-02-21/electricity-tariffs/'
+            'E-1R-AGILE-18-02-21-L/standard-unit-rates/')
+
+    fake_api.routes[path] = lambda params: (503, {'detail': 'Unavailable'})
+    assert octopus_tariff_app.get_tariff('AGILE-18-02-21') is None
+    assert octopus_tariff_app._parsed_tariffs == {}
+
+    fake_api.routes[path] = lambda params: (200, rates)
+    tariff = octopus_tariff_app.get_tariff('AGILE-18-02-21')
+    assert tariff['value_inc_vat'].tolist() == [10.5]
@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from config import dbConfig
+from logger import LogDBHandler, log_table
+
+
+def entry(i: int) -> dict:
+    return {'timestamp': '2023-06-01T12:00:00+00:00', 'logged_by': 'test',
+            'log_level': 20, 'log_level_name': 'INFO',
+            'log_message': f'Message {i}'}
+
+
+@pytest.fixture
+def handler(tmp_path):
+    handler = LogDBHandler(dbConfig, log_table, batch_size=2,
+                           spill_file=str(tmp_path / 'spill.jsonl'))
+    yield handler
+    handler.close()
+
+
+def spilled(handler: LogDBHandler) -> list:
+    with open(handler.spill_file) as f:
+        return [json.loads(line)['log_message'] for line in f]
+
+
+def test_spill_file_is_capped(handler):
+    handler.max_spill_bytes = 2 * len(json.dumps(entry(0)) + '\n')
+    handler._handle_overflow([entry(i) for i in range(3)])
+    handler._handle_overflow([entry(3)])
+
+    assert spilled(handler) == ['Message 0', 'Message 1']
+    assert handler.dropped == 2
+
+
+def test_failed_replay_keeps_unwritten_records(handler, monkeypatch):
+    handler._handle_overflow([entry(i) for i in range(5)])
+
+    written = []
+
+    def insert(batch):
+        if written:
+            raise ConnectionError('Database unavailable')
+        written.extend(batch)
+
+    monkeypatch.setattr(handler, '_insert', insert)
+    handler._replay_spill()
+
+    assert [e['log_message'] for e in written] == ['Message 0', 'Message 1']
+    assert spilled(handler) == ['Message 2', 'Message 3', 'Message 4']
+    assert not os.path.exists(handler.spill_file + '.replay')
+
+
+def test_interrupted_replay_is_finished(handler, monkeypatch):
+    # As left by a process stopped part way through a replay
+    with open(handler.spill_file + '.replay', 'w') as f:
+        for i in range(3):
+            f.write(json.dumps(entry(i)) + '\n')
+        f.write('{"timestamp": ')
+
+    written = []
+    monkeypatch.setattr(handler, '_insert', written.extend)
+    handler._replay_spill()
+
+    assert [e['log_message'] for e in written] == [
+        'Message 0', 'Message 1', 'Message 2']
+    assert handler.dropped == 1
+    assert not os.path.exists(handler.spill_file + '.replay')
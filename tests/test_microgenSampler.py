@@ -0,0 +1,118 @@
+import pandas as pd
+import pytest
+
+import microgenSampler
+from config import dbConfig
+from db import db
+from microGeneration import metric_ids
+from microgenSampler import RingBuffer, Sampler
+
+tableName = 'solar_samplertest_0'
+tech_id = 9100
+
+
+class FakeMicrogen:
+    tech_ids = {tableName: tech_id}
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    def delete():
+        with db(**dbConfig) as DB:
+            with DB.connection.begin():
+                for table in ['readings', 'readings_text']:
+                    DB.connection.execute(f"""
+                        DELETE FROM microgen.{table}
+                        WHERE tech_id = {tech_id}""")
+    delete()
+    yield
+    delete()
+
+
+def sample(minute: int, **fields) -> pd.DataFrame:
+    return pd.DataFrame({'uploadTime': [pd.Timestamp(
+        f'2023-06-01 12:{minute:02d}', tz='UTC')], **{
+            field: [value] for field, value in fields.items()}})
+
+
+def stored(table: str) -> set:
+    names = {id: name for name, id in metric_ids(
+        ['acpower', 'yieldtoday', 'inverterstatus']).items()}
+    with db(**dbConfig) as DB:
+        return {(row['ts'].minute, names[row['metric_id']], row['value'])
+                for row in DB.connection.execute(f"""
+                    SELECT ts, metric_id, value
+                    FROM microgen.{table}
+                    WHERE tech_id = {tech_id}""")}
+
+
+def test_ring_buffer_add_columns():
+    buffer = RingBuffer(3, ['a'])
+    buffer.append(1, [1.0])
+    buffer.add_columns(['b'])
+    buffer.append(2, [2.0, 3.0])
+
+    times, values = buffer.rows(0)
+    assert times.tolist() == [1, 2]
+    assert values[:, buffer.column('a')].tolist() == [1.0, 2.0]
+    assert pd.isna(values[0, buffer.column('b')])
+    assert values[1, buffer.column('b')] == 3.0
+
+
+def test_new_and_text_fields_are_written():
+    sampler = Sampler(FakeMicrogen(), capacity=10)
+    sampler.add(tableName, sample(0, acPower=100.0))
+    sampler.add(tableName, sample(1, acPower=110.0, yieldToday=1.5,
+                                  inverterStatus='102'))
+    sampler.flush()
+
+    assert sampler.latest(tableName, 'yieldToday')[1] == 1.5
+    assert stored('readings') == {(0, 'acpower', 100.0),
+                                  (1, 'acpower', 110.0),
+                                  (1, 'yieldtoday', 1.5)}
+    assert stored('readings_text') == {(1, 'inverterstatus', '102')}
+
+
+def test_overwritten_counted_once(monkeypatch):
+    sampler = Sampler(FakeMicrogen(), capacity=3)
+    for minute in range(5):
+        sampler.add(tableName, sample(minute, acPower=float(minute),
+                                      inverterStatus=str(minute)))
+
+    def unavailable(data, tech_id):
+        raise ConnectionError('Database unavailable')
+
+    monkeypatch.setattr(microgenSampler, 'write_readings', unavailable)
+    sampler.flush()
+    sampler.flush()
+    assert sampler.stats['overwritten'] == 2
+    assert sampler.stats['text_overwritten'] == 2
+
+    # Everything still held is kept through the failed writes
+    monkeypatch.undo()
+    sampler.flush()
+    assert sampler.stats['overwritten'] == 2
+    assert stored('readings_text') == {(minute, 'inverterstatus', str(minute))
+                                       for minute in [2, 3, 4]}
+    assert {minute for minute, _, _ in stored('readings')} == {2, 3, 4}
+
+
+def test_replaced_during_write_is_written(monkeypatch):
+    sampler = Sampler(FakeMicrogen(), capacity=10)
+    sampler.add(tableName, sample(0, acPower=100.0))
+    sampler.add(tableName, sample(1, acPower=110.0))
+
+    def replaced_while_writing(data, tech_id):
+        monkeypatch.undo()
+        sampler.add(tableName, sample(1, acPower=120.0))
+        microgenSampler.write_readings(data, tech_id)
+
+    monkeypatch.setattr(microgenSampler, 'write_readings',
+                        replaced_while_writing)
+    sampler.flush()
+    assert stored('readings') == {(0, 'acpower', 100.0),
+                                  (1, 'acpower', 110.0)}
+
+    sampler.flush()
+    assert stored('readings') == {(0, 'acpower', 100.0),
+                                  (1, 'acpower', 120.0)}
@@ -0,0 +1,96 @@
+import pandas as pd
+import pytest
+
+from config import dbConfig
+from db import db
+from microGeneration import metric_ids, to_readings
+from migrate_readings import fields, fully_migrated, migrate_table
+
+table = 'solar_migrationtest_0'
+
+
+@pytest.fixture
+def wide_table():
+    with db(**dbConfig) as DB:
+        DB.session.execute(f"""
+            DROP TABLE IF EXISTS microgen.{table};
+            CREATE TABLE microgen.{table} (
+                uploadtime TIMESTAMP WITH TIME ZONE,
+                yieldtotal DOUBLE PRECISION,
+                inverterstatus VARCHAR(10),
+                batstatus TEXT);
+            INSERT INTO microgen.{table} VALUES
+                ('2023-01-01 12:00+00', 1.5, '102', 'Charging'),
+                ('2023-01-01 12:05+00', 1.6, '103', NULL);
+            """)
+        DB.session.commit()
+        tech_id = DB.connection.execute("""
+            INSERT INTO microgen.technologies (type, make, sn, instance_no)
+            VALUES ('solar', 'migrationtest', 'SN', 0)
+            RETURNING id
+            """).scalar()
+    yield tech_id
+    with db(**dbConfig) as DB:
+        for target in ['readings', 'readings_text']:
+            DB.session.execute(f"""
+                DELETE FROM microgen.{target} WHERE tech_id = {tech_id}""")
+        DB.session.execute(f"""
+            DROP TABLE microgen.{table};
+            DELETE FROM microgen.technologies WHERE id = {tech_id};
+            """)
+        DB.session.commit()
+
+
+def text_readings(DB: db, tech_id: int) -> dict:
+    names = {id: name for name, id in metric_ids(
+        ['inverterstatus', 'batstatus']).items()}
+    return {(str(row['ts']), names[row['metric_id']]): row['value']
+            for row in DB.connection.execute(f"""
+                SELECT ts, metric_id, value
+                FROM microgen.readings_text
+                WHERE tech_id = {tech_id}""")}
+
+
+def test_to_readings_text():
+    data = pd.DataFrame({
+        'uploadTime': pd.to_datetime(['2023-01-01 12:00'], utc=True),
+        'yieldTotal': [1.5], 'inverterStatus': ['102']})
+
+    numeric = to_readings(data, 1)
+    text = to_readings(data, 1, text=True)
+
+    assert numeric['metric_id'].tolist() == [metric_ids(['yieldtotal'])[
+        'yieldtotal']]
+    assert text['metric_id'].tolist() == [metric_ids(['inverterstatus'])[
+        'inverterstatus']]
+    assert text['value'].tolist() == ['102']
+
+
+def test_migrate_keeps_text_fields(wide_table):
+    with db(**dbConfig) as DB:
+        assert fields(DB, table) == (['yieldtotal'],
+                                     ['inverterstatus', 'batstatus'])
+        assert not fully_migrated(DB, table, wide_table)
+
+        # Two numeric and three text values (one is NULL)
+        assert migrate_table(DB, table, wide_table, pd.Timedelta(days=1)) == 5
+        assert text_readings(DB, wide_table) == {
+            ('2023-01-01 12:00:00+00:00', 'inverterstatus'): '102',
+            ('2023-01-01 12:00:00+00:00', 'batstatus'): 'Charging',
+            ('2023-01-01 12:05:00+00:00', 'inverterstatus'): '103'}
+        assert fully_migrated(DB, table, wide_table)
+
+        # Rerunning copies nothing more
+        assert migrate_table(DB, table, wide_table, pd.Timedelta(days=1)) == 0
+
+
+def test_not_fully_migrated_with_uncopied_text(wide_table):
+    with db(**dbConfig) as DB:
+        migrate_table(DB, table, wide_table, pd.Timedelta(days=1))
+        DB.session.execute(f"""
+            DELETE FROM microgen.readings_text
+            WHERE tech_id = {wide_table}""")
+        DB.session.commit()
+
+        # Every reading is in microgen.readings, but the text fields are not
+        assert not fully_migrated(DB, table, wide_table)
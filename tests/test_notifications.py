@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+
+import notifications
+from config import dbConfig
+from db import db
+
+
+@pytest.fixture(autouse=True)
+def empty_outbox():
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DELETE FROM notification.outbox')
+
+
+def outbox() -> list:
+    with db(**dbConfig) as DB:
+        return [(row['message'], row['occurrences'], row['status'])
+                for row in DB.connection.execute("""
+                    SELECT message, occurrences, status
+                    FROM notification.outbox
+                    ORDER BY id""")]
+
+
+def age(minutes: float):
+    """Move every message's first occurrence into the past"""
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(f"""
+                UPDATE notification.outbox
+                SET created_at = created_at - INTERVAL '{minutes} minutes'""")
+
+
+def test_repeats_are_counted():
+    notifications.enqueue('Disk full')
+    notifications.enqueue('Disk full')
+    notifications.enqueue('Disk full', title='Another title')
+
+    assert outbox() == [('Disk full', 2, 'pending'),
+                        ('Disk full', 1, 'pending')]
+
+
+def test_recurring_message_is_queued_each_window():
+    notifications.enqueue('Disk full')
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute("""
+                UPDATE notification.outbox SET status = 'sent'""")
+
+    # Repeated within the window, after it was sent
+    notifications.enqueue('Disk full')
+    assert outbox() == [('Disk full', 2, 'sent')]
+
+    # Still recurring once the window since it was first queued has passed
+    age(notifications.dedup_window_minutes + 1)
+    notifications.enqueue('Disk full')
+    assert outbox() == [('Disk full', 2, 'sent'),
+                        ('Disk full', 1, 'pending')]
+
+
+def test_sender_logs_errors(monkeypatch, caplog):
+    sender = notifications.OutboxSender(interval=0.1)
+
+    def unavailable():
+        sender._stop.set()
+        raise ConnectionError('Database unavailable')
+
+    monkeypatch.setattr(sender, 'send_pending', unavailable)
+    with caplog.at_level(logging.WARNING, logger='notifications'):
+        sender._run()
+
+    assert caplog.messages == [
+        'Unable to send notifications: Database unavailable']
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+import partitions
+from config import dbConfig
+from db import db
+
+table = 'partitions_test.events'
+
+
+@pytest.fixture
+def events(monkeypatch):
+    monkeypatch.setitem(partitions.partitioned_tables, table,
+                        {'key': 'ts', 'ddl': []})
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute(f"""
+                DROP SCHEMA IF EXISTS partitions_test CASCADE;
+                CREATE SCHEMA partitions_test;
+                CREATE TABLE {table} (ts TIMESTAMP WITH TIME ZONE,
+                                      value INT);
+                INSERT INTO {table} VALUES ('2023-01-15', 1);
+                """)
+    yield
+    with db(**dbConfig) as DB:
+        with DB.connection.begin():
+            DB.connection.execute('DROP SCHEMA partitions_test CASCADE')
+        DB.invalidate_catalog('partitions_test')
+
+
+def values() -> list:
+    with db(**dbConfig) as DB:
+        return [row['value'] for row in DB.connection.execute(
+            f'SELECT value FROM {table} ORDER BY value')]
+
+
+def test_convert_waits_for_writers(events):
+    with db(**dbConfig) as writer, db(**dbConfig) as DB:
+        converted = threading.Thread(target=partitions.convert,
+                                     args=(DB, table))
+        with writer.connection.begin():
+            writer.connection.execute(
+                f"INSERT INTO {table} VALUES ('2023-02-15', 2)")
+            converted.start()
+            time.sleep(0.5)
+            # Waiting for the insert to commit
+            assert converted.is_alive()
+        converted.join(timeout=10)
+
+        assert partitions.is_partitioned(DB, table)
+        assert partitions.partitions(DB, table)[:2] == [
+            'partitions_test.events_p202301', 'partitions_test.events_p202302']
+    assert values() == [1, 2]
+
+
+def test_convert_converted_table(events):
+    with db(**dbConfig) as DB:
+        partitions.convert(DB, table)
+        # e.g. by another process, which waited for the lock
+        partitions.convert(DB, table)
+
+        assert partitions.is_partitioned(DB, table)
+    assert values() == [1]
+
+
+def test_maintain_drains_default_first(events, monkeypatch):
+    monkeypatch.setattr(partitions, 'partitioned_tables', {
+        table: partitions.partitioned_tables[table]})
+    with db(**dbConfig) as DB:
+        partitions.convert(DB, table)
+        current = f"{table}_p{time.strftime('%Y%m', time.gmtime())}"
+        with DB.connection.begin():
+            # Rows for a month without a partition land in the default
+            DB.connection.execute(f'DROP TABLE {current}')
+            DB.connection.execute(
+                f'INSERT INTO {table} VALUES (CURRENT_TIMESTAMP, 2)')
+
+    partitions.maintain()
+
+    with db(**dbConfig) as DB:
+        assert current in partitions.partitions(DB, table)
+        assert DB.connection.execute(
+            f'SELECT COUNT(*) FROM {table}_default').scalar() == 0
+    assert values() == [1, 2]
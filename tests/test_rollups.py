@@ -0,0 +1,96 @@
+import pandas as pd
+import pytest
+
+import cost
+import rollups
+from config import dbConfig
+from db import db
+from microGeneration import write_readings
+
+# A technology id of its own, so only the readings written here are counted
+tech_id = 9000
+
+
+def write_usage(times: pd.DatetimeIndex, kwh: float, table='consumption'):
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(pd.DataFrame({
+            'interval_start': times,
+            'interval_end': times + pd.Timedelta('30min'),
+            'consumption': kwh}), table, schema='supply',
+            upsert_keys=['interval_start'], upsert_update=True)
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    def delete():
+        with db(**dbConfig) as DB:
+            with DB.connection.begin():
+                for table in ['hourly', 'daily', 'watermark', 'stale']:
+                    DB.connection.execute(f'DELETE FROM rollup.{table}')
+                for table in ['consumption', 'exported', 'tariff', 'cost']:
+                    if DB.table_exists(table, 'supply'):
+                        DB.connection.execute(f'DELETE FROM supply.{table}')
+                DB.connection.execute(f"""
+                    DELETE FROM microgen.readings
+                    WHERE tech_id IN ({tech_id}, {tech_id + 1})""")
+    delete()
+    yield
+    delete()
+
+
+def samples(times: list, tech: int, power: float):
+    write_readings(pd.DataFrame({
+        'uploadTime': pd.to_datetime(times, utc=True),
+        'acPower': power}), tech)
+
+
+def test_late_readings_are_rolled_up():
+    samples(['2023-06-01 12:00', '2023-06-01 13:05'], tech_id, 100.0)
+    rollups.after_write('generation')
+
+    # A second inverter reports an earlier hour after the first has been
+    # rolled up
+    samples(['2023-06-01 11:10', '2023-06-01 11:20'], tech_id + 1, 50.0)
+    rollups.after_write('generation')
+
+    hourly = rollups.query('generation', 'hourly', '2023-06-01 11:00Z',
+                           '2023-06-01 12:00Z', series=f'{tech_id + 1}.acpower')
+    assert hourly['sum'].tolist() == [100.0]
+    assert hourly['count'].tolist() == [2]
+
+
+def test_repeated_hour_is_two_buckets():
+    # 01:00 to 02:00 happens twice in Europe/London on 30 October 2022
+    write_usage(pd.date_range('2022-10-30 00:00Z', periods=4, freq='30min'),
+                1.0)
+    rollups.after_write('consumption')
+
+    hourly = rollups.query('consumption', 'hourly', '2022-10-30 00:00Z',
+                           '2022-10-30 02:00Z')
+    assert hourly['sum'].tolist() == [2.0, 2.0]
+    assert [bucket.isoformat() for bucket in hourly['bucket']] == [
+        '2022-10-30T01:00:00+01:00', '2022-10-30T01:00:00+00:00']
+
+    daily = rollups.query('consumption', 'daily', '2022-10-30 00:00+01:00',
+                          '2022-10-31 00:00Z')
+    assert daily['sum'].tolist() == [4.0]
+
+
+def test_summary():
+    day = pd.Timestamp('2023-06-01', tz='Europe/London')
+    assert cost.summary(day) is None
+
+    times = pd.date_range(day, periods=48, freq='30min')
+    write_usage(times, 0.5)
+    write_usage(times[:4], 0.25, 'exported')
+    with db(**dbConfig) as DB:
+        DB.dataframe_to_table(pd.DataFrame({
+            'valid_from': times, 'valid_to': times + pd.Timedelta('30min'),
+            'value_inc_vat': 20.0, 'value_exc_vat': 20.0}), 'tariff',
+            schema='supply', upsert_keys=['valid_from'], upsert_update=True)
+    rollups.after_write('consumption', 'exported')
+    cost.update()
+
+    assert cost.summary(day) == ('Imported 24.0 kWh\n'
+                                 'Exported 1.0 kWh\n'
+                                 'Cost £4.65 (£4.80 imported, £0.15 exported)')
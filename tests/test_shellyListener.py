@@ -0,0 +1,212 @@
+import json
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from action import shadow, Shelly
+from shellyListener import (CoIoTListener, MQTTListener, parse_coap,
+                            parse_coiot)
+
+# As in the devices file written by conftest.py
+device_id = 'immersion'
+mqtt_id = 'shelly1-ABCDEF'
+coiot_id = 'ABCDEF'
+
+
+def coap(options: list, payload: bytes = b'', token: bytes = b'') -> bytes:
+    """Encode a CoAP message (non-confirmable, code 0.30 as Shelly sends)
+
+    Args:
+        options (list): (option number, value) pairs
+    """
+    packet = bytes([0x50 | len(token), 0x1E, 0x00, 0x01]) + token
+
+    def extended(value: int):
+        # Nibble and the bytes following the option header
+        if value >= 269:
+            return 14, struct.pack('!H', value - 269)
+        if value >= 13:
+            return 13, bytes([value - 13])
+        return value, b''
+
+    number = 0
+    for option, value in sorted(options):
+        delta, delta_bytes = extended(option - number)
+        length, length_bytes = extended(len(value))
+        packet += bytes([delta << 4 | length]) + delta_bytes + length_bytes \
+            + value
+        number = option
+    if payload:
+        packet += b'\xff' + payload
+    return packet
+
+
+def status(is_on: bool, sensor: int = 1101, device: str = coiot_id) -> bytes:
+    """CoIoT status message for a Shelly 1"""
+    return coap([(3332, f'SHSW-1#{device}#2'.encode()),
+                 (3412, struct.pack('!H', 38400))],
+                json.dumps({'G': [[0, 9103, 0], [0, sensor, int(is_on)]]}
+                           ).encode())
+
+
+def wait_until(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture(autouse=True)
+def unknown_state():
+    shadow.invalidate(Shelly.device_type, device_id)
+
+
+def test_parse_coap():
+    long_value = b'x' * 300
+    options, payload = parse_coap(coap([(11, b'cit'), (3332, long_value)],
+                                       b'{"G": []}', token=b'\x01\x02'))
+
+    assert options == {11: [b'cit'], 3332: [long_value]}
+    assert payload == b'{"G": []}'
+
+
+def test_parse_coap_without_payload():
+    options, payload = parse_coap(coap([(11, b'cit'), (11, b's')]))
+
+    assert options == {11: [b'cit', b's']}
+    assert payload == b''
+
+
+def test_parse_coap_rejects_other_messages():
+    with pytest.raises(ValueError):
+        parse_coap(b'\x00\x01')
+    with pytest.raises(ValueError):
+        # CoAP version 2
+        parse_coap(b'\x80\x1e\x00\x01')
+
+
+@pytest.mark.parametrize('sensor', [112, 1101])
+def test_parse_coiot(sensor):
+    assert parse_coiot(status(True, sensor)) == (coiot_id, True)
+    assert parse_coiot(status(False, sensor)) == (coiot_id, False)
+
+
+def test_parse_coiot_without_relay_state():
+    # e.g. a Shelly H&T, which has no relay
+    assert parse_coiot(status(True, sensor=3101)) is None
+    # CoIoT description rather than status
+    assert parse_coiot(coap([(3332, b'SHSW-1#ABCDEF#2')])) is None
+
+
+def test_coiot_listener_updates_shadow():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    listener = CoIoTListener(port=port)
+    listener.start()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            # Sent until the listener has bound its socket
+            def reported(is_on):
+                sender.sendto(b'not coap', ('127.0.0.1', port))
+                sender.sendto(status(True, device='UNKNOWN'),
+                              ('127.0.0.1', port))
+                sender.sendto(status(is_on), ('127.0.0.1', port))
+                return shadow.get(Shelly.device_type, device_id) == is_on
+
+            assert wait_until(lambda: reported(True))
+            assert wait_until(lambda: reported(False))
+    finally:
+        listener.stop()
+
+
+class StandInBroker:
+    """Just enough of an MQTT 3.1.1 broker for one client
+
+    Accepts a connection, acknowledges CONNECT and SUBSCRIBE, and then
+    publishes each message in messages (QoS 0).
+    """
+
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.subscriptions = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _read(connection: socket.socket, n: int) -> bytes:
+        data = b''
+        while len(data) < n:
+            chunk = connection.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('Client disconnected')
+            data += chunk
+        return data
+
+    def _packet(self, connection: socket.socket):
+        packet_type = self._read(connection, 1)[0] >> 4
+        length, shift = 0, 0
+        while True:
+            byte = self._read(connection, 1)[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return packet_type, self._read(connection, length)
+
+    @staticmethod
+    def _publish(topic: str, payload: bytes) -> bytes:
+        body = struct.pack('!H', len(topic)) + topic.encode() + payload
+        return bytes([0x30, len(body)]) + body
+
+    def _run(self):
+        connection, _ = self.server.accept()
+        with connection:
+            try:
+                while True:
+                    packet_type, body = self._packet(connection)
+                    if packet_type == 1:  # CONNECT
+                        connection.sendall(b'\x20\x02\x00\x00')
+                    elif packet_type == 8:  # SUBSCRIBE
+                        topic_length = struct.unpack('!H', body[2:4])[0]
+                        self.subscriptions.append(
+                            body[4:4 + topic_length].decode())
+                        connection.sendall(b'\x90\x03' + body[:2] + b'\x00')
+                        for topic, payload in self.messages:
+                            connection.sendall(self._publish(topic, payload))
+                    elif packet_type == 12:  # PINGREQ
+                        connection.sendall(b'\xd0\x00')
+                    elif packet_type == 14:  # DISCONNECT
+                        return
+            except (ConnectionError, OSError):
+                return
+
+    def close(self):
+        self.server.close()
+
+
+def test_mqtt_listener_updates_shadow():
+    broker = StandInBroker([
+        ('shellies/shelly1-UNKNOWN/relay/0', b'on'),
+        (f'shellies/{mqtt_id}/relay/0', b'overpower'),
+        (f'shellies/{mqtt_id}/relay/0', b'on'),
+    ])
+    listener = MQTTListener('127.0.0.1', broker.port)
+    listener.start()
+    try:
+        assert wait_until(
+            lambda: shadow.get(Shelly.device_type, device_id) is True)
+        assert broker.subscriptions == [MQTTListener.topic]
+    finally:
+        listener.stop()
+        broker.close()
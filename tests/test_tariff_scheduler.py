@@ -0,0 +1,32 @@
+import logging
+
+import pandas as pd
+
+from tariff_scheduler import Schedulable, schedule
+
+
+def tariff(prices: list) -> pd.DataFrame:
+    starts = pd.date_range('2023-06-01 00:00', periods=len(prices),
+                           freq='30min', tz='UTC')
+    return pd.DataFrame({'valid_from': starts,
+                         'valid_to': starts + pd.Timedelta('30min'),
+                         'value_inc_vat': prices})
+
+
+def test_cheapest_slots():
+    actions = schedule(tariff([30.0, 10.0, 5.0, 20.0]),
+                       [Schedulable('immersion', energy_kwh=3, power_kw=3)])
+
+    assert actions['action'].tolist() == ['on', 'off']
+    assert actions['action_time'].tolist() == [
+        pd.Timestamp('2023-06-01 00:30', tz='UTC'),
+        pd.Timestamp('2023-06-01 01:30', tz='UTC')]
+
+
+def test_empty_tariff(caplog):
+    with caplog.at_level(logging.WARNING, logger='tariff_scheduler'):
+        actions = schedule(tariff([]),
+                           [Schedulable('immersion', energy_kwh=3)])
+
+    assert len(actions) == 0
+    assert 'No future tariff slots' in caplog.text
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+import microGeneration
+from microGeneration import SampleSkipped, Solar
+from throttle import CircuitBreaker
+
+
+def half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    time.sleep(0.1)
+    assert breaker.state == 'half open'
+    return breaker
+
+
+def test_one_trial_when_half_open():
+    breaker = half_open_breaker()
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+
+def test_released_trial_allows_another():
+    breaker = half_open_breaker()
+    assert breaker.allow()
+
+    # Another thread can't end this thread's trial
+    other = threading.Thread(target=breaker.release)
+    other.start()
+    other.join()
+    assert not breaker.allow()
+
+    breaker.release()
+    assert breaker.state == 'half open'
+    assert breaker.allow()
+
+
+def test_unexpected_error_ends_trial(monkeypatch):
+    breaker = half_open_breaker()
+    monkeypatch.setitem(microGeneration._breakers, 'http://solax.invalid',
+                        breaker)
+
+    def unexpected(*args, **kwargs):
+        raise ValueError('Unexpected')
+
+    monkeypatch.setattr(microGeneration.requests, 'get', unexpected)
+    solar = Solar('solax', {'API_URL': 'http://solax.invalid', 'key': 'key',
+                            'SN': 'SN'}, 0)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            solar._get_data(time.monotonic() + 5)
+    # Still half open, rather than skipping every call as circuit_open
+    assert breaker.state == 'half open'
+
+    with pytest.raises(SampleSkipped):
+        solar._get_data(time.monotonic() - 1)
+    assert breaker.allow()
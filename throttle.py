@@ -0,0 +1,159 @@
+"""Rate limiting and retry helpers shared by the API clients"""
+
+import random
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """Token bucket rate limiter
+
+    Holds up to capacity tokens, refilled at rate tokens per second. Each
+    call costs one token, so bursts of up to capacity calls are allowed
+    while the long term rate is capped at rate.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens: float = 1) -> bool:
+        """Take tokens if available. Returns False (without waiting) if not"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1):
+        """Wait until tokens are available, then take them"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """One token bucket per host, e.g. to respect each API's rate limit"""
+
+    def __init__(self, rates: Dict[str, float], default_rate: float,
+                 burst: float = 1):
+        """
+        Args:
+            rates (Dict[str, float]): Requests per second for named hosts
+            default_rate (float): Requests per second for any other host
+            burst (float, optional): Requests allowed at once. Defaults to 1.
+        """
+        self.rates = rates
+        self.default_rate = default_rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url: str):
+        """Wait until a request may be made to url's host"""
+        host = urlparse(url).hostname
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(
+                    self.rates.get(host, self.default_rate), self.burst)
+            bucket = self._buckets[host]
+        bucket.acquire()
+
+
+def backoff(attempt: int, base: float, cap: float, jitter: bool = True
+            ) -> float:
+    """Capped exponential backoff
+
+    Args:
+        attempt (int): Number of previous failed attempts (0 for the first retry)
+        base (float): Delay after the first failure in seconds
+        cap (float): Maximum delay in seconds
+        jitter (bool, optional): Randomise the delay between 0 and the exponential value ("full jitter") so that clients do not retry in lockstep. Defaults to True.
+
+    Returns:
+        float: Delay in seconds before the next attempt
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(0, delay) if jitter else delay
+
+
+class CircuitBreaker:
+    """Stop calling an endpoint that keeps failing
+
+    After failure_threshold consecutive failures the breaker opens and
+    allow() returns False for reset_timeout seconds. After that one trial
+    call is allowed (half open): success closes the breaker, failure opens
+    it again. Callers release() the breaker once the call is over, in a
+    finally, so a trial which ends some other way (e.g. an unexpected
+    error) lets another trial be made.
+    """
+
+    def __init__(self, failure_threshold: int = 5,
+                 reset_timeout: float = 300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # Thread making the half open trial call, False if there is none
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """Whether a call may be made now"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half open' and not self._trial:
+                self._trial = threading.get_ident()
+                return True
+            return False
+
+    def release(self):
+        """End this thread's trial call if neither success nor failure was
+        recorded for it"""
+        with self._lock:
+            if self._trial == threading.get_ident():
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False